@@ -33,7 +33,7 @@ It is a subclass of the DiscoveryListener class.
 More details are documented in the ArpDiscoveryListener class
 '''
 
-import sys
+import sys, socket
 from consts import CMAconsts
 from store import Store
 from AssimCclasses import pyConfigContext
@@ -43,6 +43,54 @@ from graphnodes import NICNode, IPaddrNode, GraphNode
 from systemnode import SystemNode
 from cmaconfig import ConfigFile
 from linkdiscovery import discovery_indicates_link_is_up
+from graphnodeexpression import LRUCache
+
+class ArpIPMap(object):
+    '''A bounded in-memory map of IP address => MAC address.
+    It's organized by subnet, with a limit on the number of subnets and a limit
+    on the number of addresses we remember for each subnet - so one huge
+    (or hostile) subnet can't push everyone else out.
+    Forgetting something just means we'll check the database for it again.
+    '''
+    V4MAPPED = '\x00' * 10 + '\xff\xff'   # Prefix of IPv4-mapped IPv6 addresses
+
+    def __init__(self, maxsubnets=1024, maxpersubnet=4096):
+        'Initialize our ArpIPMap'
+        self.maxpersubnet = maxpersubnet
+        self.subnets = LRUCache(maxsubnets)
+
+    @staticmethod
+    def subnetkey(ip):
+        '''Return the (approximate) subnet this address belongs to: its /24 or /64.
+        Nanoprobes report IPv4 addresses as IPv4-mapped IPv6 (::ffff:a.b.c.d) - those
+        get the /24 of the IPv4 address they contain.'''
+        try:
+            if ip.find(':') >= 0:
+                packed = socket.inet_pton(socket.AF_INET6, ip.strip('[]'))
+                if packed.startswith(ArpIPMap.V4MAPPED):
+                    return packed[12:15]
+                return packed[:8]
+            return socket.inet_aton(ip)[:3]
+        except (socket.error, ValueError):
+            return ip
+
+    def get(self, ip):
+        'Return the MAC address we think goes with this IP - or None'
+        subnet = self.subnets.get(ArpIPMap.subnetkey(ip))
+        return None if subnet is None else subnet.get(ip)
+
+    def put(self, ip, macaddr):
+        'Remember the MAC address that goes with this IP'
+        key = ArpIPMap.subnetkey(ip)
+        subnet = self.subnets.get(key)
+        if subnet is None:
+            subnet = LRUCache(self.maxpersubnet)
+            self.subnets.put(key, subnet)
+        subnet.put(ip, macaddr)
+
+    def __len__(self):
+        'Return the number of IP addresses we know about'
+        return sum([len(subnet) for subnet in self.subnets.cache.values()])
 
 @SystemNode.add_json_processor   # Register ourselves to process discovery packets
 class ArpDiscoveryListener(DiscoveryListener):
@@ -76,6 +124,12 @@ class ArpDiscoveryListener(DiscoveryListener):
     Of course, a lot of what causes this code to be really slow is the fact that we
     hit the database with a transaction for each IP and each MAC that we find in the
     message.
+
+    So we compute our own deltas: we remember the last ARP table we got from each
+    drone and interface, and only look at entries which are new or have moved.
+    On top of that, we keep a bounded map of IP => MAC (warmed up from the
+    database with a single query) and skip any entries the database already has.
+    The rest we look up - along with the NICs which own them now - in one query.
     '''
 
     prio = DiscoveryListener.PRI_OPTION     # This is an optional feature
@@ -87,10 +141,22 @@ class ArpDiscoveryListener(DiscoveryListener):
     #               the requests we send above...
     wantedpackets = ('ARP', 'netconfig')
 
-    ip_map = {}
-    mac_map = {}
+    ip_map = ArpIPMap()     # IP => MAC as we believe the database has it
+    _ip_map_warmed = False
+    # (domain, designation, instance) => previous {IP: MAC} table
+    # Forgetting one just means we look at all of that table's entries next time.
+    last_arp = LRUCache(1024)
+    stats = {'entries': 0, 'changed': 0, 'known': 0, 'updated': 0}
+    warmquery = '''START nic=node:NICNode('*:*')
+                   MATCH (nic)-[:%s]->(ip)
+                   RETURN nic.macaddr AS macaddr, ip.ipaddr AS ipaddr''' % CMAconsts.REL_ipowner
+    # The IPaddrNodes for a set of 'ipaddr:domain' Lucene terms - with the NICs which own them
+    ipownerquery = '''START ip=node:IPaddrNode({ipaddrs})
+                      OPTIONAL MATCH (nic)-[:%s]->(ip)
+                      RETURN ip, collect(nic) AS nics''' % CMAconsts.REL_ipowner
+    lookupbatch = 256   # Lucene allows 1024 clauses by default
 
-    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged):
+    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged, _dispatch=None):
         '''Trigger ARP discovery or add ARP data to the database.
         '''
         if not discoverychanged:
@@ -147,68 +213,116 @@ class ArpDiscoveryListener(DiscoveryListener):
         that did the discovery is a reasonable choice.
         '''
 
+        if not ArpDiscoveryListener._ip_map_warmed:
+            self.warm_ip_map()
         data = jsonobj['data']
+        arpkey = (drone.domain, drone.designation, jsonobj.get('instance', None))
+        previous = ArpDiscoveryListener.last_arp.get(arpkey)
+        if previous is None:
+            previous = {}
+        current = {}
         maciptable = {}
-        # Group the IP addresses by MAC address - reversing the map
+        # Group the new and moved IP addresses by MAC address - reversing the map
         for ip in data.keys():
             mac = str(data[ip])
+            ip = str(ip)
+            current[ip] = mac
+            ArpDiscoveryListener.stats['entries'] += 1
+            if previous.get(ip) == mac:
+                # Same as last time - unless someone else has seen it move since then
+                mapmac = ArpDiscoveryListener.ip_map.get(ip)
+                if mapmac is None or mapmac == mac:
+                    continue
+            ArpDiscoveryListener.stats['changed'] += 1
             if mac not in maciptable:
                 maciptable[mac] = []
             maciptable[mac].append(ip)
 
+        updates = {}
         for mac in maciptable:
-            self.filtered_add_mac_ip(drone, mac, maciptable[mac])
+            if self.needs_update(mac, maciptable[mac]):
+                updates[mac] = maciptable[mac]
+        if updates:
+            self.add_mac_ips(drone, updates)
+            for mac in updates:
+                for ip in updates[mac]:
+                    ArpDiscoveryListener.ip_map.put(ip, mac)
+        ArpDiscoveryListener.last_arp.put(arpkey, current)
+
+    @classmethod
+    def abort(cls):
+        '''The transaction was aborted - so the database may not have what we remember.
+        Start over from the database.'''
+        ArpDiscoveryListener.last_arp.clear()
+        ArpDiscoveryListener.ip_map = ArpIPMap()
+        ArpDiscoveryListener._ip_map_warmed = False
+
+    def warm_ip_map(self):
+        'Load our IP => MAC map from the database - all in one query'
+        ArpDiscoveryListener._ip_map_warmed = True
+        count = 0
+        for row in self.store.load_cypher_query(ArpDiscoveryListener.warmquery,
+                                                GraphNode.factory):
+            if row.macaddr is not None and row.ipaddr is not None:
+                ArpDiscoveryListener.ip_map.put(str(row.ipaddr), str(row.macaddr))
+                count += 1
+        if self.debug:
+            self.log.debug('ARP IP map warmed with %d IP addresses' % count)
 
-    def filtered_add_mac_ip(self, drone, macaddr, IPlist):
-        '''We process all the IP addresses that go with a given MAC address (NICNode)
-        The parameters are expected to be canonical address strings like str(pyNetAddr(...)).
+    @staticmethod
+    def needs_update(macaddr, IPlist):
+        '''Return True if the database might not relate all these IP addresses
+        to this MAC address (NICNode).
 
         Lots of the information we're given is typically repeats of information we
-        were given before.  This is why we keep these two in-memory maps
+        were given before.  This is why we keep our in-memory IP => MAC map
         - to help speed that up by a huge factor.
         '''
         for ip in IPlist:
             if ArpDiscoveryListener.ip_map.get(ip) != macaddr:
-                self.add_mac_ip(drone, macaddr, IPlist)
-                for ip in IPlist:
-                    ArpDiscoveryListener.ip_map[ip] = macaddr
-                    if macaddr not in ArpDiscoveryListener.mac_map:
-                        ArpDiscoveryListener.mac_map[macaddr] = []
-                    if ip not in ArpDiscoveryListener.mac_map[macaddr]:
-                        ArpDiscoveryListener.mac_map[macaddr].append(ip)
-                return
-
-    def add_mac_ip(self, drone, macaddr, IPlist):
-        '''We process all the IP addresses that go with a given MAC address (NICNode)
-        The parameters are expected to be canonical address strings like str(pyNetAddr(...)).
+                ArpDiscoveryListener.stats['updated'] += 1
+                return True
+        ArpDiscoveryListener.stats['known'] += 1
+        return False
+
+    def load_ip_owners(self, domain, IPlist):
+        '''Return {ip: (IPaddrNode, [owning NICNodes])} for those of these IP addresses
+        which are in the database - using one query for each batch of addresses.'''
+        ret = {}
+        batch = ArpDiscoveryListener.lookupbatch
+        for start in range(0, len(IPlist), batch):
+            ipaddrs = ' OR '.join(['%s:%s' % (Store.lucene_escape(ip), Store.lucene_escape(domain))
+                                   for ip in IPlist[start:start+batch]])
+            for (ipnode, nics) in self.store.load_cypher_query(ArpDiscoveryListener.ipownerquery,
+                    GraphNode.factory, params={'ipaddrs': ipaddrs}):
+                ret[str(ipnode.ipaddr)] = (ipnode, nics)
+        return ret
+
+    def add_mac_ips(self, drone, maciptable):
+        '''We relate each MAC address (NICNode) to all the IP addresses that go with it
+        - maciptable is {macaddr: [ipaddr, ...]}.
+        The addresses are expected to be canonical address strings like str(pyNetAddr(...)).
+        We look up all the IP addresses and the NICs that currently own them at once,
+        then relate each IP to its new NIC (separating it from any other NIC) directly.
         '''
-        nicnode = self.store.load_or_create(NICNode, domain=drone.domain, macaddr=macaddr)
-        if not Store.is_abstract(nicnode):
-            # This NIC already existed - let's see what IPs it already owned
-            currips = {}
-            oldiplist = self.store.load_related(nicnode, CMAconsts.REL_ipowner, IPaddrNode)
-            for ipnode in oldiplist:
-                currips[ipnode.ipaddr] = ipnode
-                #print >> sys.stderr, ('IP %s already related to NIC %s'
-                #%       (str(ipnode.ipaddr), str(nicnode.macaddr)))
-            # See what IPs still need to be added
-            ips_to_add = []
-            for ip in IPlist:
-                if ip not in currips:
-                    ips_to_add.append(ip)
-            # Replace the original list of IPs with those not already there...
-            IPlist = ips_to_add
-
-        # Now we have a NIC and IPs which aren't already related to it
-        for ip in IPlist:
-            ipnode = self.store.load_or_create(IPaddrNode, domain=drone.domain, ipaddr=ip)
-            #print >> sys.stderr, ('CREATING IP %s for NIC %s'
-            #%       (str(ipnode.ipaddr), str(nicnode.macaddr)))
-            if not Store.is_abstract(ipnode):
-                # Then this IP address already existed,
-                # but it wasn't related to our NIC...
-                # Make sure it isn't related to a different NIC
-                for oldnicnode in self.store.load_in_related(ipnode, CMAconsts.REL_ipowner,
-                                                             GraphNode.factory):
-                    self.store.separate(oldnicnode, CMAconsts.REL_ipowner, ipnode)
-            self.store.relate(nicnode, CMAconsts.REL_ipowner, ipnode)
+        owners = self.load_ip_owners(drone.domain,
+                                     [ip for mac in maciptable for ip in maciptable[mac]])
+        for macaddr in maciptable:
+            nicnode = self.store.load_or_create(NICNode, domain=drone.domain, macaddr=macaddr)
+            nicid = None if Store.is_abstract(nicnode) else Store.id(nicnode)
+            for ip in maciptable[macaddr]:
+                if ip not in owners:
+                    # Our query says it's not in the database - no need to ask again
+                    ipnode = self.store.save(IPaddrNode(domain=drone.domain, ipaddr=ip))
+                    self.store.relate(nicnode, CMAconsts.REL_ipowner, ipnode)
+                    continue
+                (ipnode, oldnics) = owners[ip]
+                alreadyours = False
+                for oldnic in oldnics:
+                    if nicid is not None and Store.id(oldnic) == nicid:
+                        alreadyours = True
+                    else:
+                        # An IP address can only belong to one NIC
+                        self.store.separate(oldnic, CMAconsts.REL_ipowner, ipnode)
+                if not alreadyours:
+                    self.store.relate(nicnode, CMAconsts.REL_ipowner, ipnode)
@@ -27,9 +27,11 @@
 Assimilation Command Line tool.
 We support the following commands:
     query - perform one of our canned ClientQuery queries
+    bpwhatif - evaluate a proposed best practice rule across all systems
+    monrulebench - try out monitoring rules on captured discovery data - no database needed
 '''
 
-import sys, os, getent
+import sys, os, getent, time
 from py2neo import neo4j
 from query import ClientQuery
 from consts import CMAconsts
@@ -37,8 +39,8 @@ from graphnodes import GraphNode
 from store import Store
 from AssimCtypes import QUERYINSTALL_DIR, cryptcurve25519_gen_persistent_keypair,   \
     cryptcurve25519_cache_all_keypairs, CMA_KEY_PREFIX, CMAUSERID, BPINSTALL_DIR,   \
-    CMAINITFILE
-from AssimCclasses import pyCryptFrame, pyCryptCurve25519
+    CMAINITFILE, MONRULEINSTALL_DIR
+from AssimCclasses import pyCryptFrame, pyCryptCurve25519, pyConfigContext
 from cmaconfig import ConfigFile
 from cmadb import Neo4jCreds, CMAdb
 #
@@ -47,6 +49,10 @@ from cmadb import Neo4jCreds, CMAdb
 import droneinfo, hbring, monitoring
 from cmainit import CMAinit
 from bestpractices import BestPractices
+from columnareval import ColumnarTable, ColumnarRuleEvaluator
+from monitoring import MonitoringRule
+from graphnodes import ProcessNode, JSONMapNode
+from graphnodeexpression import ExpressionContext
 
 commands = {}
 
@@ -285,6 +291,291 @@ class neo4jpass(object):
         Neo4jCreds().update(newauth=otherargs[0] if len(otherargs) > 0 else None)
 
 
+@RegisterCommand
+class bpwhatif(object):
+    '''Evaluate a (proposed) best practice rule against the current discovery data
+    for every system - all at once.'''
+
+    whatifquery = '''START drone=node:Drone('*:*')
+                     MATCH (drone)-[rel:jsonattr]->(jsonmap)
+                     WHERE rel.jsonname = {jsonname}
+                     RETURN drone, jsonmap.json AS json'''
+
+    @staticmethod
+    def usage():
+        "reports usage for this sub-command"
+        return 'bpwhatif discovery-type rule-expression [rule-category]'
+
+    @staticmethod
+    def execute(store, _executor_context, otherargs, flagoptions):
+        'Evaluate the rule across all systems and summarize what would happen'
+        if len(otherargs) not in (2, 3):
+            return usage()
+        discoverytype = otherargs[0]
+        rule = otherargs[1]
+        category = otherargs[2] if len(otherargs) > 2 else 'security'
+        start = time.time()
+        rownames = []
+        rowobjs = []
+        for (drone, json) in store.load_cypher_query(bpwhatif.whatifquery, GraphNode.factory,
+                                                      params={'jsonname': discoverytype}):
+            jsonobj = pyConfigContext(JSONMapNode.decode(json))
+            if jsonobj is None or 'data' not in jsonobj:
+                continue
+            rownames.append(drone.designation)
+            rowobjs.append(jsonobj['data'])
+        loaded = time.time()
+        evaluator = ColumnarRuleEvaluator(ColumnarTable(rownames, rowobjs))
+        results = evaluator.evaluate(rule)
+        statuses = {'pass': [], 'fail': [], 'ignore': [], 'NA': []}
+        for rownum in range(len(rownames)):
+            status = ColumnarRuleEvaluator.rulestatus(rule, category, results[rownum])
+            if status is not None:
+                statuses[status].append(rownames[rownum])
+        done = time.time()
+        for status in ('pass', 'fail', 'ignore', 'NA'):
+            print '%-6s %d' % (status+':', len(statuses[status]))
+        if flagoptions.get('hostnames', False):
+            for designation in sorted(statuses['fail']):
+                print 'FAIL:  %s' % designation
+        print >> sys.stderr, ('%d systems: %.2f seconds loading, %.2f seconds evaluating'
+        %   (len(rownames), loaded-start, done-loaded))
+        return 0
+
+
+class OfflineSystem(dict):
+    '''A stand-in for a Drone made from captured discovery files - so we can
+    evaluate monitoring rules without a database.
+    Each discovery file is available as "_init_<filename>" - just like in a Drone.
+    '''
+    def __init__(self, designation, discovery):
+        'Initialize our OfflineSystem from a {discovery-name: JSON-string} dict'
+        dict.__init__(self)
+        self.designation = designation
+        self.domain = CMAconsts.globaldomain
+        self._parsed = {}
+        for name in discovery:
+            self['_init_' + name] = discovery[name]
+
+    def get(self, name, alternative=None):
+        'Return the value of this (possibly dotted) name'
+        if name in self:
+            return self[name]
+        if name.find('.') < 0:
+            return alternative
+        (prefix, suffix) = name.split('.', 1)
+        if prefix not in self:
+            return alternative
+        if prefix not in self._parsed:
+            self._parsed[prefix] = pyConfigContext(self[prefix])
+        if self._parsed[prefix] is None:
+            return alternative
+        return self._parsed[prefix].deepget(suffix, alternative)
+
+@RegisterCommand
+class monrulebench(object):
+    '''Run our monitoring rules over captured discovery data for a set of systems.
+    Each directory containing a "tcpdiscovery" file is a system, and any other
+    discovery files alongside it (like "monitoringagents") describe that system.
+    We report how things matched, and how long each rule took to evaluate.
+    '''
+    PRIONAMES = ('NOMATCH', 'NEVERMATCH', 'PARTMATCH', 'LOWPRIOMATCH', 'MEDPRIOMATCH',
+                 'HIGHPRIOMATCH')
+    SLOWEST = 10
+
+    @staticmethod
+    def usage():
+        "reports usage for this sub-command"
+        return 'monrulebench discovery-directory [monitoring-rule-directory]'
+
+    @staticmethod
+    def load_systems(rootdirname):
+        'Return a list of (OfflineSystem, tcpdiscovery-data) from this directory tree'
+        systems = []
+        for (dirpath, dirnames, filenames) in os.walk(rootdirname):
+            dirnames.sort()
+            if 'tcpdiscovery' not in filenames:
+                continue
+            discovery = {}
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'r') as f:
+                    discovery[filename] = f.read()
+            tcpdiscovery = pyConfigContext(discovery['tcpdiscovery'])
+            if tcpdiscovery is None or 'data' not in tcpdiscovery:
+                print >> sys.stderr, 'Skipping %s: invalid tcpdiscovery JSON' % dirpath
+                continue
+            designation = os.path.relpath(dirpath, rootdirname)
+            systems.append((OfflineSystem(designation, discovery), tcpdiscovery['data']))
+        return systems
+
+    @staticmethod
+    def services(system, data):
+        'Return ProcessNodes for each listening process in this tcpdiscovery data'
+        ret = []
+        for procname in data.keys():
+            procinfo = data[procname]
+            if 'listenaddrs' not in procinfo:
+                continue
+            processproc = ProcessNode(system.domain, procname, system.designation
+            ,   procinfo.get('exe', 'unknown'), procinfo.get('cmdline', 'unknown')
+            ,   procinfo.get('uid', 'unknown'), procinfo.get('gid', 'unknown')
+            ,   procinfo.get('cwd', '/'), roles=(CMAconsts.ROLE_server,))
+            processproc.procinfo = str(procinfo)
+            ret.append(processproc)
+        return ret
+
+    @staticmethod
+    def rulename(rule):
+        'Return a printable name for this rule'
+        if hasattr(rule, 'filename'):
+            return os.path.basename(rule.filename)
+        return '%s:%s' % (rule.monitorclass, getattr(rule, 'rsctype',
+                                                     getattr(rule, 'servicename', '?')))
+
+    @staticmethod
+    def timefindbestmatch(contexts, useindex, usecache):
+        'Time findbestmatch over these contexts - returning (seconds, results)'
+        MonitoringRule.useindex = useindex
+        MonitoringRule.usedecisioncache = usecache
+        start = time.time()
+        results = [MonitoringRule.findbestmatch(context) for context in contexts]
+        return (time.time() - start, results)
+
+    @staticmethod
+    def execute(_store, _executor_context, otherargs, flagoptions):
+        'Evaluate monitoring rules against our captured discovery data and summarize'
+        if len(otherargs) not in (1, 2):
+            return usage()
+        MonitoringRule.load_tree(otherargs[1] if len(otherargs) > 1 else MONRULEINSTALL_DIR)
+        systems = monrulebench.load_systems(otherargs[0])
+        procs = []
+        for (system, data) in systems:
+            procs.extend([(proc, system) for proc in monrulebench.services(system, data)])
+        print '%d systems, %d listening processes' % (len(systems), len(procs))
+
+        # Per-rule evaluation cost - every rule against every process
+        ruletimes = {}
+        for (proc, system) in procs:
+            for rules in MonitoringRule.monobjclass('service').values():
+                for rule in rules:
+                    context = ExpressionContext((proc, system))
+                    start = time.time()
+                    rule.specmatch(context)
+                    elapsed = time.time() - start
+                    name = monrulebench.rulename(rule)
+                    (count, total) = ruletimes.get(name, (0, 0.0))
+                    ruletimes[name] = (count+1, total+elapsed)
+
+        # The matcher as a whole - exhaustively, using the rule index, and with decisions cached
+        contexts = [ExpressionContext((proc, system)) for (proc, system) in procs]
+        (scantime, scanresults) = monrulebench.timefindbestmatch(contexts, False, False)
+        (indextime, indexresults) = monrulebench.timefindbestmatch(contexts, True, False)
+        (cachetime, cacheresults) = monrulebench.timefindbestmatch(contexts, True, True)
+        if str(scanresults) != str(indexresults) or str(scanresults) != str(cacheresults):
+            print >> sys.stderr, 'WARNING: findbestmatch results differ between methods!'
+
+        distribution = {}
+        for j in range(len(procs)):
+            (proc, system) = procs[j]
+            match = indexresults[j]
+            prioname = monrulebench.PRIONAMES[match[0]]
+            if match[0] in (MonitoringRule.NOMATCH, MonitoringRule.PARTMATCH):
+                how = prioname
+            else:
+                how = '%s %s::%s' % (prioname, match[1]['monitorclass'], match[1]['monitortype'])
+            distribution[how] = distribution.get(how, 0) + 1
+            if flagoptions.get('hostnames', False):
+                print '%s: %s: %s' % (system.designation, proc.pathname, how)
+        hostmatches = 0
+        start = time.time()
+        for (system, _data) in systems:
+            hostmatches += len(MonitoringRule.findallmatches((system,), objclass='host'))
+        hosttime = time.time() - start
+
+        print 'Service match distribution:'
+        for how in sorted(distribution.keys(), key=lambda how: -distribution[how]):
+            print '    %6d  %s' % (distribution[how], how)
+        print 'Host-level matches: %d (%.3f seconds)' % (hostmatches, hosttime)
+        print ('findbestmatch: %.3f seconds scanning, %.3f seconds indexed, %.3f seconds cached'
+        %       (scantime, indextime, cachetime))
+        print 'Slowest rules (total seconds, evaluations, microseconds per evaluation):'
+        slowest = sorted(ruletimes.keys(), key=lambda name: -ruletimes[name][1])
+        for name in slowest[:monrulebench.SLOWEST]:
+            (count, total) = ruletimes[name]
+            print '    %8.4f %6d %8.1f  %s' % (total, count, 1000000.0*total/count, name)
+        return 0
+
+@RegisterCommand
+class compressjson(object):
+    '''Rewrite all our stored JSON discovery data (JSONMapNodes) so that those at least
+    'threshold' bytes long are stored compressed - and the rest uncompressed.
+    A threshold of 0 uncompresses everything.
+    We report how much space (and transfer from the database) this saves.
+    We work with the stored 'json' property directly - constructing a JSONMapNode
+    would re-encode it using our own (default) threshold.
+    '''
+    batchquery = '''START jsonmap=node:JSONMapNode('*:*')
+                    WHERE id(jsonmap) > {lastid}
+                    RETURN id(jsonmap) AS id, jsonmap.json AS json
+                    ORDER BY id(jsonmap) LIMIT {batchsize}'''
+    updatequery = '''START jsonmap=node({id}) SET jsonmap.json = {json}'''
+    batchsize = 200
+
+    @staticmethod
+    def usage():
+        "reports usage for this sub-command"
+        return 'compressjson [threshold-bytes]'
+
+    @staticmethod
+    def execute(store, _executor_context, otherargs, _flagoptions):
+        'Rewrite our JSONMapNodes and report the savings'
+        if len(otherargs) > 1:
+            return usage()
+        try:
+            threshold = int(otherargs[0]) if otherargs else 16384
+        except ValueError:
+            return usage()
+        counts = {'nodes': 0, 'compressed': 0, 'uncompressed': 0, 'unchanged': 0}
+        rawbytes = oldbytes = newbytes = 0
+        lastid = -1
+        start = time.time()
+        while True:
+            rows = [row for row in store.load_cypher_query(compressjson.batchquery, None,
+                    params={'lastid': lastid, 'batchsize': compressjson.batchsize})]
+            if not rows:
+                break
+            tx = None
+            for row in rows:
+                lastid = max(lastid, row.id)
+                counts['nodes'] += 1
+                storedjson = str(row.json)
+                rawjson = JSONMapNode.decode(storedjson)
+                newjson = JSONMapNode.encode(rawjson, threshold)
+                rawbytes += len(rawjson)
+                oldbytes += len(storedjson)
+                newbytes += len(newjson)
+                if newjson == storedjson:
+                    counts['unchanged'] += 1
+                    continue
+                counts['compressed' if JSONMapNode.iscompressed(newjson)
+                       else 'uncompressed'] += 1
+                if tx is None:
+                    tx = store.db.cypher.begin()
+                tx.append(compressjson.updatequery, {'id': row.id, 'json': newjson})
+            if tx is not None:
+                tx.commit()
+        print 'JSON nodes: %(nodes)d, compressed: %(compressed)d, ' \
+              'uncompressed: %(uncompressed)d, unchanged: %(unchanged)d' % counts
+        print 'JSON size:         %12d bytes' % rawbytes
+        print 'Stored size was:   %12d bytes' % oldbytes
+        print 'Stored size is:    %12d bytes (%.1f%% of JSON size)' \
+              % (newbytes, (100.0*newbytes/rawbytes if rawbytes else 100.0))
+        print 'Savings:           %12d bytes stored and transferred per full read' \
+              % (oldbytes - newbytes)
+        print >> sys.stderr, '%.2f seconds' % (time.time() - start)
+        return 0
+
+
 options = {'language':True, 'format':True, 'hostnames':False, 'ruleids': False}
 def usage():
     'Construct and print usage message'
@@ -338,8 +629,8 @@ def main(argv):
     ourstore = None
     executor_context = None
 
-    nodbcmds = {'genkeys', 'neo4jpass'}
-    rwcmds = {'loadqueries', 'loadbp'}
+    nodbcmds = {'genkeys', 'neo4jpass', 'monrulebench'}
+    rwcmds = {'loadqueries', 'loadbp', 'compressjson'}
     selected_options = {}
     narg = 0
     skipnext = False
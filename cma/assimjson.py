@@ -24,112 +24,335 @@
 #
 #
 '''
-File containing the JSONtree class
+File containing the JSONtree and JSONChunker classes
 '''
 
-import re
+import sys
 from AssimCclasses import pyConfigContext, pyNetAddr
 from store import Store
 
 # R0903: Too few public methods
 # pylint: disable=R0903
 class JSONtree(object):
-    "Class to convert things to JSON strings - that's about all"
-    REESC = re.compile('\\\\')
-    REQUOTE = re.compile('"')
+    """Class to convert things to JSON strings - that's about all.
+    We build our output as a list of pieces and join them once at the end,
+    rather than repeatedly concatenating (and copying) ever-larger strings.
+    """
+    # (character, replacement) - backslash must come first
+    ESCAPES = (('\\', '\\\\'), ('"', '\\"'))
+    # Things _iterencode() leaves to _encode() as a single piece
+    SCALARTYPES = (str, unicode, bool, int, long, float, pyNetAddr, pyConfigContext)
     filterprefixes = ['_', 'JSON__hash__']
 
     def __init__(self, tree, expandJSON=False, maxJSON=0, filterprefixes=None):
         self.filterprefixes = filterprefixes if filterprefixes is not None \
             else JSONtree.filterprefixes
+        # str.startswith() accepts a tuple - which checks them all in one call
+        self._filtertuple = tuple(self.filterprefixes)
         self.tree = tree
         self.expandJSON = expandJSON
         self.maxJSON = maxJSON
 
     def __str__(self):
         'Convert our internal tree to JSON.'
-        return self._jsonstr(self.tree)
+        out = []
+        self._encode(self.tree, out.append)
+        return ''.join(out)
+
+    def write(self, emit):
+        'Convert our internal tree to JSON - passing it to emit() a piece at a time'
+        self._encode(self.tree, emit)
+
+    def iterpieces(self):
+        '''Convert our internal tree to JSON - yielding it a piece at a time.
+        Unlike write(), our caller gets control back after every piece, so it can pass
+        the pieces along as it goes, no matter how big the tree is.'''
+        return self._iterencode(self.tree)
 
     @staticmethod
     def _jsonesc(stringthing):
         'Escape this string according to JSON string escaping rules'
-        stringthing = JSONtree.REESC.sub('\\\\\\\\', stringthing)
-        stringthing = JSONtree.REQUOTE.sub('\\\\"', stringthing)
+        for (char, replacement) in JSONtree.ESCAPES:
+            if char in stringthing:
+                stringthing = stringthing.replace(char, replacement)
         return stringthing
 
     # R0911 is too many return statements
-    # pylint: disable=R0911
-    def _jsonstr(self, thing):
-        'Recursively convert ("pickle") this thing to JSON'
+    # R0912 is too many branches
+    # pylint: disable=R0911,R0912
+    def _encode(self, thing, emit):
+        'Recursively convert ("pickle") this thing to JSON - passing each piece to emit()'
+        thingtype = type(thing)
+        # The common cases first - by exact type
+        if thingtype is str:
+            emit('"%s"' % JSONtree._jsonesc(thing))
+            return
+        if thingtype is bool:
+            emit('true' if thing else 'false')
+            return
+        if thingtype is int or thingtype is long or thingtype is float:
+            emit(str(thing))
+            return
+        if thing is None:
+            emit('null')
+            return
 
         if isinstance(thing, (list, tuple)):
-            ret = ''
             comma = '['
-            if len(thing) == 0:
-                ret += '['
             for item in thing:
-                ret += '%s%s' % (comma, self._jsonstr(item))
+                emit(comma)
+                self._encode(item, emit)
                 comma = ','
-            ret += ']'
-            return ret
+            emit(']' if comma == ',' else '[]')
+            return
 
         if isinstance(thing, dict):
-            ret = '{'
             comma = ''
+            emit('{')
             for key in thing.keys():
-                value = thing[key]
-                ret += '%s"%s":%s' % (comma, JSONtree._jsonesc(key), self._jsonstr(value))
+                emit('%s"%s":' % (comma, JSONtree._jsonesc(key)))
+                self._encode(thing[key], emit)
                 comma = ','
-            ret += '}'
-            return ret
+            emit('}')
+            return
 
         if isinstance(thing, pyNetAddr):
-            return '"%s"' % (str(thing))
+            emit('"%s"' % (str(thing)))
+            return
 
         if isinstance(thing, bool):
-            if thing:
-                return 'true'
-            return 'false'
+            emit('true' if thing else 'false')
+            return
 
         if isinstance(thing, (int, long, float, pyConfigContext)):
-            return str(thing)
+            emit(str(thing))
+            return
 
-        if isinstance(thing, unicode) or isinstance(thing, pyNetAddr):
-            return '"%s"' % (JSONtree._jsonesc(str(thing)))
+        if isinstance(thing, unicode):
+            emit('"%s"' % (JSONtree._jsonesc(str(thing))))
+            return
 
         if isinstance(thing, str):
-            return '"%s"' % (JSONtree._jsonesc(thing))
-
-        if thing is None:
-            return 'null'
+            emit('"%s"' % (JSONtree._jsonesc(thing)))
+            return
 
-        return self._jsonstr_other(thing)
+        self._encode_other(thing, emit)
 
-    def _jsonstr_other(self, thing):
+    def _encode_other(self, thing, emit):
         'Do our best to make JSON out of a "normal" python object - the final "other" case'
-        ret = '{'
-        comma = ''
-        attrs = thing.__dict__.keys()
-        attrs.sort()
-        if Store.has_node(thing) and Store.id(thing) is not None:
-            ret += '"_id": %s' %  str(Store.id(thing))
+        comma = '{'
+        for (label, value) in self._other_members(thing):
+            emit(comma + label)
+            self._encode(value, emit)
             comma = ','
-        for attr in attrs:
-            skip = False
-            for prefix in self.filterprefixes:
-                if attr.startswith(prefix):
-                    skip = True
-                    continue
-            if skip:
+        emit('}' if comma == ',' else '{}')
+
+    def _other_members(self, thing):
+        '''Yield (JSON label, value) for each member of a "normal" python object that we
+        return - starting with its node id (if it has one)'''
+        if Store.has_node(thing):
+            nodeid = Store.id(thing)
+            if nodeid is not None:
+                yield ('"_id": ', nodeid)
+        filtertuple = self._filtertuple
+        for attr in sorted(thing.__dict__.keys()):
+            if filtertuple and attr.startswith(filtertuple):
                 continue
             value = getattr(thing, attr)
-            if self.maxJSON > 0 and attr.startswith('JSON_') and len(value) > self.maxJSON:
-                continue
-            if self.expandJSON and attr.startswith('JSON_') and value.startswith('{'):
-                js = pyConfigContext(value)
-                if js is not None:
-                    value = js
-            ret += '%s"%s":%s' % (comma, attr, self._jsonstr(value))
+            if attr.startswith('JSON_'):
+                if self.maxJSON > 0 and len(value) > self.maxJSON:
+                    continue
+                if self.expandJSON and value.startswith('{'):
+                    js = pyConfigContext(value)
+                    if js is not None:
+                        value = js
+            yield ('"%s":' % attr, value)
+
+    def _iterencode(self, thing):
+        '''Generator version of _encode() - lists, dicts and objects are encoded lazily,
+        a member at a time.  Everything else is a single piece from _encode().'''
+        if isinstance(thing, (list, tuple)):
+            comma = '['
+            for item in thing:
+                yield comma
+                for piece in self._iterencode(item):
+                    yield piece
+                comma = ','
+            yield ']' if comma == ',' else '[]'
+            return
+        if isinstance(thing, dict):
+            comma = ''
+            yield '{'
+            for key in thing.keys():
+                yield '%s"%s":' % (comma, JSONtree._jsonesc(key))
+                for piece in self._iterencode(thing[key]):
+                    yield piece
+                comma = ','
+            yield '}'
+            return
+        if thing is None or isinstance(thing, JSONtree.SCALARTYPES):
+            pieces = []
+            self._encode(thing, pieces.append)
+            for piece in pieces:
+                yield piece
+            return
+        comma = '{'
+        for (label, value) in self._other_members(thing):
+            yield comma + label
+            for piece in self._iterencode(value):
+                yield piece
             comma = ','
-        ret += '}'
-        return ret
+        yield '}' if comma == ',' else '{}'
+
+class JSONChunker(object):
+    '''Collects pieces of output (JSON or otherwise) and passes them on to a sink in chunks
+    of about 'chunksize' bytes.  The sink is any callable taking a string - like the write
+    method of a file, or the sendall method of a socket.
+    We never hold much more than 'chunksize' bytes at a time.
+    '''
+    DEFAULT_CHUNKSIZE = 64*1024
+
+    def __init__(self, sink, chunksize=None):
+        'Initialize our JSONChunker'
+        self.sink = sink
+        self.chunksize = chunksize if chunksize is not None else JSONChunker.DEFAULT_CHUNKSIZE
+        self.pieces = []
+        self.size = 0
+
+    def emit(self, piece):
+        'Add this piece to our output - passing it on to our sink when we have enough'
+        self.pieces.append(piece)
+        self.size += len(piece)
+        if self.size >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        'Pass everything we have on to our sink'
+        if self.pieces:
+            self.sink(''.join(self.pieces))
+            self.pieces = []
+            self.size = 0
+
+if __name__ == '__main__':
+    # pylint: disable=C0413
+    import re, timeit
+    class LegacyJSONtree(JSONtree):
+        'The original string-concatenating JSONtree - kept here as a benchmark baseline'
+        REESC = re.compile('\\\\')
+        REQUOTE = re.compile('"')
+
+        def __str__(self):
+            return self._jsonstr(self.tree)
+
+        @staticmethod
+        def _jsonesc(stringthing):
+            'Escape this string according to JSON string escaping rules'
+            stringthing = LegacyJSONtree.REESC.sub('\\\\\\\\', stringthing)
+            stringthing = LegacyJSONtree.REQUOTE.sub('\\\\"', stringthing)
+            return stringthing
+
+        def _jsonstr(self, thing):
+            'Recursively convert ("pickle") this thing to JSON'
+            if isinstance(thing, (list, tuple)):
+                ret = ''
+                comma = '['
+                if len(thing) == 0:
+                    ret += '['
+                for item in thing:
+                    ret += '%s%s' % (comma, self._jsonstr(item))
+                    comma = ','
+                ret += ']'
+                return ret
+            if isinstance(thing, dict):
+                ret = '{'
+                comma = ''
+                for key in thing.keys():
+                    value = thing[key]
+                    ret += '%s"%s":%s' % (comma, LegacyJSONtree._jsonesc(key),
+                                          self._jsonstr(value))
+                    comma = ','
+                ret += '}'
+                return ret
+            if isinstance(thing, pyNetAddr):
+                return '"%s"' % (str(thing))
+            if isinstance(thing, bool):
+                return 'true' if thing else 'false'
+            if isinstance(thing, (int, long, float, pyConfigContext)):
+                return str(thing)
+            if isinstance(thing, unicode):
+                return '"%s"' % (LegacyJSONtree._jsonesc(str(thing)))
+            if isinstance(thing, str):
+                return '"%s"' % (LegacyJSONtree._jsonesc(thing))
+            if thing is None:
+                return 'null'
+            return self._jsonstr_other(thing)
+
+        def _jsonstr_other(self, thing):
+            'Make JSON out of a "normal" python object'
+            ret = '{'
+            comma = ''
+            attrs = thing.__dict__.keys()
+            attrs.sort()
+            if Store.has_node(thing) and Store.id(thing) is not None:
+                ret += '"_id": %s' %  str(Store.id(thing))
+                comma = ','
+            for attr in attrs:
+                skip = False
+                for prefix in self.filterprefixes:
+                    if attr.startswith(prefix):
+                        skip = True
+                        continue
+                if skip:
+                    continue
+                value = getattr(thing, attr)
+                if self.maxJSON > 0 and attr.startswith('JSON_') and len(value) > self.maxJSON:
+                    continue
+                if self.expandJSON and attr.startswith('JSON_') and value.startswith('{'):
+                    js = pyConfigContext(value)
+                    if js is not None:
+                        value = js
+                ret += '%s"%s":%s' % (comma, attr, self._jsonstr(value))
+                comma = ','
+            ret += '}'
+            return ret
+
+    class FakeDrone(object):
+        'Something with the attributes of a typical Drone'
+        def __init__(self, hostnum):
+            self.designation = 'server%04d.example.com' % hostnum
+            self.domain = 'global'
+            self.nodetype = 'Drone'
+            self.status = 'up'
+            self.reason = 'HBSTART'
+            self.roles = ['host', 'drone', 'server'] if hostnum % 3 else ['host', 'drone']
+            self.port = 1984
+            self.monitors_activated = True
+            self.hostmonitors_activated = hostnum % 2 == 0
+            self.time_status_ms = 1476800000000 + hostnum
+            self.time_status_iso8601 = '2016-10-18 14:%02d:00' % (hostnum % 60)
+            self.bp_category_security_score = hostnum * 1.5
+            self.JSON__hash__os = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+            self.JSON_comment = 'He said "C:\\Temp" was fine'
+            self._private = 'not to be seen'
+
+    testdrones = [FakeDrone(j) for j in range(200)]
+    testrows = [{'drone': testdrones[j], 'ipaddr': '10.10.%d.%d' % (j/250, j%250),
+                 'packages': {'openssh-server': '1:7.2p2-4ubuntu2.1', 'bash': '4.3-14ubuntu1.1',
+                              'some"quoted\\thing': None},
+                 'ports': [22, 80, 443], 'empty': [], 'up': j % 5 != 0}
+                for j in range(len(testdrones))]
+    for testobj in testdrones + testrows + [[], {}, (1, 'x'), u'unicode', None, 3L, 2.5]:
+        assert str(JSONtree(testobj)) == str(LegacyJSONtree(testobj)), str(JSONtree(testobj))
+        assert ''.join(JSONtree(testobj).iterpieces()) == str(JSONtree(testobj))
+    for testname, testcls in (('JSONtree', JSONtree), ('legacy JSONtree', LegacyJSONtree)):
+        for testset, testobjs in (('Drones', testdrones), ('query rows', testrows)):
+            elapsed = min(timeit.repeat(lambda: [str(testcls(obj)) for obj in testobjs],
+                                        repeat=5, number=20))
+            print >> sys.stderr, '%-16s %-11s %8.1f microseconds/object' % (
+                testname, testset, elapsed * 1000000.0 / (20 * len(testobjs)))
+    testchunks = []
+    testchunker = JSONChunker(testchunks.append, chunksize=1000)
+    JSONtree(testrows).write(testchunker.emit)
+    testchunker.flush()
+    assert ''.join(testchunks) == str(JSONtree(testrows))
+    assert max([len(chunk) for chunk in testchunks[:-1]]) < 2000
@@ -31,10 +31,10 @@
 This module defines some classes related to evaluating best practices based
 on discovery information
 '''
-import os, logging, sys
+import os, logging, sys, hashlib
 from droneinfo import Drone
 from consts import CMAconsts
-from graphnodes import BPRules, BPRuleSet
+from graphnodes import BPRules, BPRuleSet, BPRuleIndex
 from systemnode import SystemNode
 from discoverylistener import DiscoveryListener
 from graphnodeexpression import GraphNodeExpression, ExpressionContext
@@ -43,6 +43,165 @@ from store import Store
 from assimevent import AssimEvent
 from assimeventobserver import AssimEventObserver
 
+class BPRuleStatuses(object):
+    '''Compact encoding of the per-drone best practice rule statuses for one ruleset.
+
+    Rule ids are sorted to give each rule a fixed index, and we store one status
+    character per rule index, prefixed by a version hash of that index:
+        v1:<version>:PFNN-P...
+    Looking up the previous status of a rule is then just a string index, and
+    two evaluations which came out the same compare equal as strings.
+    If the ruleset changes, the version changes.  We remember the rule ids for each
+    version (in memory and as BPRuleIndex nodes), so statuses encoded for an older
+    ruleset can be remapped by rule id.  Only rules we have never evaluated read as unknown.
+    '''
+    FORMAT = 'v1'
+    UNKNOWN = '-'
+    STATUSCHARS = {'pass': 'P', 'fail': 'F', 'ignore': 'I', 'NA': 'N'}
+    CHARSTATUS = {'P': 'pass', 'F': 'fail', 'I': 'ignore', 'N': 'NA'}
+    knownversions = {}  # version => sorted list of rule ids
+    savedversions = set()   # versions we know have a BPRuleIndex in the database
+
+    def __init__(self, rulesobj):
+        'Build the rule index for this set of rules'
+        if hasattr(rulesobj, '_jsonobj'):
+            rulesobj = getattr(rulesobj, '_jsonobj')
+        self.ruleids = sorted(rulesobj.keys())
+        self.index = dict((ruleid, j) for j, ruleid in enumerate(self.ruleids))
+        self.version = hashlib.sha1('\n'.join(self.ruleids)).hexdigest()[:8]
+        if self.version not in BPRuleStatuses.knownversions:
+            BPRuleStatuses.knownversions[self.version] = self.ruleids
+
+    def remember(self, store):
+        'Make sure the database knows which rule ids go with our version'
+        if self.version in BPRuleStatuses.savedversions:
+            return
+        store.load_or_create(BPRuleIndex, version=self.version, ruleids=self.ruleids)
+        BPRuleStatuses.savedversions.add(self.version)
+
+    @staticmethod
+    def version_ruleids(version, store=None):
+        'Return the rule ids which go with this version - or None if we have no idea'
+        ruleids = BPRuleStatuses.knownversions.get(version)
+        if ruleids is None and store is not None:
+            ruleindex = store.load(BPRuleIndex, version=version)
+            if ruleindex is not None:
+                ruleids = [str(ruleid) for ruleid in ruleindex.ruleids]
+                BPRuleStatuses.knownversions[version] = ruleids
+                BPRuleStatuses.savedversions.add(version)
+        return ruleids
+
+    def statuschars(self, results):
+        'Convert a dict of status lists into our one-character-per-rule form'
+        chars = [BPRuleStatuses.UNKNOWN] * len(self.ruleids)
+        for stat in BPRuleStatuses.STATUSCHARS:
+            if stat not in results:
+                continue
+            statchar = BPRuleStatuses.STATUSCHARS[stat]
+            for ruleid in results[stat]:
+                if ruleid in self.index:
+                    chars[self.index[ruleid]] = statchar
+        return ''.join(chars)
+
+    def encode(self, chars):
+        'Return the string we store in the drone for these status characters'
+        return '%s:%s:%s' % (BPRuleStatuses.FORMAT, self.version, chars)
+
+    def decode(self, encoded, store=None):
+        '''Return the status characters for a stored status string.
+        We also understand the older JSON status lists, and statuses encoded for other
+        versions of our rules (if we or 'store' know their rule ids).
+        Anything we can't map onto our rule index comes back as UNKNOWN.
+        '''
+        unknown = BPRuleStatuses.UNKNOWN * len(self.ruleids)
+        if encoded is None:
+            return unknown
+        encoded = str(encoded)
+        if encoded.startswith('{'):
+            return self.statuschars(pyConfigContext(encoded))
+        fields = encoded.split(':', 2)
+        if len(fields) != 3 or fields[0] != BPRuleStatuses.FORMAT:
+            return unknown
+        (_, version, oldchars) = fields
+        if version == self.version:
+            return oldchars if len(oldchars) == len(self.ruleids) else unknown
+        oldruleids = BPRuleStatuses.version_ruleids(version, store)
+        if oldruleids is None or len(oldruleids) != len(oldchars):
+            return unknown
+        # Remap the old statuses by rule id
+        chars = list(unknown)
+        for j in range(len(oldruleids)):
+            newindex = self.index.get(oldruleids[j])
+            if newindex is not None:
+                chars[newindex] = oldchars[j]
+        return ''.join(chars)
+
+    def statuses(self, chars):
+        'Convert status characters back into the dict of status lists'
+        results = {'pass': [], 'fail': [], 'ignore': [], 'NA': [], 'score': 0.0}
+        for j, statchar in enumerate(chars):
+            if statchar in BPRuleStatuses.CHARSTATUS:
+                results[BPRuleStatuses.CHARSTATUS[statchar]].append(self.ruleids[j])
+        return results
+
+class BPTracer(object):
+    '''Tracing for best practice rule evaluation - off by default.
+
+    Tracing can be turned on globally (by level), or for particular drones or rule ids
+    (at the RULES level).  When a trace isn't wanted we just count results, so nothing
+    gets formatted or written on the normal path.
+    Configured from the 'bp_trace' configuration item.
+    '''
+    OFF = 0         # Count only
+    SUMMARY = 1     # Per-evaluation header and score changes
+    RULES = 2       # Every rule result too
+    level = OFF
+    drones = set()
+    ruleids = set()
+    counters = {}
+
+    @staticmethod
+    def configure(level=None, drones=None, ruleids=None):
+        'Set our trace level and the drones and rule ids we trace'
+        if level is not None:
+            BPTracer.level = int(level)
+        if drones is not None:
+            BPTracer.drones = set([str(drone).lower() for drone in drones])
+        if ruleids is not None:
+            BPTracer.ruleids = set([str(ruleid) for ruleid in ruleids])
+
+    @staticmethod
+    def configure_from(config):
+        'Configure ourselves from the bp_trace section of our configuration (if any)'
+        if 'bp_trace' not in config:
+            return
+        traceconfig = config['bp_trace']
+        BPTracer.configure(level=traceconfig.get('level', BPTracer.OFF),
+                           drones=traceconfig.get('drones', []),
+                           ruleids=traceconfig.get('rules', []))
+
+    @staticmethod
+    def enabled(level, drone=None, ruleid=None):
+        'Return True if we should trace at this level for this drone and rule'
+        if BPTracer.level >= level:
+            return True
+        if drone is not None and BPTracer.drones:
+            # Drones are configured by designation - str(drone) is 'Drone(designation)'
+            designation = getattr(drone, 'designation', drone)
+            if str(designation).lower() in BPTracer.drones:
+                return True
+        return ruleid is not None and ruleid in BPTracer.ruleids
+
+    @staticmethod
+    def count(name):
+        'Count an event whether we trace it or not'
+        BPTracer.counters[name] = BPTracer.counters.get(name, 0) + 1
+
+    @staticmethod
+    def trace(fmt, *args):
+        'Write out a trace message - only called once we know tracing is enabled'
+        print >> sys.stderr, fmt % args
+
 class BestPractices(DiscoveryListener):
     'Base class for evaluating changes against best practices'
     prio = DiscoveryListener.PRI_OPTION
@@ -61,6 +220,7 @@ class BestPractices(DiscoveryListener):
         DiscoveryListener.__init__(self, config, packetio, store, log, debug)
         if self.__class__ != BestPractices:
             return
+        BPTracer.configure_from(config)
         for pkttype in config['allbpdiscoverytypes']:
             BestPractices.register_sensitivity(BestPracticesCMA, pkttype)
         for pkttype in BestPractices.eval_classes:
@@ -194,7 +354,7 @@ class BestPractices(DiscoveryListener):
             delim='&'
         return '%s/%s' % ((self.BASEURL % port), ret)
 
-    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged):
+    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged, _dispatch=None):
         '''Inform interested rule objects about this change'''
         if not discoverychanged:
             return
@@ -217,8 +377,7 @@ class BestPractices(DiscoveryListener):
             #print  >> sys.stderr, 'Fetching %s rules for %s' % (evaltype, drone)
             rulesobj = rule_obj.fetch_rules(drone, srcaddr, evaltype)
             #print >> sys.stderr, 'RULES ARE:', rulesobj
-            statuses = pyConfigContext(rule_obj.evaluate(drone, srcaddr,
-                                       jsonobj, rulesobj, evaltype))
+            statuses = rule_obj.evaluate(drone, srcaddr, jsonobj, rulesobj, evaltype)
             #print >> sys.stderr, 'RESULTS ARE:', statuses
             self.log_rule_results(statuses, drone, srcaddr, jsonobj, evaltype, rulesobj)
 
@@ -262,30 +421,33 @@ class BestPractices(DiscoveryListener):
     def log_rule_results(self, results, drone, _srcaddr, discoveryobj, discovertype, rulesobj):
         '''Log the results of this set of rule evaluations'''
         status_name = Drone.bp_discoverytype_result_attrname(discovertype)
-        if hasattr(drone, status_name):
-            oldstats = pyConfigContext(getattr(drone, status_name))
-        else:
-            oldstats = pyConfigContext({'pass': [], 'fail': [], 'ignore': [],
-                                        'NA': [], 'score': 0.0})
-        for stat in ('pass', 'fail', 'ignore', 'NA'):
+        statcodec = BPRuleStatuses(rulesobj)
+        newchars = statcodec.statuschars(results)
+        newencoded = statcodec.encode(newchars)
+        oldencoded = getattr(drone, status_name, None)
+        if oldencoded == newencoded:
+            # Nothing changed - no events, no score changes, nothing to update
+            return
+        oldchars = statcodec.decode(oldencoded, self.store)
+        for j, newchar in enumerate(newchars):
+            oldchar = oldchars[j]
+            if oldchar == newchar or newchar in (BPRuleStatuses.UNKNOWN, 'N'):
+                # No change
+                continue
+            stat = BPRuleStatuses.CHARSTATUS[newchar]
+            oldstat = BPRuleStatuses.CHARSTATUS.get(oldchar)
+            ruleid = statcodec.ruleids[j]
             logmethod = self.log.info if stat == 'pass' else self.log.warning
-            for ruleid in results[stat]:
-                oldstat = None
-                for statold in ('pass', 'fail', 'ignore', 'NA'):
-                    if ruleid in oldstats[statold]:
-                        oldstat = statold
-                        break
-                if oldstat == stat or stat == 'NA':
-                    # No change
-                    continue
-                url = self.url(drone, ruleid, rulesobj[ruleid])
-                BestPractices.send_rule_event(oldstat, stat, drone, ruleid, rulesobj, url)
-                thisrule = rulesobj[ruleid]
-                rulecategory = thisrule['category']
-                logmethod('%s %sED %s rule %s: %s [%s]' %
-                          (drone, stat.upper(), rulecategory, ruleid, url, thisrule['rule']))
-        self.compute_score_updates(discoveryobj, drone, rulesobj, results, oldstats)
-        setattr(drone, status_name, str(results))
+            url = self.url(drone, ruleid, rulesobj[ruleid])
+            BestPractices.send_rule_event(oldstat, stat, drone, ruleid, rulesobj, url)
+            thisrule = rulesobj[ruleid]
+            rulecategory = thisrule['category']
+            logmethod('%s %sED %s rule %s: %s [%s]' %
+                      (drone, stat.upper(), rulecategory, ruleid, url, thisrule['rule']))
+        self.compute_score_updates(discoveryobj, drone, rulesobj, results,
+                                   statcodec.statuses(oldchars))
+        statcodec.remember(self.store)
+        setattr(drone, status_name, newencoded)
 
     def compute_scores(self, drone, rulesobj, statuses):
         '''Compute the scores from this set of statuses - organized by category
@@ -296,7 +458,8 @@ class BestPractices(DiscoveryListener):
         rulescores = {}
         totalscore=0
         if isinstance(statuses, (str, unicode)):
-            statuses = pyConfigContext(statuses)
+            statcodec = BPRuleStatuses(rulesobj)
+            statuses = statcodec.statuses(statcodec.decode(statuses, self.store))
         for status in statuses:
             if status == 'score':
                 continue
@@ -367,7 +530,9 @@ class BestPractices(DiscoveryListener):
                 # we shouldn't have concurrency problems.
                 oldval = getattr(drone, catattr) if hasattr(drone, catattr) else 0.0
                 setattr(drone, catattr, oldval + diff)
-                print >> sys.stderr, 'Setting %s.%s to %d' % (drone, catattr, oldval+diff)
+                BPTracer.count('score_updates')
+                if BPTracer.enabled(BPTracer.SUMMARY, drone):
+                    BPTracer.trace('Setting %s.%s to %d', drone, catattr, oldval+diff)
                 AssimEvent(drone, eventtype, extrainfo=extrainfo)
         return newcatscores, diffs
 
@@ -380,7 +545,7 @@ class BestPractices(DiscoveryListener):
         raise NotImplementedError('class BestPractices is an abstract class')
 
     @staticmethod
-    def evaluate(_unused_drone, _unusedsrcaddr, wholejsonobj, ruleobj, description):
+    def evaluate(drone, _unusedsrcaddr, wholejsonobj, ruleobj, description):
         '''Evaluate our rules given the current/changed data.
         '''
         jsonobj = wholejsonobj['data']
@@ -393,35 +558,35 @@ class BestPractices(DiscoveryListener):
         statuses = {'pass': [], 'fail': [], 'ignore': [], 'NA': [], 'score': 0.0}
         if len(ruleids) < 1:
             return statuses
-        print >> sys.stderr, '\n==== Evaluating %d Best Practice rules on "%s" [%s]' \
-            % (len(ruleids)-1, wholejsonobj['description'], description)
+        BPTracer.count('evaluations')
+        if BPTracer.enabled(BPTracer.SUMMARY, drone):
+            BPTracer.trace('\n==== Evaluating %d Best Practice rules on "%s" [%s]',
+                           len(ruleids)-1, wholejsonobj['description'], description)
         for ruleid in ruleids:
             ruleinfo = ruleobj[ruleid]
             rule = ruleinfo['rule']
             rulecategory = ruleinfo['category']
             result = GraphNodeExpression.evaluate(rule, newcontext)
             if result is None:
-                print >> sys.stderr, 'n/a:    %s ID %s %s' \
-                    % (rulecategory, ruleid, rule)
-                statuses['NA'].append(ruleid)
+                status, tracefmt = 'NA', 'n/a:    %s ID %s %s'
             elif not isinstance(result, bool):
+                # Always worth knowing about - it's a broken rule
                 print >> sys.stderr, 'Rule id %s %s returned %s (%s)' \
                     % (ruleid, rule, result, type(result))
-                statuses['fail'].append(ruleid)
+                status, tracefmt = 'fail', None
             elif result:
                 if rule.startswith('IGNORE'):
-                    if not rulecategory.lower().startswith('comment'):
-                        statuses['ignore'].append(ruleid)
-                        print >> sys.stderr, 'IGNORE: %s ID %s %s' % \
-                            (rulecategory, ruleid, rule)
+                    if rulecategory.lower().startswith('comment'):
+                        continue
+                    status, tracefmt = 'ignore', 'IGNORE: %s ID %s %s'
                 else:
-                    statuses['pass'].append(ruleid)
-                    print >> sys.stderr, 'PASS:   %s ID %s %s' \
-                        % (rulecategory, ruleid, rule)
+                    status, tracefmt = 'pass', 'PASS:   %s ID %s %s'
             else:
-                print >> sys.stderr, 'FAIL:   %s ID %s %s'\
-                    % (rulecategory, ruleid, rule)
-                statuses['fail'].append(ruleid)
+                status, tracefmt = 'fail', 'FAIL:   %s ID %s %s'
+            statuses[status].append(ruleid)
+            BPTracer.count(status)
+            if tracefmt is not None and BPTracer.enabled(BPTracer.RULES, drone, ruleid):
+                BPTracer.trace(tracefmt, rulecategory, ruleid, rule)
         return statuses
 
 @BestPractices.register('proc_sys')
@@ -455,6 +620,9 @@ class BestPracticesCMA(BestPractices):
         if changedname in (None, 'allbpdiscoverytypes'):
             for pkttype in config['allbpdiscoverytypes']:
                 BestPractices.register_sensitivity(BestPracticesCMA, pkttype)
+        if changedname in (None, 'bp_trace'):
+            # Our listener objects are long-lived, so they won't pick this up by themselves
+            BPTracer.configure_from(config)
 
 if __name__ == '__main__':
     #import sys
@@ -553,6 +721,36 @@ if __name__ == '__main__':
         assert str(pyConfigContext(tstdiffs)) == '{"networking":-1.0,"security":-4.0}'
         assert dummydrone.bp_category_networking_score == 0.0   # should be OK for integer values
         assert dummydrone.bp_category_security_score == 0.0     # should be OK for integer values
+        # Compact status encoding - round trip, legacy JSON, and ruleset changes
+        testcodec = BPRuleStatuses(testrules)
+        tstchars = testcodec.statuschars(ourstats)
+        assert len(tstchars) == len(testrules)
+        tstencoded = testcodec.encode(tstchars)
+        assert testcodec.decode(tstencoded) == tstchars
+        assert testcodec.statuses(tstchars)['fail'] == ourstats['fail']
+        assert testcodec.decode(str(pyConfigContext(ourstats))) == tstchars
+        assert testcodec.decode(None) == BPRuleStatuses.UNKNOWN * len(testrules)
+        assert len(tstencoded) < len(str(pyConfigContext(ourstats)))
+        _, tstscores, _ = bpobj.compute_scores(dummydrone, testrules, tstencoded)
+        assert str(pyConfigContext(tstscores)) == '{"networking":1.0,"security":4.0}'
+        changedrules = pyConfigContext(str(testrules))
+        changedrules['zz-newrule'] = testrules['itbp-00001']
+        changedcodec = BPRuleStatuses(changedrules)
+        assert changedcodec.version != testcodec.version
+        # Old statuses get remapped by rule id - only the new rule is unknown
+        assert changedcodec.decode(tstencoded) == tstchars + BPRuleStatuses.UNKNOWN
+        assert changedcodec.decode('v1:00000000:PF') == BPRuleStatuses.UNKNOWN * len(changedrules)
+        # Tracing is off by default - but we still count what happened
+        assert BPTracer.level == BPTracer.OFF
+        assert not BPTracer.enabled(BPTracer.RULES, 'testdrone', 'itbp-00001')
+        assert BPTracer.counters['fail'] >= 3
+        BPTracer.configure(ruleids=['itbp-00001'])
+        assert BPTracer.enabled(BPTracer.RULES, 'testdrone', 'itbp-00001')
+        assert not BPTracer.enabled(BPTracer.RULES, 'testdrone', 'nist_V-38526')
+        BPTracer.configure(drones=['testdrone'], ruleids=[])
+        assert BPTracer.enabled(BPTracer.SUMMARY, 'testdrone')
+        assert not BPTracer.enabled(BPTracer.SUMMARY, 'otherdrone')
+        BPTracer.configure(drones=[])
     DebugEventObserver()
     atestrule = testrules['itbp-00001']
     # Create temporary rules for the send_rule_event tests
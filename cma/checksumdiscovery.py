@@ -39,8 +39,12 @@ than we asked for.
 
 If we ask for a file which doesn't exist (like bad JARs in the CLASSPATH),
 then those files won't show up in the results.
+
+We keep an in-memory index of everyone's checksums (ChecksumIndex), which lets us
+find changes by comparing dictionaries, and lets us notice when the same file has
+different checksums on different systems.
 '''
-import sys
+import sys, hashlib
 from systemnode import SystemNode
 from AssimCclasses import pyConfigContext
 from AssimCtypes import CONFIGNAME_TYPE, CONFIGNAME_INSTANCE
@@ -49,55 +53,161 @@ from cmaconfig import ConfigFile
 
 from discoverylistener import DiscoveryListener
 
+class ChecksumIndex(object):
+    '''Index of file checksums - per system, and across the whole fleet.
+    'systems' maps each system to its {filename: checksum} map.
+    'fleet' maps each filename to {checksum: set-of-systems} - so we can tell
+    when the same binary has different checksums on different systems.
+    Updating a system only touches the fleet index for files which changed.
+    '''
+    def __init__(self):
+        'Initialize our (empty) ChecksumIndex'
+        self.systems = {}
+        self.fleet = {}
+
+    def __contains__(self, designation):
+        'Return True if we know the checksums for this system'
+        return designation in self.systems
+
+    def update(self, designation, checksums):
+        '''Replace this system's checksums with 'checksums' ({filename: checksum}).
+        Return the changes as {filename: (oldchecksum, newchecksum)} - new files aren't
+        changes, and files we didn't hear about this time aren't either.
+        '''
+        designation = intern(str(designation))
+        old = self.systems.get(designation, {})
+        new = {}
+        changes = {}
+        for filename in checksums:
+            checksum = intern(str(checksums[filename]))
+            filename = intern(str(filename))
+            new[filename] = checksum
+            oldchecksum = old.get(filename)
+            if oldchecksum == checksum:
+                continue
+            if oldchecksum is not None:
+                changes[filename] = (oldchecksum, checksum)
+                self._forget(filename, oldchecksum, designation)
+            self.fleet.setdefault(filename, {}).setdefault(checksum, set()).add(designation)
+        for filename in old:
+            if filename not in new:
+                self._forget(filename, old[filename], designation)
+        self.systems[designation] = new
+        return changes
+
+    def _forget(self, filename, checksum, designation):
+        'Remove this system from the fleet index for this file and checksum'
+        checksums = self.fleet.get(filename, {})
+        systems = checksums.get(checksum)
+        if systems is None:
+            return
+        systems.discard(designation)
+        if not systems:
+            del checksums[checksum]
+            if not checksums:
+                del self.fleet[filename]
+
+    def forget_system(self, designation):
+        'Remove everything we know about this system'
+        for filename, checksum in self.systems.pop(designation, {}).items():
+            self._forget(filename, checksum, designation)
+
+    def mismatches(self, minsystems=2):
+        '''Yield (filename, {checksum: sorted-list-of-systems}) for each file which has
+        more than one checksum across at least 'minsystems' systems'''
+        for filename in sorted(self.fleet.keys()):
+            checksums = self.fleet[filename]
+            if len(checksums) < 2:
+                continue
+            if sum([len(systems) for systems in checksums.values()]) < minsystems:
+                continue
+            yield (filename, dict([(checksum, sorted(checksums[checksum]))
+                                   for checksum in checksums]))
+
+    def outliers(self, designation, filenames=None):
+        '''Return {filename: (our checksum, our count, total count)} for files where
+        this system's checksum is shared by fewer systems than some other checksum.'''
+        ours = self.systems.get(designation, {})
+        ret = {}
+        for filename in (ours.keys() if filenames is None else filenames):
+            if filename not in ours:
+                continue
+            checksums = self.fleet.get(filename, {})
+            ourcount = len(checksums.get(ours[filename], ()))
+            counts = [len(systems) for systems in checksums.values()]
+            if ourcount < max(counts):
+                ret[filename] = (ours[filename], ourcount, sum(counts))
+        return ret
+
 @SystemNode.add_json_processor
 class TCPDiscoveryChecksumGenerator(DiscoveryListener):
     'Class for generating checksums based on our tcpdiscovery packets'
     prio = DiscoveryListener.PRI_OPTION
     wantedpackets = ('tcpdiscovery', 'checksum')
+    index = ChecksumIndex()
+    stats = {'requests': 0, 'unchangedrequests': 0, 'warmed': 0, 'changes': 0}
+
+    @classmethod
+    def abort(cls):
+        '''The transaction was aborted - so our index may be ahead of the database.
+        Start over - each system is reloaded from the database when we next hear from it.'''
+        TCPDiscoveryChecksumGenerator.index = ChecksumIndex()
+
+    @staticmethod
+    def checksum_filelist(config, jsondata):
+        '''Return the sorted, duplicate-free list of files we want checksummed, given
+        our configuration and the data from a tcpdiscovery packet'''
+        filelist = set(config['checksum_files'])
+        filelist.update(config['checksum_cmds'])
+        for procname in jsondata.keys():    # List of of process names...
+            procinfo = jsondata[procname]   # (names assigned by the nanoprobe)
+            if 'exe' not in procinfo:
+                continue
+            exename = procinfo.get('exe')
+            filelist.add(exename)
+            if exename.endswith('/java'):
+                # Special case for some/many JAVA programs - find the jars...
+                if 'cmdline' not in procinfo:
+                    continue
+                cmdline = procinfo.get('cmdline')
+                for j in range(0, len(cmdline)):
+                    # The argument following -cp is the ':'-separated CLASSPATH
+                    if cmdline[j] == '-cp' and j < len(cmdline)-1:
+                        filelist.update(cmdline[j+1].split(':'))
+                        break
+        filelist.discard('')
+        return sorted(filelist)
 
-    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged):
+    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged, dispatch=None):
         '''Inform interested rule objects about this change'''
         if not discoverychanged:
             return
         if jsonobj['discovertype'] == 'tcpdiscovery':
-            self.processtcpdiscoverypkt(drone, srcaddr, jsonobj)
+            self.processtcpdiscoverypkt(drone, srcaddr, jsonobj, dispatch)
         elif jsonobj['discovertype'] == 'checksum':
             self.processchecksumpkt(drone, srcaddr, jsonobj)
         else:
             print >> sys.stderr, ('OOPS! bad packet type [%s]' %
                                   jsonobj['discovertype'])
 
-    def processtcpdiscoverypkt(self, drone, _unused_srcaddr, jsonobj):
+    def processtcpdiscoverypkt(self, drone, _unused_srcaddr, jsonobj, dispatch=None):
         "Send commands generating checksums for the Systems's net-facing things"
+        sumcmds = self.config['checksum_cmds']
+        # The data portion of the JSON message
+        data = self.get_dispatch(drone, jsonobj, dispatch).data()
+        filelist = self.checksum_filelist(self.config, data)
+        # Don't repeat a request the nanoprobe already has (until it restarts)
+        requesthash = hashlib.sha1('\n'.join(list(sumcmds) + filelist)).hexdigest()
+        if getattr(drone, 'checksum_request', '') == requesthash:
+            TCPDiscoveryChecksumGenerator.stats['unchangedrequests'] += 1
+            return
+        drone.checksum_request = requesthash
+        TCPDiscoveryChecksumGenerator.stats['requests'] += 1
         params = ConfigFile.agent_params(self.config, 'discovery', 'checksums',
                                          drone.designation)
-        sumcmds = self.config['checksum_cmds']
-        filelist = self.config['checksum_files']
-        filelist.extend(sumcmds)
         params['parameters'] = pyConfigContext()
         params[CONFIGNAME_TYPE] = 'checksums'
         params[CONFIGNAME_INSTANCE] = '_auto_checksumdiscovery'
-        data = jsonobj['data'] # The data portion of the JSON message
-        for procname in data.keys():    # List of of process names...
-            procinfo = data[procname]   # (names assigned by the nanoprobe)
-            if 'exe' not in procinfo:
-                continue
-            exename = procinfo.get('exe')
-            # dups (if any) are removed by the agent
-            filelist.append(exename)
-            if exename.endswith('/java'):
-                # Special case for some/many JAVA programs - find the jars...
-                if 'cmdline' not in procinfo:
-                    continue
-                cmdline = procinfo.get('cmdline')
-                for j in range(0, len(cmdline)):
-                    # The argument following -cp is the ':'-separated CLASSPATH
-                    if cmdline[j] == '-cp' and j < len(cmdline)-1:
-                        jars = cmdline[j+1].split(':')
-                        for jar in jars:
-                            filelist.append(jar)
-                        break
-
         params['parameters']['ASSIM_sumcmds'] = sumcmds
         params['parameters']['ASSIM_filelist'] = filelist
         # Request checksums of all the binaries talking (tcp) over the network
@@ -111,25 +221,36 @@ class TCPDiscoveryChecksumGenerator(DiscoveryListener):
         '''
         data = jsonobj['data'] # The data portion of the JSON message
         print >> sys.stderr, 'PROCESSING CHECKSUM DATA'
-        if ('checksums' in drone):
+        index = TCPDiscoveryChecksumGenerator.index
+        designation = drone.designation
+        hadchecksums = 'checksums' in drone
+        if hadchecksums and designation not in index:
+            # We haven't seen this system since we started - load its previous checksums
+            TCPDiscoveryChecksumGenerator.stats['warmed'] += 1
+            olddata = drone['checksums']['data']
+            index.update(designation, dict([(oldfile, olddata[oldfile])
+                                            for oldfile in olddata.keys()]))
+        newdata = dict([(newfile, data[newfile]) for newfile in data.keys()])
+        changes = index.update(designation, newdata)
+        if hadchecksums:
             print >> sys.stderr, 'COMPARING CHECKSUM DATA'
-            olddata = pyConfigContext(drone['checksums'])['data']
-            self.compare_checksums(drone, olddata, data)
+            self.report_changes(drone, changes)
+        outliers = index.outliers(designation,
+                                  newdata.keys() if not hadchecksums else changes.keys())
+        for filename in sorted(outliers.keys()):
+            (checksum, ourcount, total) = outliers[filename]
+            self.log.warning('On system %s: %s has checksum %s - shared by only %d of %d'
+                             ' systems'
+            %   (designation, filename, checksum, ourcount, total))
         print >> sys.stderr, 'UPDATING CHECKSUM DATA for %d files' % len(data)
 
-    def compare_checksums(self, drone, oldobj, newobj):
-        'Compare checksums and complain about those that change'
+    def report_changes(self, drone, changes):
+        'Complain about checksums that changed'
         designation = drone.designation
-        changes = {}
-        for oldfile in oldobj.keys():
-            if oldfile not in newobj:
-                continue
-            oldchecksum = oldobj[oldfile]
-            newchecksum = newobj[oldfile]
-            if oldchecksum == newchecksum:
-                continue
+        for filename in sorted(changes.keys()):
+            (oldchecksum, newchecksum) = changes[filename]
             self.log.warning('On system %s: %s had checksum %s which is now %s'
-            %   (designation, oldfile, oldchecksum, newchecksum))
-            changes[oldfile] = (oldchecksum, newchecksum)
+            %   (designation, filename, oldchecksum, newchecksum))
+        TCPDiscoveryChecksumGenerator.stats['changes'] += len(changes)
         extrainfo = {'CHANGETYPE': 'checksums', 'changes': changes}
         AssimEvent(drone, AssimEvent.OBJUPDATE, extrainfo=extrainfo)
@@ -247,7 +247,8 @@ def main():
     from packetlistener import PacketListener
     from messagedispatcher import MessageDispatcher
     from dispatchtarget import DispatchTarget
-    from monitoring import MonitoringRule
+    from monitoring import MonitoringRule, MonitorAction
+    from graphnodes import JSONMapNode
     from AssimCclasses import pyNetAddr, pySignFrame, pyReliableUDP, \
          pyPacketDecoder
     from AssimCtypes import CONFIGNAME_CMAINIT, CONFIGNAME_CMAADDR, CONFIGNAME_CMADISCOVER, \
@@ -373,7 +374,7 @@ def main():
     # Important to note that we don't want PacketListener to create its own 'io' object
     # or it will screw up the ReliableUDP protocol...
     listener = PacketListener(config, disp, io=io)
-    mandatory_modules = [ 'discoverylistener' ]
+    mandatory_modules = [ 'discoverylistener', 'packagediscovery' ]
     for mandatory in mandatory_modules:
         importlib.import_module(mandatory)
     #pylint is confused here...
@@ -403,6 +404,11 @@ def main():
         # This module *ought* to be optional.
         # that would involve adding some Drone callbacks for creation of new Drones
         BestPractices(config, io, CMAdb.store, CMAdb.log, opt.debug)
+        if 'json_compress_threshold' in config:
+            JSONMapNode.compressthreshold = int(config['json_compress_threshold'])
+        # Monitoring results come in constantly - look up their MonitorActions in memory
+        CMAdb.log.info('Loaded %d MonitorActions into the monitor name index'
+        %   MonitorAction.load_nameindex())
         listener.listen()
     return 0
 
@@ -120,6 +120,12 @@ class ConfigFile(object):
         },
         'bprulesbydomain': {str: str},  # Which best practice rule sets to use by default?
         'allbpdiscoverytypes': [str],   # List of all best practice discovery types
+        'bp_trace': {                   # Best practice evaluation tracing
+            'level':    {int,long},     # 0: off, 1: summaries, 2: every rule result
+            'drones':   [str],          # Drones to trace every rule result for
+            'rules':    [str],          # Rule ids to trace results for
+        },
+        'json_compress_threshold': {int, long}, # Store JSON this long compressed (0: never)
         'checksum_cmds': [str],         # Ordered List of checksum commands to use
         'checksum_files': [str],        # Files to always perform the checksum of
         'permission_files': [str],      # Files to always check the permissions of
@@ -278,6 +284,10 @@ class ConfigFile(object):
             # List of all the known best practice discovery types
             'allbpdiscoverytypes': ['auditd_conf', 'auditd_fileattrs', 'fileattrs',
                                     'login_defs', 'pam', 'proc_sys', 'sshd'],
+            # Best practice evaluation tracing - off by default
+            'bp_trace': {'level': 0, 'drones': [], 'rules': []},
+            # JSON discovery data at least this long is stored compressed (0: never)
+            'json_compress_threshold': 16384,
             # Prioritized list of checksum commands to use
             # we use the first one that's installed.
             'checksum_cmds': [
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+'''
+This module evaluates a GraphNodeExpression rule across a whole table of systems at once.
+It's intended for fleet-wide "what-if" questions like "which hosts would fail if we
+tightened this sshd rule?".
+
+Each $name referenced by a rule becomes a column with one value per system.
+The simple functions (EQ, IN, match, AND, OR and friends) are applied a column at a time,
+and because discovery data is very repetitive across a fleet, each function is only
+computed once for each distinct combination of argument values.
+Anything else falls back to the normal scalar evaluator one row at a time.
+'''
+
+import sys
+from graphnodeexpression import GraphNodeExpression, ExpressionContext
+
+class ColumnarTable(object):
+    '''A table of discovery data - one row per system.
+    Columns are built on demand the first time a rule references them.
+    '''
+    def __init__(self, rownames, rowobjs):
+        'Initialize our table from a list of row names and discovery data objects'
+        if len(rownames) != len(rowobjs):
+            raise ValueError('Row name count (%d) != row count (%d)'
+            %   (len(rownames), len(rowobjs)))
+        self.rownames = list(rownames)
+        self.rowobjs = list(rowobjs)
+        self.contexts = [None] * len(self.rowobjs)
+        self.columns = {}
+
+    def __len__(self):
+        'Return the number of rows in our table'
+        return len(self.rowobjs)
+
+    def context(self, rownum):
+        'Return the ExpressionContext for the given row'
+        ret = self.contexts[rownum]
+        if ret is None:
+            ret = ExpressionContext((self.rowobjs[rownum],))
+            self.contexts[rownum] = ret
+        return ret
+
+    def column(self, name):
+        'Return the list of values for the given (possibly dotted) name'
+        if name not in self.columns:
+            self.columns[name] = [self.context(j).get(name, None) for j in range(len(self))]
+        return self.columns[name]
+
+class ColumnarRuleEvaluator(object):
+    '''Evaluate GraphNodeExpression rules across every row of a ColumnarTable.
+    We return a list of values - the same values the scalar evaluator would
+    return for each row.
+    '''
+    # These functions don't use their context, so their value depends only on their arguments
+    CONTEXTFREE_FUNCTIONS = {'EQ', 'NE', 'LT', 'GT', 'LE', 'GE', 'IN', 'NOTIN', 'NOT', 'match',
+                             'MUST', 'NONEOK', 'IGNORE'}
+    # These re-evaluate string arguments - which only needs a context for $names and calls
+    STRINGEVAL_FUNCTIONS = {'AND', 'OR'}
+
+    def __init__(self, table):
+        'Initialize our ColumnarRuleEvaluator'
+        self.table = table
+        self.stats = {'column': 0, 'scalar': 0, 'computed': 0, 'reused': 0}
+
+    def evaluate(self, expression):
+        'Evaluate the expression for every row in our table - returning a list of values'
+        if not isinstance(expression, (str, unicode)):
+            return [expression] * len(self.table)
+        expression = str(expression.strip())
+        if expression.find('(') >= 0:
+            return self._functioncall(expression)
+        if expression.startswith('$'):
+            return self.table.column(expression[1:])
+        # A constant - the scalar evaluator knows how to interpret those...
+        return [GraphNodeExpression.evaluate(expression, ExpressionContext(()))] * len(self.table)
+
+    def _functioncall(self, expression):
+        'Evaluate a function call a column at a time if we can, a row at a time if not'
+        funname, argstrings = ColumnarRuleEvaluator._split_functioncall(expression)
+        if funname is None or (funname not in self.CONTEXTFREE_FUNCTIONS
+                               and funname not in self.STRINGEVAL_FUNCTIONS):
+            return self._scalar(expression)
+        argvectors = []
+        for (argstring, quoted) in argstrings:
+            if quoted:
+                argvectors.append([argstring] * len(self.table))
+            else:
+                argvectors.append(self.evaluate(argstring))
+        self.stats['column'] += 1
+        return self._apply(funname, argvectors)
+
+    def _apply(self, funname, argvectors):
+        'Apply this function to our argument columns - once per distinct set of arguments'
+        function = GraphNodeExpression.functions[funname]
+        needscontext = funname in self.STRINGEVAL_FUNCTIONS
+        computed = {}
+        results = []
+        for rownum in range(len(self.table)):
+            args = tuple([vector[rownum] for vector in argvectors])
+            if needscontext and ColumnarRuleEvaluator._has_contextual_string(args):
+                results.append(function(args, self.table.context(rownum)))
+                continue
+            try:
+                memokey = ColumnarRuleEvaluator._memokey(args)
+                value = computed[memokey]
+                self.stats['reused'] += 1
+            except KeyError:
+                value = function(args, None)
+                computed[memokey] = value
+                self.stats['computed'] += 1
+            except TypeError:
+                # Unhashable arguments (lists, maps) - just compute it
+                value = function(args, self.table.context(rownum))
+                self.stats['computed'] += 1
+            results.append(value)
+        return results
+
+    def _scalar(self, expression):
+        'Evaluate this expression one row at a time with the normal evaluator'
+        self.stats['scalar'] += 1
+        return [GraphNodeExpression.evaluate(expression, self.table.context(rownum))
+                for rownum in range(len(self.table))]
+
+    @staticmethod
+    def _memokey(args):
+        '''Return the key for remembering the value of a function with these arguments.
+        True == 1 == 1.0 (and they hash the same), but EQ() and friends treat them
+        differently - so our key includes the type of each argument.'''
+        return tuple([(type(arg), ColumnarRuleEvaluator._memokey(arg) if type(arg) is tuple
+                       else arg) for arg in args])
+
+    @staticmethod
+    def _has_contextual_string(args):
+        'Return True if any of these arguments would need a context to re-evaluate'
+        for arg in args:
+            if isinstance(arg, (str, unicode)) and (arg.strip().startswith('$')
+                                                    or arg.find('(') >= 0):
+                return True
+        return False
+
+    @staticmethod
+    def _split_functioncall(expression):
+        '''Split a function call into its name and a list of (argument-string, quoted) tuples
+        without evaluating anything.  This follows the same lexical rules as
+        GraphNodeExpression._compute_function_args().
+        We return (None, None) if we can't make sense of it.
+        '''
+        if not expression.endswith(')'):
+            return (None, None)
+        funname, arglist = expression[:-1].split('(', 1)
+        funname = funname.strip()
+        if funname.startswith('@'):
+            funname = funname[1:]
+        args = []
+        nestcount = 0
+        arg = ''
+        instring = False
+        prevwasquoted = False
+        for char in arglist.strip():
+            if instring:
+                if char == '"':
+                    instring = False
+                    prevwasquoted = True
+                else:
+                    arg += char
+            elif nestcount == 0 and char == '"':
+                instring = True
+            elif nestcount == 0 and char == ',':
+                if prevwasquoted:
+                    prevwasquoted = False
+                    args.append((arg, True))
+                else:
+                    arg = arg.strip()
+                    if arg == '':
+                        continue
+                    args.append((arg, False))
+                    arg = ''
+            elif char == '(':
+                nestcount += 1
+                arg += char
+            elif char == ')':
+                arg += char
+                nestcount -= 1
+                if nestcount < 0:
+                    return (None, None)
+                if nestcount == 0:
+                    args.append((arg if prevwasquoted else arg.strip(), prevwasquoted))
+                    arg = ''
+            else:
+                arg += char
+        if nestcount > 0 or instring:
+            return (None, None)
+        if arg != '':
+            args.append((arg, prevwasquoted))
+        return (funname, args)
+
+    @staticmethod
+    def rulestatus(rule, rulecategory, result):
+        '''Classify a rule result the same way BestPractices.evaluate() does.
+        Returns 'pass', 'fail', 'ignore', 'NA' or None (comment rules).'''
+        if result is None:
+            return 'NA'
+        if not isinstance(result, bool):
+            return 'fail'
+        if result:
+            if rule.strip().startswith('IGNORE'):
+                return None if rulecategory.lower().startswith('comment') else 'ignore'
+            return 'pass'
+        return 'fail'
+
+if __name__ == '__main__':
+    # pylint: disable=C0413
+    from AssimCclasses import pyConfigContext
+    testrows = []
+    for hostnum in range(200):
+        testrows.append(pyConfigContext({'PermitRootLogin': ('yes' if hostnum % 10 == 0 else 'no'),
+                                         'Protocol': (1 if hostnum % 50 == 0 else 2),
+                                         'Ciphers': {'aes128-ctr': True},
+                                         'MaxAuthTries': hostnum % 7}))
+    testtable = ColumnarTable(['host%d' % j for j in range(len(testrows))], testrows)
+    testevaluator = ColumnarRuleEvaluator(testtable)
+    for testrule in ('EQ($PermitRootLogin, no)',
+                     'AND(EQ($PermitRootLogin, no), EQ($Protocol, 2))',
+                     'OR(EQ($PermitRootLogin, "no"), IN($Protocol, 2, 3))',
+                     'NOT(match($PermitRootLogin, ^y))',
+                     'LE($MaxAuthTries, 4)',
+                     'EQ($nosuchthing, 4)',
+                     'EQ($Ciphers.aes128-ctr, true)',
+                     'IN($Protocol, 2)'):
+        columnresults = testevaluator.evaluate(testrule)
+        for testrownum in range(len(testrows)):
+            scalarresult = GraphNodeExpression.evaluate(testrule,
+                                                        ExpressionContext((testrows[testrownum],)))
+            assert columnresults[testrownum] == scalarresult, \
+                ('%s: row %d: %s != %s'
+                 % (testrule, testrownum, columnresults[testrownum], scalarresult))
+    assert testevaluator.stats['reused'] > testevaluator.stats['computed']
+    assert ColumnarRuleEvaluator.rulestatus('EQ(1,1)', 'security', None) == 'NA'
+    assert ColumnarRuleEvaluator.rulestatus('IGNORE(x)', 'comment', True) is None
+    print >> sys.stderr, 'All tests passed.', testevaluator.stats
@@ -55,7 +55,9 @@ class CMAconsts(object):
     NODE_monitoraction  = 'MonitorAction' # A (hopefully active) monitoring action
     NODE_bprules        = 'BPRules'       # Best practices rules
     NODE_bpruleset      = 'BPRuleSet'     # A set of best practice rules
+    NODE_bpruleindex    = 'BPRuleIndex'   # Rule ids for a version of a set of rules
     NODE_jsonmap        = 'JSONMapNode'   # JSON map object stored as a string
+    NODE_package        = 'PackageNode'   # An installed package (name and type)
     NODE_childsystem    = 'ChildSystem'   # A VM or container system
     NODE_vagrantsystem  = 'VagrantSystem' # A child Vagrant VM system
     NODE_dockersystem   = 'DockerSystem'  # A child Docker container
@@ -78,6 +80,7 @@ class CMAconsts(object):
     REL_basis       = 'basis'       # NODE_BPRules      ->  NODE_BPRules
     REL_bprulefor   = 'ruledbybp'   # NODE_drone        ->  NODE_BPRules
     REL_jsonattr    = 'jsonattr'    # NODE_system       ->  NODE_jsonmap
+    REL_haspackage  = 'haspackage'  # NODE_system       ->  NODE_package (has 'version')
     REL_parentsys   = 'parentsys'   # NODE_ChildSystem  ->  NODE_system
     REL_oneringnext = 'RingNext_The_One_Ring'   # NODE_drone  ->  NODE_Drone
     REL_onering     = 'RingMember_The_One_Ring'   # NODE_drone  ->  NODE_ring
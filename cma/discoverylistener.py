@@ -31,13 +31,15 @@ discovery packets as they arrive.
 
 More details are documented in the DiscoveryListener class
 '''
-import re, sys, os
+import re, os, threading
 from droneinfo import Drone
 from consts import CMAconsts
 from store import Store
 from AssimCtypes import CONFIGNAME_TYPE, CONFIGNAME_INSTANCE
 from AssimCclasses import pyNetAddr, pyConfigContext
-from systemnode import ChildSystem
+from systemnode import ChildSystem, DiscoveryDispatch
+from monitoring import MonitoringRule
+from reconcile import OwnedSubgraph
 
 from graphnodes import NICNode, IPaddrNode, ProcessNode, IPtcpportNode, GraphNode
 
@@ -54,6 +56,10 @@ class DiscoveryListener(object):
 
     prio = PRI_CONTRIB
     wantedpackets = None
+    # Listener objects are long-lived - one per class, reused for every packet.
+    # Unless a class says it's thread safe, only one thread may be in its processpkt() at once.
+    # Per-packet state belongs in the DiscoveryDispatch passed to processpkt(), not in 'self'.
+    threadsafe = False
 
     def __init__(self, config, packetio, store, log, debug):
         'Init function for DiscoveryListener'
@@ -62,6 +68,7 @@ class DiscoveryListener(object):
         self.log = log
         self.debug = debug
         self.config = config
+        self.lock = threading.Lock()
 
     @classmethod
     def priority(cls):
@@ -73,10 +80,23 @@ class DiscoveryListener(object):
         'Return the set of packets we want to be called for'
         return cls.wantedpackets
 
-    def processpkt(self, drone, srcaddr, json, discoverychanged):
-        'A desired packet has been received - process it'
+    def processpkt(self, drone, srcaddr, json, discoverychanged, dispatch=None):
+        '''A desired packet has been received - process it.
+        'dispatch' is the DiscoveryDispatch shared by all the listeners for this packet.'''
         raise NotImplementedError('Abstract class - processpkt()')
 
+    @classmethod
+    def abort(cls):
+        '''The current transaction has been aborted - forget anything we remember
+        in memory which may now be ahead of the database.  Most of us don't remember anything.'''
+        pass
+
+    @staticmethod
+    def get_dispatch(drone, jsonobj, dispatch):
+        '''Return the DiscoveryDispatch shared by everyone processing this packet
+        - making one if we were called directly rather than by SystemNode._process_json()'''
+        return dispatch if dispatch is not None else DiscoveryDispatch(drone, jsonobj)
+
 
 @Drone.add_json_processor
 class MonitoringAgentDiscoveryListener(DiscoveryListener):
@@ -85,12 +105,12 @@ class MonitoringAgentDiscoveryListener(DiscoveryListener):
     prio = DiscoveryListener.PRI_CORE
     wantedpackets = ('monitoringagents',)
 
-    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged):
-        '''Update the _agentcache when we get a new set of available agents'''
+    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged, _dispatch=None):
+        '''Update our available agents index when we get a new set of available agents'''
         if not discoverychanged:
             return
         #print >> sys.stderr, 'SETTING MONITORING AGENTS: ', jsonobj['data']
-        setattr(drone, '_agentcache', jsonobj['data'])
+        MonitoringRule.set_available_agents(drone, jsonobj['data'])
 
 
 @Drone.add_json_processor
@@ -100,7 +120,7 @@ class AuditdConfDiscoveryListener(DiscoveryListener):
     prio = DiscoveryListener.PRI_CORE
     wantedpackets = ('auditd_conf',)
 
-    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged):
+    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged, _dispatch=None):
         '''Request discovery of auditd (log) files and directories.
         They will be evaluated by some auditd best practice rules'''
         if not discoverychanged:
@@ -131,7 +151,7 @@ class NetconfigDiscoveryListener(DiscoveryListener):
     prio = DiscoveryListener.PRI_CORE
     wantedpackets = ('netconfig',)
 
-    def processpkt(self, drone, _srcaddr, jsonobj, discoverychanged):
+    def processpkt(self, drone, _srcaddr, jsonobj, discoverychanged, _dispatch=None):
         '''Save away the network configuration data we got from netconfig JSON discovery.
         This includes all our NICs, their MAC addresses, all our IP addresses and so on
         for any (non-loopback) interface.  Whee!
@@ -144,49 +164,22 @@ class NetconfigDiscoveryListener(DiscoveryListener):
             return
         data = jsonobj['data'] # The data portion of the JSON message
 
-        currmacs = {}   # Currmacs is a list of current NICNode objects belonging to this host
-                        # indexed by MAC address
-        # Get our current list of NICs
-        iflist = self.store.load_related(drone, CMAconsts.REL_nicowner, NICNode)
-        for nic in iflist:
-            currmacs[nic.macaddr] = nic
-
+        # Everything this drone currently owns: NICs and their IP addresses - in one query
+        subgraph = OwnedSubgraph(self.store, drone, CMAconsts.REL_nicowner, 'macaddr',
+                                 CMAconsts.REL_ipowner, 'ipaddr')
         primaryifname = None
-        newmacs = {}    # Newmacs is a list of NICNode objects found/created by this discovery
-                        # They are indexed by MAC address
+        wantedmacs = {} # NICs we ought to have - indexed by MAC address
         for ifname in data.keys(): # List of interfaces just below the data section
             ifinfo = data[ifname]
             if 'address' not in ifinfo:
                 continue
             macaddr = str(ifinfo['address'])
-            newnic = self.store.load_or_create(NICNode, domain=drone.domain
-            ,       macaddr=macaddr, ifname=ifname, json=str(ifinfo))
-            newmacs[macaddr] = newnic
+            wantedmacs[macaddr] = {'domain': drone.domain, 'ifname': ifname, 'json': str(ifinfo)}
             if 'default_gw' in ifinfo and primaryifname is None:
                 primaryifname = ifname
 
-        # Now compare the two sets of MAC addresses (old and new) and update the "old" MAC
-        # address with info from the new discovery and deleting any MAC addresses that
-        # we don't have any more...
-        for macaddr in currmacs.keys():
-            currmac = currmacs[macaddr]
-            if macaddr in newmacs:
-                # This MAC may need updating
-                newmacs[macaddr] = currmac.update_attributes(newmacs[macaddr])
-            else:
-                # This MAC has disappeared
-                self.store.separate(drone, CMAconsts.REL_ipowner, currmac)
-                #self.store.separate(drone, CMAconsts.REL_causes,  currmac)
-                # @TODO Needs to be a 'careful, complete' reference count deletion...
-                self.store.delete(currmac)
-                del currmacs[macaddr]
-        currmacs = None
-
-        # Create REL_nicowner relationships for any newly created NIC nodes
-        for macaddr in newmacs.keys():
-            nic = newmacs[macaddr]
-            self.store.relate_new(drone, CMAconsts.REL_nicowner, nic, {'causes': True})
-            #self.store.relate(drone, CMAconsts.REL_causes,   nic)
+        # Update, create, relate and delete NICs to match what we just discovered
+        newmacs = subgraph.reconcile_children(wantedmacs, NICNode, {'causes': True})
 
         # Now newmacs contains all the updated info about our current NICs
         # Let's figure out what's happening with our IP addresses...
@@ -200,12 +193,8 @@ class NetconfigDiscoveryListener(DiscoveryListener):
             #print >> sys.stderr, 'DATA IS:', str(data)
             #print >> sys.stderr, 'IFNAME IS', str(ifname)
             iptable = data[str(ifname)]['ipaddrs']
-            currips = {}
-            iplist = self.store.load_related(mac, CMAconsts.REL_ipowner, IPaddrNode)
-            for ip in iplist:
-                currips[ip.ipaddr] = ip
-
-            newips = {}
+            wantedips = {}
+            primaryipaddr = None
             for ip in iptable.keys():   # keys are 'ip/mask' in CIDR format
                 ipname = ':::INVALID:::'
                 ipinfo = iptable[ip]
@@ -217,37 +206,20 @@ class NetconfigDiscoveryListener(DiscoveryListener):
                 netaddr = pyNetAddr(iponly).toIPv6()
                 if netaddr.islocal():       # We ignore loopback addresses - might be wrong...
                     continue
-                ipnode = self.store.load_or_create(IPaddrNode
-                ,   domain=drone.domain, ipaddr=str(netaddr), cidrmask=cidrmask)
                 ## FIXME: Not an ideal way to determine primary (preferred) IP address...
                 ## it's a bit idiosyncratic to Linux...
                 ## A better way would be to use their 'startaddr' (w/o the port)
                 ## This uses the IP address they used to talk to us.
-                if ifname == primaryifname  and primaryip is None and ipname == ifname:
-                    primaryip = ipnode
-                    drone.primary_ip_addr = str(primaryip.ipaddr)
-                newips[str(netaddr)] = ipnode
-
-            # compare the two sets of IP addresses (old and new)
-            for ipaddr in currips.keys():
-                currip = currips[ipaddr]
-                if ipaddr in newips:
-                    newips[ipaddr] = currip.update_attributes(newips[ipaddr])
-                else:
-                    #print >> sys.stderr, 'Deleting address %s from MAC %s' %  (currip, macaddr)
-                    #print >> sys.stderr, 'currip:%s, currips:%s' %  (str(currip), str(currips))
-                    self.log.debug('Deleting address %s from MAC %s' %  (currip, macaddr))
-                    self.log.debug('currip:%s, currips:%s' %  (str(currip), str(currips)))
-                    self.store.separate(mac, rel_type=CMAconsts.REL_ipowner, obj=currip)
-                    # @TODO Needs to be a 'careful, complete' reference count deletion...
-                    self.store.delete(currip)
-                    del currips[ipaddr]
-
-            # Create REL_ipowner relationships for all the newly created IP nodes
-            for ipaddr in newips.keys():
-                ip = newips[ipaddr]
-                self.store.relate_new(mac, CMAconsts.REL_ipowner, ip, {'causes': True})
-                #self.store.relate(mac, CMAconsts.REL_causes,  ip)
+                if (ifname == primaryifname and primaryip is None and primaryipaddr is None
+                        and ipname == ifname):
+                    primaryipaddr = str(netaddr)
+                wantedips[str(netaddr)] = {'domain': drone.domain, 'cidrmask': cidrmask}
+
+            # Update, create, relate and delete IP addresses to match what we discovered
+            newips = subgraph.reconcile_grandchildren(mac, wantedips, IPaddrNode, {'causes': True})
+            if primaryipaddr is not None:
+                primaryip = newips[primaryipaddr]
+                drone.primary_ip_addr = str(primaryip.ipaddr)
 
 @Drone.add_json_processor
 class TCPDiscoveryListener(DiscoveryListener):
@@ -257,134 +229,211 @@ class TCPDiscoveryListener(DiscoveryListener):
     wantedpackets = ('tcpdiscovery',)
     netstatipportpat = re.compile('(.*):([^:]*)$')
 
+    # One query fetches all our ProcessNodes along with the ports they serve and use.
+    # We collect the services before matching the clients - otherwise we'd get
+    # (services x clients) rows for each process.
+    subgraphquery = '''START drone=node({droneid})
+                       MATCH (drone)-[:hosting]->(proc)
+                       WHERE proc.nodetype = 'ProcessNode'
+                       OPTIONAL MATCH (proc)-[:tcpservice]->(service)
+                       WITH proc, collect(DISTINCT service) AS services
+                       OPTIONAL MATCH (client)-[:tcpclient]->(proc)
+                       RETURN proc, services, collect(DISTINCT client) AS clients'''
+    stats = {'queries': 0, 'newprocs': 0, 'delprocs': 0, 'newports': 0, 'oldports': 0,
+             'delports': 0}
+
     # disable=R0914 means too many local variables...
     # disable=R0912 means too many branches
     # pylint: disable=R0914,R0912
-    def processpkt(self, drone, _srcaddr, jsonobj, discoverychanged):
-        '''Add TCP listeners and clients.'''
+    def processpkt(self, drone, _srcaddr, jsonobj, discoverychanged, dispatch=None):
+        '''Add TCP listeners and clients.
+        We load the existing process/port subgraph for this Drone in a single query,
+        compare it to the discovery data in memory, and only create, relate and separate
+        what actually changed.  The Store sends all of it out in one batch at commit time.
+        '''
         if not discoverychanged:
             return
-        data = jsonobj['data'] # The data portion of the JSON message
+        dispatch = self.get_dispatch(drone, jsonobj, dispatch)
+        data = dispatch.data() # The data portion of the JSON message
         if self.debug:
             self.log.debug('_add_tcplisteners(data=%s)' % data)
 
         assert(not Store.is_abstract(drone))
-        allourips = drone.get_owned_ips()
         if self.debug:
             self.log.debug('Processing keys(%s)' % data.keys())
-        newprocs = {}
-        newprocmap = {}
         discoveryroles = {}
-        for procname in data.keys():    # List of nanoprobe-assigned names of processes...
-            procinfo = data[procname]
+        for procinfo in data.values():
             if 'listenaddrs' in procinfo:
-                if CMAconsts.ROLE_server not in discoveryroles:
-                    discoveryroles[CMAconsts.ROLE_server] = True
-                    drone.addrole(CMAconsts.ROLE_server)
+                discoveryroles[CMAconsts.ROLE_server] = True
             if 'clientaddrs' in procinfo:
-                if CMAconsts.ROLE_client not in discoveryroles:
-                    discoveryroles[CMAconsts.ROLE_client] = True
-                    drone.addrole(CMAconsts.ROLE_client)
-            #print >> sys.stderr, 'CREATING PROCESS %s!!' % procname
-            processproc = self.store.load_or_create(ProcessNode, domain=drone.domain
-            ,   processname=procname
-            ,   host=drone.designation
-            ,   pathname=procinfo.get('exe', 'unknown'), argv=procinfo.get('cmdline', 'unknown')
-            ,   uid=procinfo.get('uid','unknown'), gid=procinfo.get('gid', 'unknown')
-            ,   cwd=procinfo.get('cwd', '/'))
-            assert hasattr(processproc, '_Store__store_node')
-            processproc.procinfo = str(procinfo)
-
-            newprocs[processproc.processname] = processproc
-            newprocmap[procname] = processproc
-            if self.store.is_abstract(processproc):
-                self.store.relate(drone, CMAconsts.REL_hosting, processproc, {'causes':True})
-            if self.debug:
-                self.log.debug('procinfo(%s) - processproc created=> %s' % (procinfo, processproc))
+                discoveryroles[CMAconsts.ROLE_client] = True
+        for role in discoveryroles:
+            drone.addrole(role)
 
-        oldprocs = {}
-        # Several kinds of nodes have the same relationship to the host...
-        for proc in self.store.load_related(drone, CMAconsts.REL_hosting, GraphNode.factory):
-            if not isinstance(proc, ProcessNode):
-                continue
-            assert hasattr(proc, '_Store__store_node')
-            procname = proc.processname
-            oldprocs[procname] = proc
-            if procname not in newprocs:
-                if len(proc.delrole(discoveryroles.keys())) == 0:
-                    assert not Store.is_abstract(proc)
-                    self.store.separate(drone, CMAconsts.REL_hosting, proc)
-                    # @TODO Needs to be a 'careful, complete' reference count deletion...
-                    print >> sys.stderr, ('TRYING TO DELETE node %s'
-                    %   (procname))
-                    for newprocname in newprocs:
-                        print >> sys.stderr, ('*** new procs: proc.procname %s'
-                        %   (str(newprocname)))
-                    print >> sys.stderr, ('*** DELETING proc: proc.procname %s: proc=%s'
-                    %   (str(procname), str(proc)))
-                    self.store.delete(proc)
-
-        for procname in data.keys(): # List of names of processes...
-            processnode = newprocmap[procname]
+        oldprocs, oldservices, oldclients = self._load_tcpsubgraph(drone)
+        allourips = None
+        ipnodes = {}
+        newprocs = {}
+        allprocattrs = dispatch.processattrs()
+        for procname in data.keys():    # List of nanoprobe-assigned names of processes...
             procinfo = data[procname]
+            procattrs = allprocattrs[procname]
+            if procname in oldprocs:
+                processnode = oldprocs[procname]
+                for attr in procattrs:
+                    if getattr(processnode, attr, None) != procattrs[attr]:
+                        setattr(processnode, attr, procattrs[attr])
+            else:
+                #print >> sys.stderr, 'CREATING PROCESS %s!!' % procname
+                processnode = self.store.load_or_create(ProcessNode, domain=drone.domain
+                ,   processname=procname, host=drone.designation, **procattrs)
+                if self.store.is_abstract(processnode):
+                    self.store.relate(drone, CMAconsts.REL_hosting, processnode,
+                                      {'causes':True})
+                else:
+                    self.store.relate_new(drone, CMAconsts.REL_hosting, processnode,
+                                          {'causes':True})
+                TCPDiscoveryListener.stats['newprocs'] += 1
+            assert hasattr(processnode, '_Store__store_node')
+            if getattr(processnode, 'procinfo', None) != str(procinfo):
+                processnode.procinfo = str(procinfo)
+            newprocs[procname] = processnode
+            # Later listeners for this packet can use this ProcessNode without looking it up
+            dispatch.processnodes[procname] = processnode
             if self.debug:
-                self.log.debug('Processing key(%s): proc: %s' % (procname, processnode))
+                self.log.debug('procinfo(%s) - processnode => %s' % (procinfo, processnode))
+            known = procname in oldprocs
+
+            # Ports this process serves
+            services = {}
             if 'listenaddrs' in procinfo:
-                srvportinfo = procinfo['listenaddrs']
                 processnode.addrole(CMAconsts.ROLE_server)
-                for srvkey in srvportinfo.keys():
-                    match = TCPDiscoveryListener.netstatipportpat.match(srvkey)
-                    (ip, port) = match.groups()
-                    self._add_serveripportnodes(drone, ip, int(port), processnode, allourips)
+                if allourips is None:
+                    allourips = drone.get_owned_ips()
+                    for ipnode in allourips:
+                        ipnodes[str(ipnode.ipaddr)] = ipnode
+                for srvkey in procinfo['listenaddrs'].keys():
+                    (ip, port) = TCPDiscoveryListener.netstatipportpat.match(srvkey).groups()
+                    for ipnode in self._server_ipnodes(drone, ip, allourips, ipnodes):
+                        services[IPtcpportNode.ipportkey(ipnode.ipaddr, int(port))] \
+                            = (ipnode, int(port))
+            self._reconcile_ports(drone, processnode, CMAconsts.REL_tcpservice, services,
+                                  oldservices.get(procname, {}) if known else None)
+
+            # Ports this process is a client of
+            clients = {}
             if 'clientaddrs' in procinfo:
-                clientinfo = procinfo['clientaddrs']
                 processnode.addrole(CMAconsts.ROLE_client)
-                for clientkey in clientinfo.keys():
-                    match = TCPDiscoveryListener.netstatipportpat.match(clientkey)
-                    (ip, port) = match.groups()
-                    self._add_clientipportnode(drone, ip, int(port), processnode)
-
-    def _add_clientipportnode(self, drone, ipaddr, servport, processnode):
-        '''Add the information for a single client IPtcpportNode to the database.'''
-        servip_name = str(pyNetAddr(ipaddr).toIPv6())
-        servip = self.store.load_or_create(IPaddrNode, domain=drone.domain, ipaddr=servip_name)
-        ip_port = self.store.load_or_create(IPtcpportNode, domain=drone.domain
-        ,       ipaddr=servip_name, port=servport)
-        self.store.relate_new(ip_port, CMAconsts.REL_baseip, servip)
-        self.store.relate_new(ip_port, CMAconsts.REL_tcpclient, processnode)
-
-    def _add_serveripportnodes(self, drone, ip, port, processnode, allourips):
-        '''We create tcpipports objects that correspond to the given json object in
-        the context of the set of IP addresses that we support - including support
-        for the ANY ipv4 and ipv6 addresses'''
+                for clientkey in procinfo['clientaddrs'].keys():
+                    (ip, port) = TCPDiscoveryListener.netstatipportpat.match(clientkey).groups()
+                    servip_name = str(pyNetAddr(ip).toIPv6())
+                    clients[IPtcpportNode.ipportkey(servip_name, int(port))] \
+                        = (servip_name, int(port))
+            self._reconcile_ports(drone, processnode, CMAconsts.REL_tcpclient, clients,
+                                  oldclients.get(procname, {}) if known else None, ipnodes)
+
+        for procname in oldprocs:
+            if procname in newprocs:
+                continue
+            proc = oldprocs[procname]
+            if len(proc.delrole(discoveryroles.keys())) == 0:
+                assert not Store.is_abstract(proc)
+                # @TODO Needs to be a 'careful, complete' reference count deletion...
+                # (Store.delete() also removes all its relationships)
+                if self.debug:
+                    self.log.debug('Deleting process %s: %s' % (procname, proc))
+                self.store.delete(proc)
+                TCPDiscoveryListener.stats['delprocs'] += 1
+
+    def _load_tcpsubgraph(self, drone):
+        '''Load all our ProcessNodes, and the IPtcpportNodes they serve and use.
+        Returns (processes, services, clients) where processes maps process names to
+        ProcessNodes, and services and clients map process names to {ipport: IPtcpportNode}
+        '''
+        procs = {}
+        services = {}
+        clients = {}
+        TCPDiscoveryListener.stats['queries'] += 1
+        for (proc, procservices, procclients) in self.store.load_cypher_query(
+                TCPDiscoveryListener.subgraphquery, GraphNode.factory,
+                params={'droneid': Store.id(drone)}):
+            assert hasattr(proc, '_Store__store_node')
+            procs[proc.processname] = proc
+            services[proc.processname] = dict([(port.ipport, port)
+                                               for port in procservices if port is not None])
+            clients[proc.processname] = dict([(port.ipport, port)
+                                              for port in procclients if port is not None])
+        return procs, services, clients
+
+    def _server_ipnodes(self, drone, ip, allourips, ipnodes):
+        '''Return the list of our IPaddrNodes a server listening on 'ip' is reachable through
+        - including support for the ANY ipv4 and ipv6 addresses'''
         netaddr = pyNetAddr(str(ip)).toIPv6()
         if netaddr.islocal():
             self.log.warning('add_serveripportnodes("%s"): address is local' % netaddr)
-            return
+            return []
+        if netaddr.isanyaddr():
+            return allourips
         addr = str(netaddr)
-        # Were we given the ANY address?
-        anyaddr = netaddr.isanyaddr()
-        for ipaddr in allourips:
-            if not anyaddr and str(ipaddr.ipaddr) != addr:
-                continue
-            ip_port = self.store.load_or_create(IPtcpportNode, domain=drone.domain
-            ,   ipaddr=ipaddr.ipaddr, port=port)
-            assert hasattr(ip_port, '_Store__store_node')
-            self.store.relate_new(processnode, CMAconsts.REL_tcpservice, ip_port)
-            assert hasattr(ipaddr, '_Store__store_node')
-            self.store.relate_new(ip_port, CMAconsts.REL_baseip, ipaddr)
-            if not anyaddr:
-                return
-        if not anyaddr:
-            print >> sys.stderr, ('LOOKING FOR %s (%s, %s) in: %s'
-            %       (netaddr, type(ip), type(netaddr), [str(ip.ipaddr) for ip in allourips]))
-            #raise ValueError('IP Address mismatch for Drone %s - could not find address %s'
-            #%       (drone, addr))
+        if addr not in ipnodes:
             # Must not have been discovered yet. Hopefully discovery will come along and
             # fill in the cidrmask, and create the NIC relationship ;-)
+            if self.debug:
+                self.log.debug('LOOKING FOR %s in: %s'
+                %   (addr, [str(ipnode.ipaddr) for ipnode in allourips]))
             ipnode = self.store.load_or_create(IPaddrNode, domain=drone.domain, ipaddr=addr)
             allourips.append(ipnode)
-            self._add_serveripportnodes(drone, addr, port, processnode, allourips)
+            ipnodes[addr] = ipnode
+        return [ipnodes[addr]]
+
+    # pylint: disable=R0913
+    def _reconcile_ports(self, drone, processnode, reltype, desired, existing, ipnodes=None):
+        '''Make the 'reltype' IPtcpportNodes of this process match 'desired'.
+        'desired' maps ipport keys to (IP address (node or name), port) pairs.
+        'existing' maps ipport keys to the IPtcpportNodes we know are related to this
+        process, or is None if we don't know (i.e., it's a new process).
+        For services, the relationship is processnode-[:tcpservice]->ip_port,
+        for clients it's ip_port-[:tcpclient]->processnode.
+        '''
+        known = existing is not None
+        if not known:
+            existing = {}
+        for ipport in desired:
+            if ipport in existing:
+                TCPDiscoveryListener.stats['oldports'] += 1
+                continue
+            (ipaddr, port) = desired[ipport]
+            if isinstance(ipaddr, IPaddrNode):
+                ipnode = ipaddr
+            else:
+                ipnode = ipnodes.get(ipaddr)
+                if ipnode is None:
+                    ipnode = self.store.load_or_create(IPaddrNode, domain=drone.domain,
+                                                       ipaddr=ipaddr)
+                    ipnodes[ipaddr] = ipnode
+            ip_port = self.store.load_or_create(IPtcpportNode, domain=drone.domain
+            ,   ipaddr=ipnode.ipaddr, port=port)
+            assert hasattr(ip_port, '_Store__store_node')
+            assert hasattr(ipnode, '_Store__store_node')
+            if reltype == CMAconsts.REL_tcpservice:
+                subj, obj = processnode, ip_port
+            else:
+                subj, obj = ip_port, processnode
+            if known:
+                # Our query says they're not related - no need to ask the database
+                self.store.relate(subj, reltype, obj)
+            else:
+                self.store.relate_new(subj, reltype, obj)
+            self.store.relate_new(ip_port, CMAconsts.REL_baseip, ipnode)
+            TCPDiscoveryListener.stats['newports'] += 1
+        for ipport in existing:
+            if ipport not in desired:
+                # The port itself may well be in use by other processes...
+                if reltype == CMAconsts.REL_tcpservice:
+                    self.store.separate(processnode, reltype, existing[ipport])
+                else:
+                    self.store.separate(existing[ipport], reltype, processnode)
+                TCPDiscoveryListener.stats['delports'] += 1
 
 @Drone.add_json_processor
 class SystemSubclassDiscoveryListener(DiscoveryListener):
@@ -393,7 +442,7 @@ class SystemSubclassDiscoveryListener(DiscoveryListener):
     prio = DiscoveryListener.PRI_CORE
     wantedpackets = ('vagrant', 'docker')
 
-    def processpkt(self, drone, _unused_srcaddr, jsonobj, discoverychanged):
+    def processpkt(self, drone, _unused_srcaddr, jsonobj, discoverychanged, _dispatch=None):
         ''' Kick off discovery for a Docker or vagrant instance - as though it were a
             real boy -- I mean a real Drone
         '''
@@ -294,6 +294,8 @@ class Drone(SystemNode):
         self.status = status
         self.reason = reason
         self.monitors_activated = False
+        self.hostmonitors_activated = False
+        self.checksum_request = ''
         self.time_status_ms = int(round(time.time() * 1000))
         self.time_status_iso8601 = time.strftime('%Y-%m-%d %H:%M:%S')
         if status == oldstatus:
@@ -456,6 +458,10 @@ class Drone(SystemNode):
         assert CMAdb.store.has_node(drone)
         drone.reason = reason
         drone.status = status
+        # A (re)started nanoprobe isn't monitoring anything
+        drone.monitors_activated = False
+        drone.hostmonitors_activated = False
+        drone.checksum_request = ''
         drone.statustime = int(round(time.time() * 1000))
         drone.iso8601 = time.strftime('%Y-%m-%d %H:%M:%S')
         if port is not None:
@@ -22,11 +22,48 @@
 #
 ''' This module defines Functions to evaluate GraphNode expressions...  '''
 
-import re, os, inspect, sys
+import re, os, inspect, sys, collections
 from AssimCtypes import ADDR_FAMILY_IPV4, ADDR_FAMILY_IPV6
 from AssimCclasses import pyNetAddr, pyConfigContext
 #
 #
+class LRUCache(object):
+    '''A simple bounded least-recently-used cache which keeps hit/miss statistics.
+    None is not a cacheable value - get() returns None for things not in the cache.
+    '''
+    def __init__(self, maxsize):
+        'Initialize our LRUCache'
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        'Return the value for this key - or None'
+        try:
+            value = self.cache.pop(key)
+        except KeyError:
+            self.stats['misses'] += 1
+            return None
+        self.cache[key] = value  # Now it's the most recently used
+        self.stats['hits'] += 1
+        return value
+
+    def put(self, key, value):
+        'Cache this value - evicting the least recently used value if we need room'
+        if key in self.cache:
+            del self.cache[key]
+        elif len(self.cache) >= self.maxsize:
+            self.cache.popitem(last=False)
+            self.stats['evictions'] += 1
+        self.cache[key] = value
+
+    def clear(self):
+        'Empty out our cache'
+        self.cache.clear()
+
+    def __len__(self):
+        return len(self.cache)
+
 class GraphNodeExpression(object):
     '''We implement Graph node expressions - we are't a real class'''
     functions = {}
@@ -78,19 +115,25 @@ class GraphNodeExpression(object):
             value = str(value)
         return value
 
+    # Parsed function calls: expression => (function-name, argument-tokens)
+    _parsecache = LRUCache(2048)
+    # Kinds of argument tokens
+    ARG_QUOTED = 0  # Quoted string - used as is
+    ARG_EXPR = 1    # Expression to evaluate
+    ARG_CALL = 2    # Nested function call
+
     # pylint R0912: too many branches - really ought to write a lexical analyzer and parser
     # On the whole it would be simpler and easier to understand...
     # pylint: disable=R0912
     @staticmethod
-    def _compute_function_args(arglist, context):
-        '''Compute the arguments to a function call. May contain function calls
-        and other GraphNodeExpression, or quoted strings...
+    def _parse_function_args(arglist):
+        '''Parse the arguments to a function call into a list of (kind, string) tokens.
+        They may contain function calls and other GraphNodeExpression, or quoted strings...
+        We return None if the arguments are ill-formed.
         Ugly lexical analysis.
         Really ought to write a real recursive descent parser...
         '''
-        # print >> sys.stderr, '_compute_function_args(%s)' % str(arglist)
-        args = []
-        argstrings = []
+        tokens = []
         nestcount=0
         arg = ''
         instring = False
@@ -107,52 +150,88 @@ class GraphNodeExpression(object):
             elif nestcount == 0 and char == ',':
                 if prevwasquoted:
                     prevwasquoted = False
-                    args.append(arg)
-                    argstrings.append(arg)
+                    tokens.append((GraphNodeExpression.ARG_QUOTED, arg))
                 else:
                     arg = arg.strip()
                     if arg == '':
                         continue
-                    #print >> sys.stderr, "EVALUATING [%s]" % arg
-                    args.append(GraphNodeExpression.evaluate(arg, context))
-                    argstrings.append(arg)
+                    tokens.append((GraphNodeExpression.ARG_EXPR, arg))
                     arg = ''
             elif char == '(':
                 nestcount += 1
-                #print >> sys.stderr, "++nesting: %d" % (nestcount)
                 arg += char
             elif char == ')':
                 arg += char
                 nestcount -= 1
-                #print >> sys.stderr, "--nesting: %d" % (nestcount)
                 if nestcount < 0:
-                    return (None, None)
+                    return None
                 if nestcount == 0:
                     if prevwasquoted:
-                        #print >> sys.stderr, '_compute_function_args: QUOTED argument: "%s"' % arg
-                        args.append(arg)
+                        tokens.append((GraphNodeExpression.ARG_QUOTED, arg))
                     else:
-                        arg = arg.strip()
-                        #print >> sys.stderr, "GnE.functioncall [%s]" % arg
-                        args.append(GraphNodeExpression.functioncall(arg, context))
-                    argstrings.append(arg)
+                        tokens.append((GraphNodeExpression.ARG_CALL, arg.strip()))
                     arg = ''
             else:
                 arg += char
         if nestcount > 0 or instring:
             #print "Nestcount: %d, instring: %s" % (nestcount, instring)
-            return (None, None)
+            return None
         if arg != '':
             if prevwasquoted:
-                #print >> sys.stderr, '_compute_function_args: quoted argument: "%s"' % arg
-                args.append(arg)
+                tokens.append((GraphNodeExpression.ARG_QUOTED, arg))
             else:
-                #print >> sys.stderr, "GnE.evaluate [%s]" % arg
-                args.append(GraphNodeExpression.evaluate(arg, context))
-            argstrings.append(arg)
-        #print >> sys.stderr, 'RETURNING [%s] [%s]' % (args, argstrings)
+                tokens.append((GraphNodeExpression.ARG_EXPR, arg))
+        return tokens
+
+    @staticmethod
+    def _compute_function_args(arglist, context):
+        '''Compute the arguments to a function call. May contain function calls
+        and other GraphNodeExpression, or quoted strings...
+        '''
+        tokens = GraphNodeExpression._parse_function_args(arglist)
+        if tokens is None:
+            return (None, None)
+        return GraphNodeExpression._evaluate_args(tokens, context)
+
+    @staticmethod
+    def _evaluate_args(tokens, context):
+        '''Evaluate a list of parsed argument tokens in this context.
+        We return (argument-values, argument-strings)
+        '''
+        args = []
+        argstrings = []
+        for (kind, argstring) in tokens:
+            if kind == GraphNodeExpression.ARG_QUOTED:
+                args.append(argstring)
+            elif kind == GraphNodeExpression.ARG_CALL:
+                args.append(GraphNodeExpression.functioncall(argstring, context))
+            else:
+                args.append(GraphNodeExpression.evaluate(argstring, context))
+            argstrings.append(argstring)
         return (args, argstrings)
 
+    @staticmethod
+    def _parse_functioncall(expression):
+        '''Parse a function call expression into (function-name, argument-tokens) - once.
+        We return None if it's ill-formed.
+        '''
+        parsed = GraphNodeExpression._parsecache.get(expression)
+        if parsed is not None:
+            return parsed
+        if expression[-1] != ')':
+            print >> sys.stderr, '%s does not end in )' % expression
+            return None
+        (funname, arglist) = expression[:len(expression)-1].split('(', 1)
+        funname = funname.strip()
+        if funname.startswith('@'):
+            funname = funname[1:]
+        tokens = GraphNodeExpression._parse_function_args(arglist.strip())
+        if tokens is None:
+            return None
+        parsed = (funname, tokens)
+        GraphNodeExpression._parsecache.put(expression, parsed)
+        return parsed
+
     @staticmethod
     def functioncall(expression, context):
         '''Performs a function call for our expression language
@@ -164,30 +243,21 @@ class GraphNodeExpression(object):
         ExpressionContext argument.
 
         This parsing is incredibly primitive.  Feel free to improve it ;-)
+        At least we only do it once for any given expression...
 
         '''
-        expression = expression.strip()
-        if expression[-1] != ')':
-            print >> sys.stderr, '%s does not end in )' % expression
+        parsed = GraphNodeExpression._parse_functioncall(expression.strip())
+        if parsed is None:
             return None
-        expression = expression[:len(expression)-1]
-        (funname, arglist) = expression.split('(', 1)
-        # print >> sys.stderr, 'FUNCTIONCALL: %s(%s)' % (funname, arglist)
-        funname = funname.strip()
-        arglist = arglist.strip()
+        (funname, tokens) = parsed
         #
-        # At this point we have all our arguments as a string , but it might contain
+        # At this point we have all our arguments parsed, but they might contain
         # other (nested) calls for us to evaluate
         #
-        # print >> sys.stderr, 'FunctionCall: arglist: [%s]' % (arglist)
-        args, _argstrings = GraphNodeExpression._compute_function_args(arglist, context)
+        args, _argstrings = GraphNodeExpression._evaluate_args(tokens, context)
         # print >> sys.stderr, 'args: %s' % (args)
         # print >> sys.stderr, '_argstrings: %s' % (_argstrings)
-        if args is None:
-            return None
 
-        if funname.startswith('@'):
-            funname = funname[1:]
         if funname not in GraphNodeExpression.functions:
             print >> sys.stderr, 'BAD FUNCTION NAME: %s' % funname
             return None
@@ -234,6 +304,7 @@ class ExpressionContext(object):
         self.objects = objects if isinstance(objects, (list, tuple)) else (objects,)
         self.prefix = prefix
         self.values = {}
+        self.argvindexes = {}
 
     def __str__(self):
         ret = 'ExpressionContext('
@@ -301,6 +372,7 @@ class ExpressionContext(object):
     def clear(self):
         'Clear our cached values'
         self.values = {}
+        self.argvindexes = {}
 
     def items(self):
         'Return all items from our cache'
@@ -537,17 +609,78 @@ def _str_to_regexflags(s):
                 flags |= re.VERBOSE
     return flags
 
-_regex_cache = {}
+_regex_cache = LRUCache(1024)
 def _compile_and_cache_regex(regexstr, flags=None):
     'Compile and cache a regular expression with the given flags'
-    cache_key = '%s//%s' % (str(regexstr), str(flags))
-    if cache_key in _regex_cache:
-        regex = _regex_cache[cache_key]
-    else:
+    cache_key = (str(regexstr), str(flags))
+    regex = _regex_cache.get(cache_key)
+    if regex is None:
         regex = re.compile(regexstr, _str_to_regexflags(flags))
-        _regex_cache[cache_key] = regex
+        _regex_cache.put(cache_key, regex)
     return regex
 
+class ArgvIndex(object):
+    '''An index of an argv-style list of arguments - built once and shared by all the rules
+    evaluated in the same ExpressionContext (see _argv_index()).
+    We index name=value arguments, "-flag value" pairs and "-Xvalue" short flags,
+    always keeping the first occurrence - just like a linear scan would find.
+    '''
+    def __init__(self, argv):
+        'Index this argument list'
+        self.argv = argv
+        self.equals = {}        # name => value (from name=value)
+        self.flags = {}         # -flag => (position, following argument)
+        self.shortflags = {}    # -X => (position, rest of argument) (from -Xvalue)
+        self.matches = {}       # (regex, flags) => argmatch result
+        self.valid = True
+        argslen = len(argv)
+        for pos in range(argslen):
+            arg = argv[pos]
+            if not isinstance(arg, (str, unicode)):
+                # Not what we expected - let the callers do it the slow way
+                self.valid = False
+                return
+            eqpos = arg.find('=')
+            if eqpos >= 0 and arg[:eqpos] not in self.equals:
+                self.equals[arg[:eqpos]] = arg[eqpos+1:]
+            if arg not in self.flags and (pos+1) < argslen:
+                self.flags[arg] = (pos, argv[pos+1])
+            if len(arg) > 2 and arg[:2] not in self.shortflags:
+                self.shortflags[arg[:2]] = (pos, arg[2:])
+
+    def argequals(self, name):
+        'Return the value from the first name=value argument - or None'
+        return self.equals.get(name)
+
+    def flagvalue(self, flagname):
+        'Return the value of the first "-flag value" or "-Xvalue" argument - or None'
+        flag = self.flags.get(flagname)
+        if len(flagname) != 2:
+            return None if flag is None else flag[1]
+        shortflag = self.shortflags.get(flagname)
+        if flag is None or (shortflag is not None and shortflag[0] < flag[0]):
+            return None if shortflag is None else shortflag[1]
+        return flag[1]
+
+def _argv_index(argname, context):
+    '''Return the ArgvIndex for the list named by 'argname' in this context.
+    Each context builds it at most once (per list).  We return None if there is no
+    such list, or if it can't be indexed.
+    '''
+    if not hasattr(context, 'argvindexes'):
+        return None
+    argv = GraphNodeExpression.evaluate(argname, context)
+    if argv is None:
+        return None
+    index = context.argvindexes.get(argname)
+    if index is None or index.argv is not argv:
+        try:
+            index = ArgvIndex(argv)
+        except TypeError:
+            return None
+        context.argvindexes[argname] = index
+    return index if index.valid else None
+
 @GraphNodeExpression.RegisterFun
 def match(args, _context):
     '''Function to return True if first argument matches the second argument (a regex)
@@ -575,6 +708,10 @@ def argequals(args, context):
         return None
     definename = args[0]
     argname = args[1] if len(args) >= 2 else '$argv'
+    if isinstance(definename, (str, unicode)) and definename.find('=') < 0:
+        index = _argv_index(argname, context)
+        if index is not None:
+            return index.argequals(definename)
     listtosearch = GraphNodeExpression.evaluate(argname, context)
     #print >> sys.stderr, 'SEARCHING in %s FOR %s in %s' % (argname, definename, listtosearch)
     if listtosearch is None:
@@ -616,10 +753,19 @@ def argmatch(args, context):
     regexstr = args[0]
     argname = args[1] if len(args) >= 2 else '$argv'
     flags   = args[2] if len(args) >= 3 else None
+    index = _argv_index(argname, context)
+    if index is not None:
+        matchkey = (str(regexstr), str(flags))
+        if matchkey not in index.matches:
+            index.matches[matchkey] = _argmatch(regexstr, flags, index.argv)
+        return index.matches[matchkey]
     listtosearch = GraphNodeExpression.evaluate(argname, context)
     if listtosearch is None:
         return None
+    return _argmatch(regexstr, flags, listtosearch)
 
+def _argmatch(regexstr, flags, listtosearch):
+    'Return the (first group of) the first match of this regex in this list'
     # W0702: No exception type specified for except statement
     # pylint: disable=W0702
     try:
@@ -659,6 +805,10 @@ def flagvalue(args, context):
         return None
     flagname = args[0]
     argname = args[1] if len(args) >= 2 else '$argv'
+    if isinstance(flagname, (str, unicode)) and len(flagname) > 0:
+        index = _argv_index(argname, context)
+        if index is not None:
+            return index.flagvalue(flagname)
 
     progargs = GraphNodeExpression.evaluate(argname, context)
     argslen = len(progargs)
@@ -804,6 +954,27 @@ def PAMMODARGS(args, _context):
     if section is None:
         #print >> sys.stderr, 'Section is None in PAM object'
         return None
+    for modargs in _pam_service_index(section).get(reqservice, ()):
+        if reqmodule != 'ANY' and (modargs['path'] != reqmodule and
+                                   modargs['path'] != (reqmodule + '.so')):
+            #print >> sys.stderr, 'Module %s not in PAM line %s' % (reqmodule, str(line))
+            continue
+        ret = modargs[reqarg] if reqarg in modargs else None
+        if ret is None and reqmodule == 'ANY':
+            continue
+        #print >> sys.stderr, 'RETURNING %s from %s' % (ret, str(modargs))
+        return ret
+    return None
+
+_pam_section_cache = LRUCache(64)
+def _pam_service_index(section):
+    '''Return a dict mapping PAM service names to the (ordered) list of module dicts
+    for that service in this PAM section.  We only build it once for any given section.
+    '''
+    cached = _pam_section_cache.get(id(section))
+    if cached is not None and cached[0] is section:
+        return cached[1]
+    index = {}
     # Each section is a list of lines
     for line in section:
         # Each line is a dict with potential keys of:
@@ -815,28 +986,14 @@ def PAMMODARGS(args, _context):
         #       - other arguments as per the module's requirements
         #         simple flags without '=' values show up with True as value
         #
-        if 'service' not in line or line['service'] != reqservice:
-            #print >> sys.stderr, 'Service %s not in PAM line %s' % (reqservice, str(line))
+        if 'service' not in line or 'module' not in line or 'path' not in line['module']:
             continue
-        if 'module' not in line:
-            #print >> sys.stderr, '"module" not in PAM line %s' % str(line)
-            continue
-        if 'path' not in line['module']:
-            #print >> sys.stderr, '"path" not in PAM module %s' % str(line['module'])
-            #print >> sys.stderr, '"path" not in PAM line %s' % str(line)
-            continue
-        modargs = line['module']
-        if reqmodule != 'ANY' and (modargs['path'] != reqmodule and
-                                   modargs['path'] != (reqmodule + '.so')):
-            #print >> sys.stderr, 'Module %s not in PAM line %s' % (reqmodule, str(line))
-            continue
-        ret = modargs[reqarg] if reqarg in modargs else None
-        if ret is None and reqmodule == 'ANY':
-            continue
-        #print >> sys.stderr, 'RETURNING %s from %s' % (ret, str(line))
-        return ret
-    return None
-
+        service = line['service']
+        if service not in index:
+            index[service] = []
+        index[service].append(line['module'])
+    _pam_section_cache.put(id(section), (section, index))
+    return index
 
 
 @GraphNodeExpression.RegisterFun
@@ -981,10 +1138,14 @@ def _regexmatch(key):
     This is not a "standard" format, but it's what netstat uses - so it's
     what we use.
     '''
-    mobj = ipportregex.match(key)
-    if mobj is None:
-        return None
-    (ip, port) = mobj.groups()
+    ipport = _ipport_cache.get(key)
+    if ipport is None:
+        mobj = ipportregex.match(key)
+        if mobj is None:
+            return None
+        ipport = mobj.groups()
+        _ipport_cache.put(key, ipport)
+    (ip, port) = ipport
     ipport = pyNetAddr(ip, port=int(port))
     if ipport.isanyaddr():
         if ipport.addrtype() == ADDR_FAMILY_IPV4:
@@ -1009,6 +1170,7 @@ def _collect_ip_ports(service):
 
 # Netstat format IP:port pattern
 ipportregex = re.compile('(.*):([^:]*)$')
+_ipport_cache = LRUCache(4096)   # netstat-format key => (ip, port)
 def selectanipport(arg, _context, preferlowestport=True, preferv4=True):
     '''This function searches discovery information for a suitable IP
     address/port combination to go with the service.
@@ -1237,6 +1399,38 @@ if __name__ == '__main__':
         assert argmatch(('THANG-(.*)','$argv', 'I'), argcontext) == 'two'
         assert argmatch(('thang-.*',), argcontext) == 'thang-two'
         assert argmatch(('THANG-.*','$argv', 'I'), argcontext) == 'thang-two'
+        flagcontext = ExpressionContext(pyConfigContext(
+            '{"argv": ["java", "-Xmx512m", "-cp", "/a:/b", "-Dneo4j.home=/neo", "-Dx=1", "-X"]}'),)
+        assert flagvalue(('-cp',), flagcontext) == '/a:/b'
+        assert flagvalue(('-X',), flagcontext) == 'mx512m'
+        assert flagvalue(('-Dx',), flagcontext) is None
+        assert argequals(('-Dneo4j.home',), flagcontext) == '/neo'
+        assert argequals(('-Dx',), flagcontext) == '1'
+        assert argequals(('-Dy',), flagcontext) is None
+        assert len(flagcontext.argvindexes) == 1
+        assert GraphNodeExpression.evaluate('@basename(@argequals(-Dneo4j.home))', flagcontext) \
+            == 'neo'
+        pamcontext = ExpressionContext(pyConfigContext('''{"auth": [
+            {"service": "auth", "type": {"required": true},
+                "module": {"path": "pam_unix.so", "nullok": true}},
+            {"service": "auth", "type": {"required": true},
+                "module": {"path": "pam_deny.so"}},
+            {"service": "account", "type": {"required": true},
+                "module": {"path": "pam_unix.so", "try_first_pass": true}}
+            ]}'''),)
+        assert GraphNodeExpression.evaluate('PAMMODARGS($auth, auth, pam_unix, nullok)',
+                                            pamcontext) is True
+        assert GraphNodeExpression.evaluate('PAMMODARGS($auth, account, ANY, try_first_pass)',
+                                            pamcontext) is True
+        assert GraphNodeExpression.evaluate('PAMMODARGS($auth, account, pam_deny, nullok)',
+                                            pamcontext) is None
+        testcache = LRUCache(2)
+        testcache.put('a', 1)
+        testcache.put('b', 2)
+        assert testcache.get('a') == 1
+        testcache.put('c', 3)
+        assert testcache.get('b') is None and testcache.get('a') == 1
+        assert testcache.stats == {'hits': 2, 'misses': 1, 'evictions': 1}
         print >> sys.stderr, 'Context tests passed.'
 
     simpletests()
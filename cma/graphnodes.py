@@ -22,13 +22,14 @@
 ''' This module defines the classes for most of our CMA nodes ...  '''
 # Pylint is nuts here...
 # pylint: disable=C0411
-import sys, re, time, hashlib, netaddr, socket
+import sys, re, time, hashlib, netaddr, socket, zlib, base64
 from py2neo import neo4j
 from consts import CMAconsts
 from store import Store
 from cmadb import CMAdb
 from AssimCtypes import ADDR_FAMILY_IPV4, ADDR_FAMILY_IPV6, ADDR_FAMILY_802
 from AssimCclasses import pyNetAddr, pyConfigContext
+from graphnodeexpression import LRUCache
 
 def nodeconstructor(**properties):
     '''A generic class-like constructor that knows our class name is stored as nodetype
@@ -166,7 +167,12 @@ class GraphNode(object):
             return prefixvalue
         # OK.  We're in the more complicated case...
         # Our expectation is that the prefixvalue is JSON...
-        jsonstruct = pyConfigContext(init=prefixvalue)
+        # The JSON string itself serves as its own hash for our cache key
+        cachekey = (TransactionJSONCache.nodeid(self), prefixvalue)
+        jsonstruct = TransactionJSONCache.get(cachekey)
+        if jsonstruct is None:
+            jsonstruct = pyConfigContext(init=prefixvalue)
+            TransactionJSONCache.put(cachekey, jsonstruct)
         if jsonstruct is None:
             # Should we throw an exception instead?
             return valueifnotfound
@@ -428,7 +434,13 @@ class IPtcpportNode(GraphNode):
         Note that we make the port the most significant part of the key - which
         should allow some more interesting queries.
         '''
-        return '%s_%s_%s' % (self.port, self.protocol, self.ipaddr)
+        return IPtcpportNode.ipportkey(self.ipaddr, self.port, self.protocol)
+
+    @staticmethod
+    def ipportkey(ipaddr, port, protocol='tcp'):
+        '''Return the key ('ipport') an IPtcpportNode for this (IPv6 string) ipaddr and port
+        would have - without constructing one'''
+        return '%s_%s_%s' % (port, protocol, ipaddr)
 
 
 @RegisterGraphClass
@@ -482,6 +494,119 @@ class ProcessNode(GraphNode):
         'Return our key attributes in order of significance'
         return ['processname', 'domain']
 
+@RegisterGraphClass
+class PackageNode(GraphNode):
+    '''A node representing a package (of a given type) - shared by every system it's on.
+    Each system's haspackage relationship to it says which version it has installed.
+    Together they make up our package index - see packagediscovery.py.
+    '''
+    def __init__(self, packagename, packagetype, pkgkey=None):
+        GraphNode.__init__(self, domain='metadata')
+        self.packagename = packagename
+        self.packagetype = packagetype
+        if pkgkey is None:
+            pkgkey = PackageNode.packagekey(packagename, packagetype)
+        self.pkgkey = pkgkey
+
+    @staticmethod
+    def packagekey(packagename, packagetype):
+        'Return the key for this package name and type'
+        return '%s:%s' % (packagetype, packagename)
+
+    @staticmethod
+    def __meta_keyattrs__():
+        'Return our key attributes in order of significance'
+        return ['pkgkey']
+
+@RegisterGraphClass
+class BPRuleIndex(GraphNode):
+    '''The (sorted) rule ids which go with a best practice rule index version.
+    This lets us make sense of rule statuses encoded for an older set of rules -
+    see BPRuleStatuses in bestpractices.py.
+    '''
+    def __init__(self, version, ruleids):
+        GraphNode.__init__(self, domain='metadata')
+        self.version = version
+        self.ruleids = ruleids
+
+    @staticmethod
+    def __meta_keyattrs__():
+        'Return our key attributes in order of significance'
+        return ['version']
+
+class TransactionJSONCache(object):
+    '''Cache of parsed JSON values which lasts for the life of the current transaction.
+    Keys are (node id, jhash) - where the jhash identifies the JSON contents,
+    so a changed value simply has a different key.
+    It's shared by SystemNode.jsonval(), GraphNode.get() and everyone using them
+    (like ExpressionContext), so evaluating lots of rules against the same
+    nodes only fetches and parses each JSON blob once per transaction.
+    With no current transaction, we don't cache anything.
+    '''
+    stats = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _cache():
+        'Return the cache dict for the current transaction (if any)'
+        return getattr(CMAdb.transaction, 'jsoncache', None)
+
+    @staticmethod
+    def nodeid(node):
+        'Return the id to use in cache keys for this node'
+        if Store.has_node(node) and not Store.is_abstract(node):
+            return Store.id(node)
+        return id(node)
+
+    @staticmethod
+    def get(key):
+        'Return the cached value for this key - or None'
+        cache = TransactionJSONCache._cache()
+        if cache is None:
+            return None
+        ret = cache.get(key)
+        TransactionJSONCache.stats['hits' if ret is not None else 'misses'] += 1
+        return ret
+
+    @staticmethod
+    def put(key, value):
+        'Cache this value (if we have a transaction, and the value is not None)'
+        cache = TransactionJSONCache._cache()
+        if cache is not None and value is not None:
+            cache[key] = value
+
+class JSONMapCache(object):
+    '''Process-wide, size-bounded cache of JSONMapNodes keyed by their content hash (jhash).
+    A JSONMapNode's contents are completely determined by its jhash, and lots of systems
+    have identical discovery data (same OS image, same packages, same sysctl settings),
+    so one parsed copy serves every system which has it - across transactions too.
+    Everyone shares these objects - so nobody may modify them.
+    Very large blobs aren't worth keeping around, so we don't cache them.
+    '''
+    maxblobsize = 2*1024*1024
+    _cache = LRUCache(1024)
+    stats = _cache.stats
+
+    @staticmethod
+    def get(jhash):
+        'Return the cached JSONMapNode with this jhash - or None'
+        return JSONMapCache._cache.get(jhash)
+
+    @staticmethod
+    def put(node):
+        'Cache this JSONMapNode (if it is not None, and not too large)'
+        if node is not None and len(str(node)) <= JSONMapCache.maxblobsize:
+            JSONMapCache._cache.put(node.jhash, node)
+
+    @staticmethod
+    def forget(jhash):
+        'Remove this jhash from our cache (if present)'
+        JSONMapCache._cache.cache.pop(jhash, None)
+
+    @staticmethod
+    def clear():
+        'Empty our cache'
+        JSONMapCache._cache.clear()
+
 @RegisterGraphClass
 class JSONMapNode(GraphNode):
     '''A node representing a map object encoded as a JSON string
@@ -496,17 +621,64 @@ class JSONMapNode(GraphNode):
     well, and in some cases extremely well. I've actually seen 3M of (unusually verbose)
     JSON discovery data compress down to less than 40K of binary.
     XML blobs are typically more compressible than the average JSON blob.
-    '''
 
-    def __init__(self, json, jhash=None):
+    So JSON strings at least 'compressthreshold' bytes long are stored zlib-compressed
+    and base64-encoded (Neo4j strings have to be valid unicode) behind a codec tag.
+    The 'json' attribute is what's stored in the database - str(), map() and friends
+    always give you the real (canonical) JSON.  Our jhash is always that of the real JSON.
+    '''
+    # JSON maps start with '{' - so nothing starting with this tag can be raw JSON
+    ZLIBTAG = 'zlib+base64:'
+    compressthreshold = 0   # Compress JSON at least this long (0 means never)
+    codecstats = {'encoded': 0, 'decoded': 0, 'rawbytes': 0, 'storedbytes': 0}
+
+    def __init__(self, json, jhash=None, _map=None):
+        '''Construct a JSONMapNode from a (possibly compressed) JSON string.
+        If the caller has already parsed it, they can give us the parsed pyConfigContext
+        as '_map' - in which case 'json' must already be its canonical string form.
+        '''
         GraphNode.__init__(self, domain='metadata')
-        self._map = pyConfigContext(json)
-        self.json = str(self._map)
+        if _map is None:
+            self._map = pyConfigContext(JSONMapNode.decode(json))
+            self._json = str(self._map)
+        else:
+            self._map = _map
+            self._json = str(json)
         # We use sha224 to keep the length under 60 characters (56 to be specific)
         # This is a performance consideration for the current (2.3) verison of Neo4j
         if jhash is None:
-            jhash = self.strhash(self.json)
+            jhash = self.strhash(self._json)
         self.jhash = jhash
+        self.json = JSONMapNode.encode(self._json)
+
+    @staticmethod
+    def encode(json, threshold=None):
+        '''Return the form of this (canonical) JSON string we should store in the database.
+        We compress it if it's at least 'threshold' bytes long - and it actually helps.'''
+        if threshold is None:
+            threshold = JSONMapNode.compressthreshold
+        if threshold <= 0 or len(json) < threshold:
+            return json
+        encoded = JSONMapNode.ZLIBTAG + base64.b64encode(zlib.compress(json, 6))
+        if len(encoded) >= len(json):
+            return json
+        JSONMapNode.codecstats['encoded'] += 1
+        JSONMapNode.codecstats['rawbytes'] += len(json)
+        JSONMapNode.codecstats['storedbytes'] += len(encoded)
+        return encoded
+
+    @staticmethod
+    def decode(stored):
+        'Return the JSON string for this value from the database (compressed or not)'
+        if JSONMapNode.iscompressed(stored):
+            JSONMapNode.codecstats['decoded'] += 1
+            return zlib.decompress(base64.b64decode(str(stored[len(JSONMapNode.ZLIBTAG):])))
+        return stored
+
+    @staticmethod
+    def iscompressed(stored):
+        'Return True if this value from the database is compressed'
+        return isinstance(stored, (str, unicode)) and stored.startswith(JSONMapNode.ZLIBTAG)
 
     @staticmethod
     def strhash(string):
@@ -515,7 +687,7 @@ class JSONMapNode(GraphNode):
 
     def __str__(self):
         'Convert to string - returning the JSON string itself'
-        return self.json
+        return self._json
 
     def hash(self):
         'Return the (sha224) hash of this JSON string'
@@ -70,7 +70,7 @@ class LinkDiscoveryListener(DiscoveryListener):
     #R0914:684,4:LinkDiscoveryListener.processpkt: Too many local variables (25/15)
     # pylint: disable=R0914
 
-    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged):
+    def processpkt(self, drone, srcaddr, jsonobj, discoverychanged, _dispatch=None):
         '''Trigger Switch discovery or add Low Level (Link Level) discovery data to the database.
         '''
         if not discoverychanged:
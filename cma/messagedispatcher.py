@@ -29,6 +29,8 @@ from datetime import datetime
 from cmadb import CMAdb
 from transaction import Transaction
 from dispatchtarget import DispatchTarget
+from monitoring import MonitorAction
+from systemnode import SystemNode
 from frameinfo import FrameSetTypes
 from AssimCtypes import proj_class_live_object_count, proj_class_max_object_count
 from AssimCclasses import pyAssimObj, dump_c_objects
@@ -146,6 +148,9 @@ class MessageDispatcher(object):
         if CMAdb.store is not None:
             CMAdb.log.critical("Aborting Neo4j transaction %s" % CMAdb.store)
             CMAdb.store.abort()
+            # Our cached MonitorActions (and discovery state) may now disagree with the database
+            MonitorAction.abort()
+            SystemNode.abort_json_processing()
         if CMAdb.transaction is not None:
             CMAdb.log.critical("Aborting network transaction %s" % CMAdb.transaction.tree)
             CMAdb.transaction = None
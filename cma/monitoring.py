@@ -28,12 +28,12 @@ rules for certain kinds of services automatically.
 '''
 
 
-import os, re, time
+import os, re, time, hashlib, copy
 import sys
 from AssimCclasses import pyConfigContext
 from frameinfo import FrameTypes, FrameSetTypes
 from graphnodes import GraphNode, RegisterGraphClass
-from graphnodeexpression import GraphNodeExpression, ExpressionContext
+from graphnodeexpression import GraphNodeExpression, ExpressionContext, LRUCache
 from assimevent import AssimEvent
 from cmadb import CMAdb
 from consts import CMAconsts
@@ -53,6 +53,18 @@ class MonitorAction(GraphNode):
     '''Class representing monitoring actions
     '''
     request_id = time.time()
+    # Counts of activations we sent, and activations we skipped because nothing had changed
+    activatestats = {'sent': 0, 'skipped': 0, 'forced': 0}
+    # In-memory index of MonitorActions by monitorname - see lookup()
+    _nameindex = None
+    nameindexstats = {'hits': 0, 'fallbacks': 0, 'stale': 0}
+    allquery = "START m=node:MonitorAction('*:*') RETURN m"
+    # Unchanged monitoring results only update these in-memory counters.
+    # Last success times are written to the database in bulk every 'flushinterval' seconds
+    steadystats = {'changed': 0, 'unchanged': 0, 'flushed': 0}
+    flushinterval = 300
+    _lastflush = time.time()
+    _pendingsuccess = {}    # monitorname => MonitorAction with an unwritten _lastsuccess
     @staticmethod
     def __meta_keyattrs__():
         'Return our key attributes in order of significance (sort order)'
@@ -95,6 +107,13 @@ class MonitorAction(GraphNode):
             for name in self._arglist:
                 self.arglist.append(name)
                 self.arglist.append(str(self._arglist[name]))
+    def post_db_init(self):
+        '''Remember every MonitorAction we create or load by name - so that we can
+        find them quickly when monitoring results come in'''
+        GraphNode.post_db_init(self)
+        if MonitorAction._nameindex is not None:
+            MonitorAction._nameindex[self.monitorname] = self
+
     def longname(self):
         'Return a long name for the type of monitoring this rule provides'
         if self.provider is not None:
@@ -105,7 +124,26 @@ class MonitorAction(GraphNode):
         'Return a short name for the type of monitoring this rule provides'
         return self.monitortype
 
-    def activate(self, monitoredentity, runon=None):
+    def definition_hash(self):
+        '''Return a hash of everything which defines what this monitoring action does.
+        If this doesn't change, then there's no need to tell the nanoprobe about it again.
+        '''
+        nagiospath = getattr(self, 'nagiospath', None)
+        definition = (self.monitorname, self.monitorclass, self.monitortype, self.provider
+        ,   self.interval, self.timeout, self.warntime
+        ,   None if self.arglist is None else [str(arg) for arg in self.arglist]
+        ,   None if self.argv is None else [str(arg) for arg in self.argv]
+        ,   None if nagiospath is None else [str(path) for path in nagiospath])
+        return hashlib.sha1(str(definition)).hexdigest()
+
+    @staticmethod
+    def _activation_key(monitoredentity, runon):
+        'Return a string identifying this (monitored entity, runon) pair - or None'
+        if Store.is_abstract(monitoredentity) or Store.is_abstract(runon):
+            return None
+        return '%s:%s' % (Store.id(monitoredentity), Store.id(runon))
+
+    def activate(self, monitoredentity, runon=None, force=False):
         '''Relate this monitoring action to the given entity, and start it on the 'runon' system
           Parameters
           ----------
@@ -114,12 +152,31 @@ class MonitorAction(GraphNode):
           runon : Drone
                 The particular Drone which is running this monitoring action.
                 Defaults to 'monitoredentity'
+          force : bool
+                Send the request even if this monitor should already be active
+                with this same definition - for example, when 'runon' has restarted.
+          Returns
+          -------
+          False if this identical monitor was already active, and so we did nothing.
+          True otherwise.
         '''
         from droneinfo import Drone
         if runon is None:
             runon = monitoredentity
         assert isinstance(monitoredentity, GraphNode)
         assert isinstance(runon, Drone)
+        defhash = self.definition_hash()
+        activationkey = MonitorAction._activation_key(monitoredentity, runon)
+        if (not force and not Store.is_abstract(self) and activationkey is not None
+                and (self.isactive or self.monitorclass == 'NEVERMON')
+                and getattr(self, 'defhash', None) == defhash
+                and getattr(self, 'activatedfor', None) == activationkey):
+            # Same definition, same service, same system - and it's already running.
+            MonitorAction.activatestats['skipped'] += 1
+            return False
+        if force:
+            MonitorAction.activatestats['forced'] += 1
+        MonitorAction.activatestats['sent'] += 1
         CMAdb.store.relate_new(self, CMAconsts.REL_monitoring, monitoredentity)
         CMAdb.store.relate_new(runon, CMAconsts.REL_hosting, self)
         if self.monitorclass == 'NEVERMON':
@@ -133,17 +190,21 @@ class MonitorAction(GraphNode):
             %   (str(runon)))
         else:
             reqjson = self.construct_mon_json()
-            CMAdb.transaction.add_packet(runon.destaddr(), FrameSetTypes.DORSCOP, reqjson
+            # All the monitors we start on 'runon' in this transaction go in one packet
+            CMAdb.transaction.add_batched_frame(runon.destaddr(), FrameSetTypes.DORSCOP, reqjson
             ,   frametype=FrameTypes.RSCJSON)
             self.isactive = True
+        self.defhash = defhash
+        self.activatedfor = activationkey
         CMAdb.log.info('Monitoring of service %s activated' % (self.monitorname))
+        return True
 
     def deactivate(self):
         '''Deactivate this monitoring action. Does not remove relationships from the graph'''
         from droneinfo import Drone
         reqjson = self.construct_mon_json()
         for drone in CMAdb.store.load_related(self, CMAconsts.REL_hosting, Drone):
-            CMAdb.transaction.add_packet(drone.primary_ip(), FrameSetTypes.STOPRSCOP
+            CMAdb.transaction.add_batched_frame(drone.primary_ip(), FrameSetTypes.STOPRSCOP
             ,   reqjson, frametype=FrameTypes.RSCJSON)
         self.isactive = False
 
@@ -166,6 +227,49 @@ class MonitorAction(GraphNode):
             return ret
         return None
 
+    @staticmethod
+    def load_nameindex():
+        '''Load all our MonitorActions into our in-memory monitorname index.
+        Return the number of MonitorActions loaded.'''
+        MonitorAction._nameindex = {}
+        for monnode in CMAdb.store.load_cypher_nodes(MonitorAction.allquery, MonitorAction):
+            MonitorAction._nameindex[monnode.monitorname] = monnode
+        return len(MonitorAction._nameindex)
+
+    @staticmethod
+    def abort():
+        '''Forget everything we know about MonitorActions in memory - because the current
+        transaction was aborted, and our objects may have changes that were never written.
+        Our index gets reloaded from the database the next time we need it.'''
+        MonitorAction._nameindex = None
+        MonitorAction._pendingsuccess = {}
+
+    @staticmethod
+    def lookup(monitorname):
+        '''Return the MonitorAction with this monitorname from our in-memory index.
+        If it's not there (or no longer valid) we fall back to the database.
+        Nothing deletes MonitorActions, so we don't try to keep track of deletions.
+        If that changes, the check below still catches objects which are no longer
+        current, and then we go back to the database.
+        '''
+        if MonitorAction._nameindex is None:
+            MonitorAction.load_nameindex()
+        monnode = MonitorAction._nameindex.get(monitorname)
+        if monnode is not None:
+            store = Store.getstore(monnode)
+            # Is it still a current object from the current store?
+            if store is CMAdb.store and (not Store.is_abstract(monnode)
+                                         or monnode in store.clients):
+                MonitorAction.nameindexstats['hits'] += 1
+                return monnode
+            MonitorAction.nameindexstats['stale'] += 1
+            del MonitorAction._nameindex[monitorname]
+        MonitorAction.nameindexstats['fallbacks'] += 1
+        monnode = MonitorAction.find1(monitorname)
+        if monnode is not None:
+            MonitorAction._nameindex[monitorname] = monnode
+        return monnode
+
     @staticmethod
     def logchange(origaddr, monmsgobj):
         '''
@@ -182,12 +286,30 @@ class MonitorAction(GraphNode):
         '''
 
         rscname = monmsgobj[CONFIGNAME_INSTANCE]
-        monnode = MonitorAction.find1(rscname)
+        monnode = MonitorAction.lookup(rscname)
         if monnode is None:
             CMAdb.log.critical('Could not locate monitor node for %s from %s'
             %   (str(monmsgobj), str(origaddr)))
         else:
             monnode.monitorchange(origaddr, monmsgobj)
+        MonitorAction.flush_lastsuccess()
+
+    @staticmethod
+    def flush_lastsuccess(force=False):
+        '''Write out the last success times of all our steady-state MonitorActions
+        - if it's been long enough since the last time we did this.
+        They all go out as part of the current transaction.
+        '''
+        now = time.time()
+        if not force and (now - MonitorAction._lastflush) < MonitorAction.flushinterval:
+            return
+        MonitorAction._lastflush = now
+        for monnode in MonitorAction._pendingsuccess.values():
+            if Store.getstore(monnode) is not CMAdb.store:
+                continue
+            monnode.lastsuccess = int(monnode._lastsuccess)
+            MonitorAction.steadystats['flushed'] += 1
+        MonitorAction._pendingsuccess = {}
 
     def monitorchange(self, origaddr, monmsgobj):
         '''
@@ -223,8 +345,23 @@ class MonitorAction(GraphNode):
             explanation = 'GOT REAL WEIRD (%d)' % int(reason_enum)
             fubar = True
         rscname = monmsgobj[CONFIGNAME_INSTANCE]
+        isworking = success and not fubar
+        if success:
+            self._lastsuccess = time.time()
+        if not fubar and self.isworking == isworking and self.reason == explanation:
+            # Nothing has changed - don't write anything or tell anyone
+            self._seencount = getattr(self, '_seencount', 0) + 1
+            self._lastseen = time.time()
+            MonitorAction.steadystats['unchanged'] += 1
+            if success:
+                MonitorAction._pendingsuccess[self.monitorname] = self
+            return
+        MonitorAction.steadystats['changed'] += 1
+        if success:
+            self.lastsuccess = int(self._lastsuccess)
+            MonitorAction._pendingsuccess.pop(self.monitorname, None)
         msg = 'Service %s %s' % (rscname, explanation)
-        self.isworking = success and not fubar
+        self.isworking = isworking
         self.reason = explanation
         print >> sys.stderr, 'MESSAGE:', msg
         if fubar:
@@ -329,6 +466,53 @@ class MonitoringRule(object):
     HIGHPRIOMATCH = 5   # We match and we are a good monitoring method
 
     monitor_objects = {'service': {}, 'host': {}}
+    # Rule index - rebuilt whenever the set of rules changes (see _build_index())
+    _ruleindex = None
+    ruleset_version = 0     # Incremented every time the set of rules changes
+    useindex = True
+    # Expressions whose (literal) regexes we can index rules by
+    INDEXEXPRS = {
+        '@basename()':          'basename',
+        'basename()':           'basename',
+        '@basename($pathname)': 'basename',
+        'basename($pathname)':  'basename',
+        '$pathname':            'pathname',
+        '$argv[0]':             'argv[0]',
+        '$argv[-1]':            'argv[-1]',
+    }
+    # How to compute the value of each kind of index key from a context
+    INDEXKEYEXPRS = {
+        'basename':             '@basename()',
+        'pathname':             '$pathname',
+        'argv[0]':              '$argv[0]',
+        'argv[-1]':             '$argv[-1]',
+    }
+    REGEXSPECIALS = '.^$*+?{}[]|()'
+    # Cache of findbestmatch() decisions - see _decisionkey()
+    _decisioncache = LRUCache(8192)
+    usedecisioncache = True
+    decisionstats = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+    # Inputs for each objclass that the current rules can read (None means "don't know")
+    _ruleinputs = None
+    # Values functions read from the context when they're not given them as arguments.
+    # Only the functions in this table can be part of a cacheable rule set.
+    FUNCTIONINPUTS = {
+        'EQ': (), 'NE': (), 'LT': (), 'GT': (), 'LE': (), 'GE': (), 'IN': (), 'NOTIN': (),
+        'NOT': (), 'AND': (), 'OR': (), 'MUST': (), 'NONEOK': (), 'IGNORE': (), 'match': (),
+        'bitwiseOR': (), 'bitwiseAND': (), 'FINDATTRVALUE': (),
+        'basename':         ('pathname',),
+        'dirname':          ('pathname',),
+        'argequals':        ('argv',),
+        'argmatch':         ('argv',),
+        'flagvalue':        ('argv',),
+        'serviceip':        ('procinfo.listenaddrs',),
+        'serviceport':      ('procinfo.listenaddrs',),
+        'serviceipport':    ('procinfo.listenaddrs',),
+        'hascmd':           ('_init_commands.data',),
+        'is_upstartjob':    (), # Available agents are always part of the key
+    }
+    _nameregex = re.compile(r'\$([A-Za-z_][-A-Za-z0-9_.\[\]]*)')
+    _funregex = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)\s*\(')
 
     def __init__(self, monitorclass, tuplespec, objclass='service'):
         '''It is constructed from an list of tuples, each one of which represents
@@ -369,6 +553,185 @@ class MonitoringRule(object):
         if monitorclass not in monrules:
             monrules[monitorclass] = []
         monrules[monitorclass].append(self)
+        MonitoringRule._ruleindex = None
+        MonitoringRule._ruleinputs = None
+        MonitoringRule.ruleset_version += 1
+        MonitoringRule._decisioncache.clear()
+
+    @staticmethod
+    def _regex_literal(regex):
+        '''Return the literal string this (anchored) regex matches, if it only
+        matches a single literal string ("sshd$", "org\\.neo4j\\.Bootstrapper$").
+        Otherwise return None.
+        '''
+        if (regex.flags & ~re.UNICODE) != 0:
+            return None
+        pattern = regex.pattern
+        if not pattern.endswith('$') or pattern.endswith('\\$'):
+            return None
+        literal = ''
+        escaped = False
+        for char in pattern[:-1]:
+            if escaped:
+                if char.isalnum():  # \d, \w, \1 and friends
+                    return None
+                literal += char
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char in MonitoringRule.REGEXSPECIALS:
+                return None
+            else:
+                literal += char
+        if escaped or literal == '':
+            return None
+        return literal
+
+    def _indexkey(self):
+        '''Return the (kind, literal-value) index key for this rule - or None.
+        Every tuple has to match for a rule to match, so any one of them will do.
+        '''
+        for tup in self._tuplespec:
+            expression = tup[0]
+            if not isinstance(expression, (str, unicode)):
+                continue
+            kind = MonitoringRule.INDEXEXPRS.get(expression.strip())
+            if kind is None:
+                continue
+            literal = MonitoringRule._regex_literal(tup[1])
+            if literal is not None:
+                return (kind, literal)
+        return None
+
+    @staticmethod
+    def _build_index():
+        '''Build our rule index.  For each object class and rule type we keep
+        the rules we can't index, and the rules we can index - organized by their key.
+        Every rule is remembered along with its position in the original list,
+        so that we can evaluate the candidate rules in their original order.
+        '''
+        ruleindex = {}
+        for objclass in MonitoringRule.monitor_objects:
+            classindex = {}
+            monrules = MonitoringRule.monitor_objects[objclass]
+            for rtype in monrules:
+                unindexed = []
+                keyed = {}
+                kinds = set()
+                for seqno, rule in enumerate(monrules[rtype]):
+                    key = rule._indexkey()
+                    if key is None:
+                        unindexed.append((seqno, rule))
+                        continue
+                    kinds.add(key[0])
+                    if key not in keyed:
+                        keyed[key] = []
+                    keyed[key].append((seqno, rule))
+                classindex[rtype] = (unindexed, keyed, kinds)
+            ruleindex[objclass] = classindex
+        MonitoringRule._ruleindex = ruleindex
+
+    @staticmethod
+    def candidate_rules(context, objclass='service'):
+        '''Return a dict of rule type => list of rules which could possibly match this
+        context - in their original order.  Any rule that's left out would not have matched.
+        '''
+        mon_objects = MonitoringRule.monobjclass(objclass)
+        if not MonitoringRule.useindex:
+            return mon_objects
+        if MonitoringRule._ruleindex is None:
+            MonitoringRule._build_index()
+        keyvalues = {}
+        ret = {}
+        classindex = MonitoringRule._ruleindex[objclass]
+        for rtype in classindex:
+            (unindexed, keyed, kinds) = classindex[rtype]
+            candidates = list(unindexed)
+            for kind in kinds:
+                if kind not in keyvalues:
+                    keyvalues[kind] = MonitoringRule._indexkeyvalues(kind, context)
+                for value in keyvalues[kind]:
+                    candidates.extend(keyed.get((kind, value), ()))
+            candidates.sort()
+            ret[rtype] = [rule for (_seqno, rule) in candidates]
+        return ret
+
+    @staticmethod
+    def _indexkeyvalues(kind, context):
+        'Return the list of index key values of this kind that this context could match'
+        value = GraphNodeExpression.evaluate(MonitoringRule.INDEXKEYEXPRS[kind], context)
+        if value is None:
+            return []
+        value = str(value)
+        # '$' also matches just before a trailing newline...
+        return [value, value[:-1]] if value.endswith('\n') else [value]
+
+    @staticmethod
+    def _expression_inputs(expression):
+        '''Return the set of context names this expression can read - or None if we
+        can't tell (because it calls a function we don't know about).
+        '''
+        if not isinstance(expression, (str, unicode)):
+            return set()
+        inputs = set(MonitoringRule._nameregex.findall(expression))
+        for funname in MonitoringRule._funregex.findall(expression):
+            if funname not in MonitoringRule.FUNCTIONINPUTS:
+                return None
+            inputs.update(MonitoringRule.FUNCTIONINPUTS[funname])
+        return inputs
+
+    def _rule_inputs(self):
+        'Return the set of context names this rule can read - or None if we can\'t tell'
+        inputs = set()
+        expressions = [tup[0] for tup in self._tuplespec]
+        expressions.extend(self.nvpairs.values())
+        for expression in expressions:
+            exprinputs = MonitoringRule._expression_inputs(expression)
+            if exprinputs is None:
+                return None
+            inputs.update(exprinputs)
+        return inputs
+
+    @staticmethod
+    def _compute_rule_inputs():
+        '''Compute the sorted list of context names each class of rules can read.
+        An objclass whose rules we can't analyze gets None - its decisions aren't cached.
+        '''
+        ruleinputs = {}
+        for objclass in MonitoringRule.monitor_objects:
+            inputs = set()
+            monrules = MonitoringRule.monitor_objects[objclass]
+            for rtype in monrules:
+                for rule in monrules[rtype]:
+                    ruleinput = rule._rule_inputs()
+                    if ruleinput is None:
+                        inputs = None
+                        break
+                    inputs.update(ruleinput)
+                if inputs is None:
+                    break
+            ruleinputs[objclass] = None if inputs is None else sorted(inputs)
+        MonitoringRule._ruleinputs = ruleinputs
+
+    @staticmethod
+    def _decisionkey(context, preferlowoverpart, objclass):
+        '''Return the key for caching the findbestmatch() decision for this context - or None.
+        The key is a hash of everything the rules can look at: the values of the
+        names they read, the set of available monitoring agents, and the rule set version.
+        So identical services on different machines get the same key.
+        '''
+        if MonitoringRule._ruleinputs is None:
+            MonitoringRule._compute_rule_inputs()
+        inputs = MonitoringRule._ruleinputs[objclass]
+        if inputs is None:
+            return None
+        agents = MonitoringRule.compute_available_agents(context)
+        signature = [MonitoringRule.ruleset_version, objclass, bool(preferlowoverpart)]
+        signature.append(sorted([(str(cls), sorted([str(agent) for agent in agents[cls]]))
+                                 for cls in agents.keys()]))
+        for name in inputs:
+            signature.append((name, str(context.get(name, None))))
+        return hashlib.sha1(str(signature)).hexdigest()
 
     @staticmethod
     def monobjclass(mtype='service'):
@@ -523,34 +886,58 @@ class MonitoringRule(object):
 
         raise ValueError('Invalid resource class ("class" = "%s")' % rscclass)
 
+    # Available monitoring agents by (domain, designation) => {agent-class: set(agent-names)}
+    # This lives here instead of in the Drone objects, so it survives reloading them.
+    _agentindex = {}
+
+    @staticmethod
+    def _agentindexkey(node):
+        'Return the key for this node in our available agents index - or None'
+        designation = getattr(node, 'designation', None)
+        if designation is None:
+            return None
+        return (getattr(node, 'domain', None), str(designation))
+
+    @staticmethod
+    def _agentsets(agentdata):
+        'Convert the data from "monitoringagents" discovery into {agent-class: set(agents)}'
+        ret = {}
+        for cls in agentdata.keys():
+            ret[str(cls)] = set([str(agent) for agent in agentdata[cls]])
+        return ret
+
+    @staticmethod
+    def set_available_agents(drone, agentdata):
+        '''Update our index of the monitoring agents available on this drone
+        from the "data" section of its "monitoringagents" discovery.'''
+        agents = MonitoringRule._agentsets(agentdata)
+        key = MonitoringRule._agentindexkey(drone)
+        if key is None:
+            setattr(drone, '_agentcache', agents)
+        else:
+            MonitoringRule._agentindex[key] = agents
+        return agents
+
     @staticmethod
     def compute_available_agents(context):
-        '''Create a cache of all our available monitoring agents - and return it'''
+        '''Return the available monitoring agents for the system in this context
+        as a dict of {agent-class: set(agent-names)}.'''
         if not hasattr(context, 'get') or not hasattr(context, 'objects'):
             context = ExpressionContext(context)
         #CMAdb.log.debug('CREATING AGENT CACHE (%s)' % str(context))
         for node in context.objects:
+            key = MonitoringRule._agentindexkey(node)
+            if key is not None and key in MonitoringRule._agentindex:
+                return MonitoringRule._agentindex[key]
             if hasattr(node, '_agentcache'):
                 # Keep pylint from getting irritated...
-                #CMAdb.log.debug('AGENT ATTR IS %s' % getattr(node, '_agentcache'))
                 return getattr(node, '_agentcache')
             if not hasattr(node, '__iter__') or '_init_monitoringagents' not in node:
                 #CMAdb.log.debug('SKIPPING AGENT NODE (%s)' % (str(node)))
-                #if hasattr(node, 'keys'):
-                #    CMAdb.log.debug('SKIPPING AGENT NODE keys: (%s)' % (str(node.keys())))
                 continue
+            # First time we've seen this system since we started - index it now
             agentobj = pyConfigContext(node['_init_monitoringagents'])
-            agentobj = agentobj['data']
-            ret = {}
-            for cls in agentobj.keys():
-                agents = agentobj[cls]
-                for agent in agents:
-                    if cls not in ret:
-                        ret[cls] = {}
-                    ret[cls][agent] = True
-            setattr(node, '_agentcache', ret)
-            #CMAdb.log.debug('AGENT CACHE IS: %s' % str(ret))
-            return ret
+            return MonitoringRule.set_available_agents(node, agentobj['data'])
         #CMAdb.log.debug('RETURNING NO AGENT CACHE AT ALL!')
         return {}
 
@@ -581,12 +968,35 @@ class MonitoringRule(object):
             Of course, we always prefer a HIGHPRIOMATCH monitoring method first
             and a MEDPRIOMATCH if that's not available.
         '''
+        if not hasattr(context, 'get') or not hasattr(context, 'objects'):
+            context = ExpressionContext(context)
+        key = None
+        if MonitoringRule.usedecisioncache:
+            key = MonitoringRule._decisionkey(context, preferlowoverpart, objclass)
+        if key is None:
+            MonitoringRule.decisionstats['uncacheable'] += 1
+            return MonitoringRule._findbestmatch(context, preferlowoverpart, objclass)
+        decision = MonitoringRule._decisioncache.get(key)
+        if decision is None:
+            MonitoringRule.decisionstats['misses'] += 1
+            decision = MonitoringRule._findbestmatch(context, preferlowoverpart, objclass)
+            MonitoringRule._decisioncache.put(key, decision)
+        else:
+            MonitoringRule.decisionstats['hits'] += 1
+        # Our callers are allowed to scribble on what we give them...
+        return copy.deepcopy(decision)
+
+    @staticmethod
+    def _findbestmatch(context, preferlowoverpart, objclass):
+        'Find the best match among our MonitoringRules - without consulting our decision cache'
         rsctypes = ['ocf', 'nagios', 'lsb', 'NEVERMON'] # Priority ordering...
         # This will make sure the priority list above is maintained :-D
         # Nagios rules can be of a variety of monitoring levels...
         mon_objects = MonitoringRule.monobjclass(objclass)
         if len(rsctypes) < len(mon_objects.keys()):
             raise RuntimeError('Update rsctypes list in findbestmatch()!')
+        # Only bother with the rules which could possibly match
+        mon_objects = MonitoringRule.candidate_rules(context, objclass)
 
         bestmatch = (MonitoringRule.NOMATCH, None)
 
@@ -624,7 +1034,9 @@ class MonitoringRule(object):
         MonitoringRules.
         '''
         result = []
-        mon_objects = MonitoringRule.monobjclass(objclass)
+        if not hasattr(context, 'get') or not hasattr(context, 'objects'):
+            context = ExpressionContext(context)
+        mon_objects = MonitoringRule.candidate_rules(context, objclass)
         keys = mon_objects.keys()
         keys.sort()
         for rtype in keys:
@@ -645,7 +1057,9 @@ class MonitoringRule(object):
         f = open(filename, 'r')
         s = f.read()
         f.close()
-        return MonitoringRule.ConstructFromString(s)
+        rule = MonitoringRule.ConstructFromString(s)
+        rule.filename = filename
+        return rule
 
     @staticmethod
     def load_tree(rootdirname, pattern=r".*\.mrule$", followlinks=False):
@@ -665,6 +1079,9 @@ class MonitoringRule(object):
                     continue
                 path = os.path.join(dirpath, filename)
                 MonitoringRule.ConstructFromFileName(path)
+        MonitoringRule._build_index()
+        MonitoringRule._compute_rule_inputs()
+        MonitoringRule._decisioncache.clear()
 
 class LSBMonitoringRule(MonitoringRule):
 
@@ -1109,3 +1526,44 @@ if __name__ == '__main__':
             print fmt2 % descr
 
     MonitoringRule.load_tree("monrules")
+
+    def benchmark(iterations=200):
+        '''Compare findbestmatch with and without the rule index over the monrules directory.
+        They must always give the same answers.'''
+        agentdrone = FakeDrone({'data': {
+            'lsb':      {'ssh', 'rpcbind', 'bacula-director', 'bacula-sd', 'munin-node'},
+            'nagios':   {'check_ssh', 'check_load', 'check_sensors'},
+            'ocf':      {'assimilation/neo4j', 'heartbeat/oracle', 'heartbeat/named'},
+            }})
+        procnodes = [sshnode, udevnode, neonode, oraclenode]
+        for exe in ('rpcbind', 'bacula-dir', 'bacula-sd', 'named', 'skype', 'cupsd', 'master',
+                    'mysqld', 'postgres', 'dnsmasq', 'ntpd', 'perl', 'python', 'apache2'):
+            procnodes.append(ProcessNode('global', 'fred', 'servidor', '/usr/sbin/' + exe,
+                             ['/usr/sbin/' + exe, '-c', '/etc/' + exe], 'root', 'root', '/',
+                             roles=(CMAconsts.ROLE_server,)))
+        timings = {}
+        answers = {}
+        MonitoringRule.usedecisioncache = False
+        for useindex in (False, True):
+            MonitoringRule.useindex = useindex
+            answers[useindex] = []
+            start = time.time()
+            for _ in range(iterations):
+                for procnode in procnodes:
+                    answer = MonitoringRule.findbestmatch((procnode, agentdrone))
+                    if len(answers[useindex]) < len(procnodes):
+                        answers[useindex].append(str(answer))
+            timings[useindex] = time.time() - start
+        MonitoringRule.useindex = True
+        MonitoringRule.usedecisioncache = True
+        assert answers[False] == answers[True]
+        print ('findbestmatch over %d processes x %d: %.3f seconds scanning, %.3f indexed'
+        %       (len(procnodes), iterations, timings[False], timings[True]))
+        start = time.time()
+        for _ in range(iterations):
+            for j in range(len(procnodes)):
+                answer = MonitoringRule.findbestmatch((procnodes[j], agentdrone))
+                assert str(answer) == answers[True][j]
+        print ('findbestmatch with decision cache: %.3f seconds %s'
+        %       (time.time() - start, MonitoringRule.decisionstats))
+    benchmark()
@@ -36,7 +36,6 @@ from monitoring import MonitoringRule, MonitorAction
 from systemnode import SystemNode
 from store import Store
 
-from graphnodes import ProcessNode
 from discoverylistener import DiscoveryListener
 from cmaconfig import ConfigFile
 
@@ -46,25 +45,25 @@ class TCPDiscoveryGenerateMonitoring(DiscoveryListener):
     prio = DiscoveryListener.PRI_OPTION
     wantedpackets = ('tcpdiscovery',)
 
-    def processpkt(self, drone, _unused_srcaddr, jsonobj, _discoverychanged):
+    def processpkt(self, drone, _unused_srcaddr, jsonobj, _discoverychanged, dispatch=None):
         '''Send commands to monitor services for this Systems's listening processes
         We ignore discoverychanged because we always want to monitor even if a system
-        has just come up with the same discovery as before it went down.'''
+        has just come up with the same discovery as before it went down.
+        If its monitors haven't been activated since it came up, we resend them all.'''
 
+        forceresend = not drone.monitors_activated
         drone.monitors_activated = True
         #self.log.debug('In TCPDiscoveryGenerateMonitoring::processpkt for %s with %s (%s)'
         #               %    (drone, _discoverychanged, str(jsonobj)))
-        data = jsonobj['data'] # The data portion of the JSON message
+        dispatch = self.get_dispatch(drone, jsonobj, dispatch)
+        data = dispatch.data() # The data portion of the JSON message
         for procname in data.keys():    # List of nanoprobe-assigned names of processes...
             procinfo = data[procname]
-            processproc = self.store.load_or_create(ProcessNode, domain=drone.domain
-            ,   processname=procname, host=drone.designation
-            ,   pathname=procinfo.get('exe', 'unknown'), argv=procinfo.get('cmdline', 'unknown')
-            ,   uid=procinfo.get('uid','unknown'), gid=procinfo.get('gid', 'unknown')
-            ,   cwd=procinfo.get('cwd', '/'))
             if 'listenaddrs' not in procinfo:
                 # We only monitor services, not clients...
                 continue
+            # Usually TCPDiscoveryListener has already found this ProcessNode for us
+            processproc = dispatch.processnode(self.store, procname)
             montuple = MonitoringRule.findbestmatch((processproc, drone))
             if montuple[0] == MonitoringRule.NOMATCH:
                 processproc.is_monitored = False
@@ -83,7 +82,8 @@ class TCPDiscoveryGenerateMonitoring(DiscoveryListener):
             else:
                 processproc.is_monitored = True
                 agent = montuple[1]
-                self._add_service_monitoring(drone, processproc, agent)
+                if not self._add_service_monitoring(drone, processproc, agent, forceresend):
+                    continue
                 if agent['monitorclass'] == 'NEVERMON':
                     print >> sys.stderr, ('NEVER monitor %s' %  (str(agent['monitortype'])))
                 else:
@@ -92,7 +92,7 @@ class TCPDiscoveryGenerateMonitoring(DiscoveryListener):
 
     # pylint - too many local variables
     # pylint: disable=R0914
-    def _add_service_monitoring(self, drone, monitoredservice, moninfo):
+    def _add_service_monitoring(self, drone, monitoredservice, moninfo, force=False):
         '''
         We start the monitoring of 'monitoredservice' using the information
         in 'moninfo' - which came from MonitoringRule.constructaction()
@@ -101,6 +101,8 @@ class TCPDiscoveryGenerateMonitoring(DiscoveryListener):
             - identification parameters - class, provider, type
             - environment variables
             - command line arguments
+        We return False if this monitoring was already active exactly as requested
+        (and 'force' is False) - in which case we didn't do anything.
         '''
         monitorclass    = moninfo['monitorclass']
         monitortype     = moninfo['monitortype']
@@ -171,23 +173,35 @@ class TCPDiscoveryGenerateMonitoring(DiscoveryListener):
         ,   argv = argv if argv else None) # Neo4j restriction...
         if monitorclass == 'nagios':
             monnode.nagiospath = self.config['monitoring']['nagiospath']
-        if not Store.is_abstract(monnode):
+        previously = not Store.is_abstract(monnode)
+        if previously:
+            # Timing parameters aren't part of the monitor name - pick up any config changes
+            monnode.interval = int(paraminterval)
+            monnode.timeout = int(paramtimeout)
+            monnode.warntime = (int(paramwarntime) if paramwarntime is not None
+                                else monnode.timeout/2)
+        if not monnode.activate(monitoredservice, drone, force=force):
+            return False
+        if previously:
             print >> sys.stderr, ('Previously monitored %s on %s'
             %       (monitortype, drone.designation))
-        monnode.activate(monitoredservice, drone)
+        return True
 
 @SystemNode.add_json_processor
 class DiscoveryGenerateHostMonitoring(TCPDiscoveryGenerateMonitoring):
     '''This class performs host-level monitoring.
     For the moment, that's only using Nagios agents.
     '''
-    def processpkt(self, drone, _unused_srcaddr, _unused_jsonobj, _discoverychanged):
+    def processpkt(self, drone, _unused_srcaddr, _unused_jsonobj, _discoverychanged,
+                   _dispatch=None):
         '''Send commands to monitor host aspects for the given System.
         We ignore discoverychanged because we always want to monitor even if a system
         has just come up with the same discovery as before it went down.
         '''
 
+        forceresend = not getattr(drone, 'hostmonitors_activated', False)
         drone.monitors_activated = True
+        drone.hostmonitors_activated = True
         #self.log.debug('In DiscoveryGenerateHostMonitoring::processpkt for %s with %s (%s)'
         #               %    (drone, _discoverychanged, str(_unused_jsonobj)))
         montuples = MonitoringRule.findallmatches((drone,), objclass='host')
@@ -203,6 +217,7 @@ class DiscoveryGenerateHostMonitoring(TCPDiscoveryGenerateMonitoring):
                 %   (drone.designation, str(montuple[1]), str(montuple[2])))
             else:
                 agent = montuple[1]
-                self._add_service_monitoring(drone, drone, agent)
+                if not self._add_service_monitoring(drone, drone, agent, forceresend):
+                    continue
                 print >> sys.stderr, ('START monitoring host %s using %s:%s agent'
                 %   (drone.designation, agent['monitorclass'], agent['monitortype']))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# Free support is available from the Assimilation Project community - http://assimproj.org
+# Paid support is available from Assimilation Systems Limited - http://assimilationsystems.com
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+'''
+This module maintains our package index from 'packages' discovery.
+
+Each distinct (package type, package name) is a PackageNode, and each system has a
+haspackage relationship (with the installed version) to each package it has installed.
+This lets the package queries find the systems with a given package without fetching
+and parsing everybody's (very large) package discovery JSON.
+'''
+import re
+from consts import CMAconsts
+from store import Store
+from systemnode import SystemNode
+from graphnodes import GraphNode, PackageNode
+from discoverylistener import DiscoveryListener
+
+@SystemNode.add_json_processor
+class PackageDiscoveryListener(DiscoveryListener):
+    'Class for keeping our package index up to date'
+    prio = DiscoveryListener.PRI_CORE
+    wantedpackets = ('packages',)
+
+    # All the packages this system has - with their installed versions
+    systemquery = '''START system=node({systemid})
+                     MATCH (system)-[rel:haspackage]->(pkg)
+                     RETURN pkg, rel.version AS version'''
+    # Which of these packages do we already have PackageNodes for?
+    # PackageNodes are indexed by pkgkey (with the constant value 'None'), so we
+    # look them up through the PackageNode index, with a Lucene query like
+    #   deb\:openssh\-server:None OR deb\:bash:None
+    knownquery = '''START pkg=node:PackageNode({lucene}) RETURN pkg'''
+    lookupbatch = 256   # Lucene allows 1024 clauses by default
+    LUCENE_SPECIAL = re.compile(r'([-+&|!(){}\[\]^"~*?:\\/\s])')
+    stats = {'indexed': 0, 'added': 0, 'removed': 0, 'newpackages': 0, 'unchanged': 0}
+
+    @staticmethod
+    def lucene_query(pkgkeys):
+        'Return a Lucene query for the PackageNode index entries for these package keys'
+        return ' OR '.join(['%s:None' % PackageDiscoveryListener.LUCENE_SPECIAL.sub(r'\\\1', key)
+                            for key in pkgkeys])
+
+    def processpkt(self, drone, _srcaddr, jsonobj, discoverychanged, _dispatch=None):
+        '''Update our package index for this system.
+        We also index systems whose package discovery hasn't changed if they've never
+        been indexed (for example, if they were discovered before we had this index).
+        '''
+        if not discoverychanged and getattr(drone, 'packages_indexed', False):
+            return
+        PackageDiscoveryListener.stats['indexed'] += 1
+        data = jsonobj['data']
+        desired = {}    # pkgkey => (package name, package type, version)
+        for pkgtype in data.keys():
+            packages = data[pkgtype]
+            for package in packages.keys():
+                desired[PackageNode.packagekey(package, pkgtype)] = \
+                    (package, pkgtype, str(packages[package]))
+
+        existing = {}   # pkgkey => (PackageNode, version)
+        for (pkg, version) in self.store.load_cypher_query(PackageDiscoveryListener.systemquery,
+                GraphNode.factory, params={'systemid': Store.id(drone)}):
+            existing[pkg.pkgkey] = (pkg, version)
+
+        # Removed packages and changed versions
+        for pkgkey in existing:
+            (pkg, version) = existing[pkgkey]
+            if pkgkey not in desired or desired[pkgkey][2] != version:
+                self.store.separate(drone, CMAconsts.REL_haspackage, pkg)
+                PackageDiscoveryListener.stats['removed'] += 1
+
+        # New packages and changed versions
+        needed = [pkgkey for pkgkey in desired
+                  if pkgkey not in existing or existing[pkgkey][1] != desired[pkgkey][2]]
+        PackageDiscoveryListener.stats['unchanged'] += len(desired) - len(needed)
+        known = {}
+        lookup = [pkgkey for pkgkey in needed if pkgkey not in existing]
+        batch = PackageDiscoveryListener.lookupbatch
+        for start in range(0, len(lookup), batch):
+            lucene = PackageDiscoveryListener.lucene_query(lookup[start:start+batch])
+            for pkg in self.store.load_cypher_nodes(PackageDiscoveryListener.knownquery,
+                    PackageNode, params={'lucene': lucene}):
+                known[pkg.pkgkey] = pkg
+        for pkgkey in needed:
+            (package, pkgtype, version) = desired[pkgkey]
+            if pkgkey in existing:
+                pkg = existing[pkgkey][0]
+            elif pkgkey in known:
+                pkg = known[pkgkey]
+            else:
+                # Our query says it's not in the database - no need to ask again
+                pkg = self.store.save(PackageNode(package, pkgtype))
+                PackageDiscoveryListener.stats['newpackages'] += 1
+            self.store.relate(drone, CMAconsts.REL_haspackage, pkg, {'version': version})
+            PackageDiscoveryListener.stats['added'] += 1
+        drone.packages_indexed = True
@@ -45,7 +45,7 @@ class ProcSysDiscovery(DiscoveryListener):
     prio = DiscoveryListener.PRI_OPTION
     wantedpackets = ('OS', 'os')
 
-    def processpkt(self, drone, _unused_srcaddr, jsonobj, discoverychanged):
+    def processpkt(self, drone, _unused_srcaddr, jsonobj, discoverychanged, _dispatch=None):
         "Send commands to gather discovery data from /proc/sys"
         if not discoverychanged:
             return
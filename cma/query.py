@@ -28,12 +28,12 @@ This module provides classes associated with querying - including providing meta
 about these queries for the client code.
 '''
 import os, sys, re
-import collections, operator
+import collections, operator, itertools, heapq
 from py2neo import neo4j
-from graphnodes import GraphNode, RegisterGraphClass
+from graphnodes import GraphNode, RegisterGraphClass, JSONMapNode
 from AssimCclasses import pyConfigContext, pyNetAddr
 from AssimCtypes import ADDR_FAMILY_IPV6, ADDR_FAMILY_IPV4, ADDR_FAMILY_802
-from assimjson import JSONtree
+from assimjson import JSONtree, JSONChunker
 from bestpractices import BestPractices
 from cmadb import CMAdb
 from droneinfo import Drone
@@ -45,6 +45,7 @@ class ClientQuery(GraphNode):
     The output of all queries is JSON - as filtered by our security mechanism
     '''
     node_query_url = "/doquery/GetaNodeById"
+    CMDLINE_MAXJSON = 5120  # Largest JSON attribute we expand for command line queries
     def __init__(self, queryname, JSON_metadata=None):
         '''Parameters
         ----------
@@ -126,6 +127,34 @@ class ClientQuery(GraphNode):
     def execute(self, executor_context, idsonly=False, expandJSON=False, maxJSON=0, elemsonly=False
     ,       **params):
         'Execute the query and return an iterator that produces sanitized (filtered) results'
+        resultiter = self._result_iterator(params)
+        return self.filter_json(executor_context, idsonly, expandJSON
+        ,   maxJSON, resultiter, elemsonly)
+
+    def execute_chunks(self, executor_context, idsonly=False, expandJSON=False, maxJSON=0
+    ,       elemsonly=False, chunksize=None, **params):
+        '''Execute the query and return an iterator that produces the same sanitized (filtered)
+        JSON as execute() - but in chunks of about 'chunksize' bytes, no matter how big
+        (or small) the rows are.  Nice for streaming a large result to a web client.'''
+        resultiter = self._result_iterator(params)
+        return self._chunked_json(executor_context, idsonly, expandJSON, maxJSON, resultiter
+        ,   elemsonly, chunksize)
+
+    def execute_to(self, sink, executor_context, idsonly=False, expandJSON=False, maxJSON=0
+    ,       elemsonly=False, chunksize=None, **params):
+        '''Execute the query and write the same sanitized (filtered) JSON as execute() to 'sink'
+        in chunks of about 'chunksize' bytes.  'sink' is a callable which takes a string -
+        like the write method of a file or the sendall method of a socket.'''
+        resultiter = self._result_iterator(params)
+        chunker = JSONChunker(sink, chunksize)
+        for piece in self._filter_rows(executor_context, idsonly, expandJSON, maxJSON
+        ,       resultiter, elemsonly):
+            if piece is not None:
+                chunker.emit(piece)
+        chunker.flush()
+
+    def _result_iterator(self, params):
+        'Validate our parameters and return an iterator over the raw results of our query'
         if self._db is None:
             raise ValueError('query must be bound to a Store')
 
@@ -140,9 +169,7 @@ class ClientQuery(GraphNode):
                 raise ValueError('Excess parameter "%s" supplied for %s query'
                 %    (pname, self.queryname))
         fixedparams = self.validate_parameters(params)
-        resultiter = queryobj.result_iterator(fixedparams)
-        return self.filter_json(executor_context, idsonly, expandJSON
-        ,   maxJSON, resultiter, elemsonly)
+        return queryobj.result_iterator(fixedparams)
 
 
     def supports_cmdline(self, language='en'):
@@ -155,23 +182,27 @@ class ClientQuery(GraphNode):
         if fmtstring is None:
             fmtstring = self._JSON_metadata['cmdline'][language]
         fixedparams = self.validate_parameters(params)
-        for json in self.execute(executor_context, expandJSON=True
-        ,           maxJSON=5120, elemsonly=True, **fixedparams):
-            obj = pyConfigContext(json)
-            yield ClientQuery._cmdline_substitute(fmtstring, obj)
+        executor_context = executor_context
+        # We substitute fields straight from each result row.
+        # Turning each row into JSON and parsing it back again was most of the work...
+        for result in self._result_iterator(fixedparams):
+            yield ClientQuery._cmdline_substitute(fmtstring
+            ,   QueryResultRow(result, maxJSON=ClientQuery.CMDLINE_MAXJSON))
 
     @staticmethod
     def _cmdline_substitute(fmtstring, queryresult):
         '''Perform expression substitution for command line queries.
-        'Substitute fields into the command line output'''
+        'Substitute fields into the command line output.
+        'queryresult' can be anything with a deepget() method - normally a QueryResultRow'''
         chunks = fmtstring.split('${')
-        result = chunks[0]
+        result = [chunks[0]]
         for j in range(1, len(chunks)):
             # Now we split it up into variable-expression, '}' and extrastuff...
             (variable, extra) = chunks[j].split('}',1)
-            result += str(JSONtree(queryresult.deepget(variable, 'undefined')))
-            result += extra
-        return result
+            result.append(str(JSONtree(queryresult.deepget(variable, 'undefined')
+            ,   expandJSON=True, maxJSON=ClientQuery.CMDLINE_MAXJSON)))
+            result.append(extra)
+        return ''.join(result)
 
     def filter_json(self, executor_context, idsonly, expandJSON, maxJSON
     ,       resultiter, elemsonly=False):
@@ -188,6 +219,44 @@ class ClientQuery(GraphNode):
                         otherwise return the objects themselves
         resultiter - iterator giving return results for us to filter
         '''
+        pieces = []
+        for piece in self._filter_rows(executor_context, idsonly, expandJSON, maxJSON
+        ,       resultiter, elemsonly):
+            if piece is None:
+                yield ''.join(pieces)
+                del pieces[:]
+            else:
+                pieces.append(piece)
+
+    def _chunked_json(self, executor_context, idsonly, expandJSON, maxJSON
+    ,       resultiter, elemsonly=False, chunksize=None):
+        '''Generator returning the same JSON as filter_json() - but in chunks of about
+        'chunksize' bytes instead of a row at a time.
+        Each chunk is passed along as soon as it's complete - even in the middle of a row -
+        so we never hold much more than a chunk, no matter how big the rows are.'''
+        chunks = []
+        chunker = JSONChunker(chunks.append, chunksize)
+        for piece in self._filter_rows(executor_context, idsonly, expandJSON, maxJSON
+        ,       resultiter, elemsonly):
+            if piece is None:
+                continue
+            chunker.emit(piece)
+            if chunks:
+                for chunk in chunks:
+                    yield chunk
+                del chunks[:]
+        chunker.flush()
+        for chunk in chunks:
+            yield chunk
+
+    def _filter_rows(self, executor_context, idsonly, expandJSON, maxJSON
+    ,       resultiter, elemsonly=False):
+        '''Generator yielding sanitized (filtered) JSON for the results from 'resultiter'
+        a piece at a time - see filter_json() for the details.
+        Each row is encoded lazily (JSONtree.iterpieces()), so we never hold a whole row.
+        We yield None after each row and after the trailer, so our callers know where
+        the rows end.
+        '''
         self = self
 
         idsonly = idsonly
@@ -204,11 +273,12 @@ class ClientQuery(GraphNode):
                     ,   ClientQuery.node_query_url
                     ,   Store.id(result[0]))
                 else:
-                    yield rowdelim + str(JSONtree(result[0], expandJSON=expandJSON
-                    ,   maxJSON=maxJSON))
+                    yield rowdelim
+                    for piece in JSONtree(result[0], expandJSON=expandJSON
+                    ,       maxJSON=maxJSON).iterpieces():
+                        yield piece
             else:
                 delim = rowdelim + '{'
-                row = ''
                 # W0212: Access to a protected member _fields of a client class
                 # No other way to get the list of columns/fields...
                 # OK - there may be another way, but I didn't how to apply what Nigel told me
@@ -216,18 +286,19 @@ class ClientQuery(GraphNode):
                 for attr in result._fields:
                     value = getattr(result, attr)
                     if idsonly:
-                        row +=  '%s"%s":"%s"' % (
+                        yield '%s"%s":"%s"' % (
                                 delim
                             ,   attr
                             ,   Store.id(value))
 
                     else:
-                        row += '%s"%s":%s' % (
-                                delim
-                            ,   attr
-                            ,   str(JSONtree(value, expandJSON=expandJSON, maxJSON=maxJSON)))
+                        yield '%s"%s":' % (delim, attr)
+                        for piece in JSONtree(value, expandJSON=expandJSON
+                        ,       maxJSON=maxJSON).iterpieces():
+                            yield piece
                     delim = ','
-                yield row + '}'
+                yield '}'
+            yield None
             if not elemsonly:
                 rowdelim = ','
         if not elemsonly:
@@ -235,6 +306,7 @@ class ClientQuery(GraphNode):
                 yield '{"data":[]}'
             else:
                 yield ']}'
+            yield None
 
     # R0912: Too many branches; R0914: too many local variables
     # pylint: disable=R0914,R0912
@@ -565,6 +637,68 @@ class ClientQuery(GraphNode):
                 except ValueError as e:
                     print >> sys.stderr, 'File %s is invalid: %s' % (path, str(e))
 
+class QueryResultRow(object):
+    '''A query result row (namedtuple) as seen by command line format strings.
+    deepget() returns the same values we would get by converting the row to (expanded)
+    JSON with filter_json() and parsing that into a pyConfigContext - without doing either.
+    '''
+    def __init__(self, result, maxJSON=0, filterprefixes=None):
+        'Initialize our QueryResultRow'
+        self.result = result
+        self.maxJSON = maxJSON
+        self.filterprefixes = tuple(filterprefixes if filterprefixes is not None
+                                    else JSONtree.filterprefixes)
+
+    def deepget(self, key, alternative=None):
+        '''Return value if our row contains the given *structured* key - 'alternative' if not'''
+        # W0212: Access to a protected member _fields of a client class
+        # pylint: disable=W0212
+        if len(self.result) == 1:
+            thing = self.result[0]
+        else:
+            thing = dict(zip(self.result._fields, self.result))
+        names = key.split('.')
+        for j in range(len(names)):
+            if isinstance(thing, pyConfigContext):
+                # Expanded JSON - it knows how to do the rest itself
+                return thing.deepget('.'.join(names[j:]), alternative)
+            thing = self._step(thing, names[j])
+            if thing is None:
+                return alternative
+        return thing
+
+    def _step(self, thing, name):
+        'Return the value of "name" (possibly followed by an [index]) in thing - or None'
+        index = None
+        if name.endswith(']') and name.find('[') > 0:
+            (name, index) = name[:-1].split('[', 1)
+        if isinstance(thing, dict):
+            value = thing.get(name)
+        elif hasattr(thing, '__dict__') and not isinstance(thing, pyNetAddr):
+            value = self._attribute(thing, name)
+        else:
+            return None
+        if index is not None:
+            try:
+                value = value[int(index)]
+            except (TypeError, IndexError, ValueError):
+                return None
+        return value
+
+    def _attribute(self, thing, name):
+        'Return the attribute "name" of this object - the way JSONtree would see it'
+        if name == '_id':
+            return Store.id(thing) if Store.has_node(thing) else None
+        if name.startswith(self.filterprefixes):
+            return None
+        value = thing.__dict__.get(name)
+        if name.startswith('JSON_') and isinstance(value, (str, unicode)):
+            if self.maxJSON > 0 and len(value) > self.maxJSON:
+                return None
+            if value.startswith('{'):
+                value = pyConfigContext(value)
+        return value
+
 class QueryExecutor(object):
     '''An abstract class which knows which can perform a variety of types of queries
     At the moment that's "python" and "cypher".
@@ -920,12 +1054,93 @@ def yield_rule_scores(categories, dtype_totals, rule_totals):
                                         ruleid, score)
 PackageTuple = collections.namedtuple('PackageTuple',
                                       ['domain', 'drone', 'package', 'version', 'packagetype'])
+
+class PackageIndex(object):
+    '''Answers package queries from the package index kept by packagediscovery.py
+    (PackageNodes and haspackage relationships) instead of fetching and parsing
+    every system's package discovery JSON.
+    We match names against the (comparatively short) list of package names in Python,
+    then fetch just the systems which have the matching packages.
+    Systems which haven't been indexed yet (packages_indexed isn't set - for example
+    because their package discovery hasn't been processed since we started indexing)
+    still get their JSON scanned, and the two sets of results are merged.
+    '''
+    existsquery = '''START pkg=node:PackageNode('*:*') RETURN pkg.pkgkey AS key LIMIT 1'''
+    namesquery = '''START pkg=node:PackageNode('*:*')
+                    RETURN id(pkg) AS id, pkg.packagename AS name'''
+    systemsquery = '''START pkg=node({pkgids})
+                      MATCH (system)-[rel:haspackage]->(pkg)
+                      RETURN system, pkg.packagename AS name, rel.version AS version,
+                             pkg.packagetype AS packagetype
+                      ORDER BY system.domain, system.designation'''
+    # Restricts JSON scans to systems which aren't in the index
+    unindexedclause = 'AND coalesce(%s.packages_indexed, false) = false'
+
+    @staticmethod
+    def available(store):
+        '''Return True if we have a package index.
+        Before any packages have been indexed, the queries go back to scanning JSON.'''
+        for _row in store.load_cypher_query(PackageIndex.existsquery, None):
+            return True
+        return False
+
+    @staticmethod
+    def packages(store, namefilter=None):
+        '''Yield a PackageTuple for each installed package whose name namefilter() likes
+        (all of them if namefilter is None)'''
+        pkgids = [row.id for row in store.load_cypher_query(PackageIndex.namesquery, None)
+                  if namefilter is None or namefilter(row.name)]
+        if not pkgids:
+            return
+        for (system, name, version, packagetype) in store.load_cypher_query(
+                PackageIndex.systemsquery, GraphNode.factory, params={'pkgids': pkgids}):
+            yield PackageTuple(system.domain, system, name, version, packagetype)
+
+    @staticmethod
+    def results(store, namefilter, jsonscan):
+        '''Return an iterator giving the PackageTuples for packages whose names namefilter()
+        likes - from our index for indexed systems, and from jsonscan(unindexedonly)
+        for the rest.  Both are ordered by domain and designation, and so are we.'''
+        if not PackageIndex.available(store):
+            return jsonscan(False)
+        return PackageIndex.merge(PackageIndex.packages(store, namefilter), jsonscan(True))
+
+    @staticmethod
+    def merge(*iterators):
+        'Merge PackageTuple iterators which are each ordered by domain and designation'
+        sequence = itertools.count()
+        def decorate(iterator):
+            'Make our PackageTuples sortable by domain and designation (stably)'
+            for row in iterator:
+                yield ((row.domain, row.drone.designation), next(sequence), row)
+        for (_, _, row) in heapq.merge(*[decorate(iterator) for iterator in iterators]):
+            yield row
+
+    @staticmethod
+    def scan_json(store, cypher, systemvar, unindexedonly, namefilter=None):
+        '''Yield PackageTuples by scanning the package JSON returned by this query.
+        The query has an %(unindexed)s placeholder for restricting it to unindexed systems.'''
+        unindexed = PackageIndex.unindexedclause % systemvar if unindexedonly else ''
+        # Not cypher % {...} - package names and regexes can contain '%' characters
+        cypher = cypher.replace('%(unindexed)s', unindexed)
+        for (drone, json) in store.load_cypher_query(cypher, GraphNode.factory):
+            jsonobj = pyConfigContext(JSONMapNode.decode(json))
+            # pylint is confused here - jsonobj['data'] _is_ very much iterable...
+            # pylint: disable=E1133
+            jsondata = jsonobj['data']
+            for pkgtype in jsondata:
+                for package in jsondata[pkgtype]:
+                    if namefilter is None or namefilter(package):
+                        yield PackageTuple(drone.domain, drone, package,
+                                           jsondata[pkgtype][package], pkgtype)
+
 @PythonExec.register
 class PythonPackagePrefixQuery(PythonExec):
     '''query executor returning packages matching the given prefix'''
     PARAMETERS = ['prefix']
     def result_iterator(self, params):
         prefix = params['prefix']
+        namefilter = lambda name: name.startswith(prefix)
         # 0:  domain
         # 1:  Drone
         # 2:  Package name
@@ -935,19 +1150,14 @@ class PythonPackagePrefixQuery(PythonExec):
         '''MATCH (system)-[rel:jsonattr]->(jsonmap)
         WHERE system.nodetype in ['Drone', 'DockerSystem', 'VagrantSystem']
             AND jsonmap.nodetype = 'JSONMapNode'
-            AND rel.jsonname =~ '^_init_packages.*' AND jsonmap.json CONTAINS '"%s'
+            AND rel.jsonname =~ '^_init_packages.*'
+            AND (jsonmap.json CONTAINS '"%s' OR jsonmap.json STARTS WITH '%s')
+            %%(unindexed)s
         RETURN system, jsonmap.json AS json ORDER BY system.domain, system.designation
-        '''     %   prefix)
-        for (drone, json) in self.store.load_cypher_query(cypher, Drone):
-            jsonobj = pyConfigContext(json)
-            # pylint is confused here - jsonobj['data'] _is_ very much iterable...
-            # pylint: disable=E1133
-            jsondata = jsonobj['data']
-            for pkgtype in jsondata:
-                for package in jsondata[pkgtype]:
-                    if package.startswith(prefix):
-                        yield PackageTuple(drone.domain, drone, package,
-                                           jsondata[pkgtype][package], pkgtype)
+        '''     %   (prefix, JSONMapNode.ZLIBTAG))
+        return PackageIndex.results(self.store, namefilter,
+            lambda unindexedonly: PackageIndex.scan_json(self.store, cypher, 'system',
+                                                         unindexedonly, namefilter))
 
 
 @PythonExec.register
@@ -963,18 +1173,12 @@ class PythonAllPackageQuery(PythonExec):
         '''MATCH (system)-[rel:jsonattr]->(jsonmap)
         WHERE system.nodetype in ['Drone', 'DockerSystem', 'VagrantSystem']
             AND rel.jsonname =~ '^_init_packages.*'
+            %(unindexed)s
         RETURN system, jsonmap.json AS json ORDER BY system.domain, system.designation
         ''')
-
-        for (drone, json) in self.store.load_cypher_query(cypher, GraphNode.factory):
-            jsonobj = pyConfigContext(json)
-            # pylint is confused here - jsonobj['data'] _is_ very much iterable...
-            # pylint: disable=E1133
-            jsondata = jsonobj['data']
-            for pkgtype in jsondata:
-                for package in jsondata[pkgtype]:
-                    yield PackageTuple(drone.domain, drone, package,
-                                       jsondata[pkgtype][package], pkgtype)
+        return PackageIndex.results(self.store, None,
+            lambda unindexedonly: PackageIndex.scan_json(self.store, cypher, 'system',
+                                                         unindexedonly))
 
 @PythonExec.register
 class PythonPackageRegexQuery(PythonExec):
@@ -982,6 +1186,8 @@ class PythonPackageRegexQuery(PythonExec):
     PARAMETERS = ['regex']
     def result_iterator(self, params):
         regex = params['regex']
+        regexobj = re.compile('.*' + regex)
+        namefilter = lambda name: regexobj.match(name) is not None
         # 0:  domain
         # 1:  Drone
         # 2:  Package name
@@ -989,21 +1195,14 @@ class PythonPackageRegexQuery(PythonExec):
         cypher = (
         '''START drone=node:Drone('*:*')
            MATCH (drone)-[rel:jsonattr]->(jsonmap)
-           WHERE rel.jsonname =~ '^_init_packages.*' AND jsonmap.json =~ '.*%s.*.*'
-           RETURN drone, jsonmap.json AS json ORDER BY system.domain, system.designation
-        '''     %   regex)
-
-        regexobj = re.compile('.*' + regex)
-        for (drone, json) in self.store.load_cypher_query(cypher, GraphNode.factory):
-            jsonobj = pyConfigContext(json)
-            # pylint is confused here - jsonobj['data'] _is_ very much iterable...
-            # pylint: disable=E1133
-            jsondata = jsonobj['data']
-            for pkgtype in jsondata:
-                for package in jsondata[pkgtype]:
-                    if regexobj.match(package):
-                        yield PackageTuple(drone.domain, drone, package,
-                                           jsondata[pkgtype][package], pkgtype)
+           WHERE rel.jsonname =~ '^_init_packages.*'
+             AND (jsonmap.json =~ '.*%s.*.*' OR jsonmap.json STARTS WITH '%s')
+             %%(unindexed)s
+           RETURN drone, jsonmap.json AS json ORDER BY drone.domain, drone.designation
+        '''     %   (regex, JSONMapNode.ZLIBTAG))
+        return PackageIndex.results(self.store, namefilter,
+            lambda unindexedonly: PackageIndex.scan_json(self.store, cypher, 'drone',
+                                                         unindexedonly, namefilter))
 
 
 @PythonExec.register
@@ -1014,6 +1213,7 @@ class PythonPackageQuery(PythonExec):
         packagename = params['packagename']
         if packagename.find('::') < 0:
             packagename += '::'
+        namefilter = lambda name: name.startswith(packagename)
         # 0:  domain
         # 1:  Drone
         # 2:  Package name
@@ -1021,19 +1221,14 @@ class PythonPackageQuery(PythonExec):
         cypher = (
         '''START drone=node:Drone('*:*')
         MATCH (drone)-[rel:jsonattr]->(jsonmap)
-        WHERE rel.jsonname = '_init_packages' AND jsonmap.json CONTAINS '"%s'
-        return drone, jsonmap.json as json
-        '''     %   packagename)
-        for (drone, json) in self.store.load_cypher_query(cypher, GraphNode.factory):
-            jsonobj = pyConfigContext(json)
-            # pylint is confused here - jsonobj['data'] _is_ very much iterable...
-            # pylint: disable=E1133
-            jsondata = jsonobj['data']
-            for pkgtype in jsondata:
-                for package in jsondata[pkgtype]:
-                    if package.startswith(packagename):
-                        yield PackageTuple(drone.domain, drone, package,
-                                           jsondata[pkgtype][package], pkgtype)
+        WHERE rel.jsonname = '_init_packages'
+          AND (jsonmap.json CONTAINS '"%s' OR jsonmap.json STARTS WITH '%s')
+          %%(unindexed)s
+        return drone, jsonmap.json as json ORDER BY drone.domain, drone.designation
+        '''     %   (packagename, JSONMapNode.ZLIBTAG))
+        return PackageIndex.results(self.store, namefilter,
+            lambda unindexedonly: PackageIndex.scan_json(self.store, cypher, 'drone',
+                                                         unindexedonly, namefilter))
 
 def reltype_expr(reltypes):
     'Create a Cypher query expression for (multiple) relationship types'
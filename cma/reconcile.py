@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number colorcolumn=100
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+#  The Assimilation software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The Assimilation software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+'''
+This module reconciles the subgraph "owned" by a node with what discovery says it
+ought to look like.
+
+Discovery listeners typically describe the children of a node (NICs of a Drone,
+IP addresses of a NIC, and so on) from scratch every time.  Rather than load and
+relate each child separately (a database round trip or two each), we fetch the whole
+existing subgraph in one query, compare it to the desired set of children in memory,
+and only create, update, relate and delete the things that actually changed.
+All of the resulting changes go out in the next Store commit as a single batch.
+'''
+
+from store import Store
+from graphnodes import GraphNode
+
+class OwnedSubgraph(object):
+    '''The subgraph owned by a node - one or two levels of children deep.
+    For example, a Drone owns its NICs (via REL_nicowner) which own their IP addresses
+    (via REL_ipowner).  We identify each child by a single key attribute.
+    '''
+    stats = {'queries': 0, 'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+
+    onelevelquery = '''START owner=node({ownerid})
+                       MATCH (owner)-[:%s]->(child)
+                       RETURN child, [] AS grandchildren'''
+    twolevelquery = '''START owner=node({ownerid})
+                       MATCH (owner)-[:%s]->(child)
+                       OPTIONAL MATCH (child)-[:%s]->(grandchild)
+                       RETURN child, collect(grandchild) AS grandchildren'''
+
+    def __init__(self, store, owner, childrel, childkey, grandchildrel=None, grandchildkey=None):
+        '''Initialize our OwnedSubgraph - and load it from the database (if it's there)
+
+        Parameters
+        ----------
+        store: Store
+            The Store our nodes live in
+        owner: GraphNode
+            The node which owns this subgraph
+        childrel: str
+            The relationship type from 'owner' to its children
+        childkey: str
+            The attribute which identifies each child
+        grandchildrel: str (optional)
+            The relationship type from each child to its children
+        grandchildkey: str (optional)
+            The attribute which identifies each grandchild
+        '''
+        self.store = store
+        self.owner = owner
+        self.childrel = childrel
+        self.childkey = childkey
+        self.grandchildrel = grandchildrel
+        self.grandchildkey = grandchildkey
+        self.children = {}      # childkey => child
+        self.grandchildren = {} # childkey => {grandchildkey => grandchild}
+        if not Store.is_abstract(owner):
+            self._load()
+
+    def _load(self):
+        'Load the existing subgraph in a single query'
+        if self.grandchildrel is None:
+            query = OwnedSubgraph.onelevelquery % self.childrel
+        else:
+            query = OwnedSubgraph.twolevelquery % (self.childrel, self.grandchildrel)
+        OwnedSubgraph.stats['queries'] += 1
+        for (child, grandchildren) in self.store.load_cypher_query(query, GraphNode.factory,
+                params={'ownerid': Store.id(self.owner)}):
+            key = getattr(child, self.childkey)
+            self.children[key] = child
+            self.grandchildren[key] = {}
+            for grandchild in grandchildren:
+                if grandchild is not None:
+                    self.grandchildren[key][getattr(grandchild, self.grandchildkey)] = grandchild
+
+    def _reconcile(self, parent, reltype, existing, desired, cls, keyattr, relprops, known):
+        '''Make the children of 'parent' related by 'reltype' match 'desired'.
+        'known' is True if 'existing' came from our query (so it's complete).
+        Return the resulting {key: child} map.
+        '''
+        result = {}
+        for key in desired:
+            args = desired[key]
+            if key in existing:
+                child = existing[key]
+                changed = False
+                for attr in args:
+                    if attr != 'domain' and getattr(child, attr, None) != args[attr]:
+                        setattr(child, attr, args[attr])
+                        changed = True
+                OwnedSubgraph.stats['updated' if changed else 'unchanged'] += 1
+            else:
+                args = dict(args)
+                args[keyattr] = key
+                child = self.store.load_or_create(cls, **args)
+                if known:
+                    # We know it's not related to 'parent' - no need to ask the database
+                    self.store.relate(parent, reltype, child, relprops)
+                else:
+                    self.store.relate_new(parent, reltype, child, relprops)
+                OwnedSubgraph.stats['added'] += 1
+            result[key] = child
+        for key in existing:
+            if key not in desired:
+                # @TODO Needs to be a 'careful, complete' reference count deletion...
+                # (Store.delete() also removes all its relationships)
+                self.store.delete(existing[key])
+                OwnedSubgraph.stats['deleted'] += 1
+        return result
+
+    def reconcile_children(self, desired, cls, relprops=None):
+        '''Make our owner's children match 'desired'.
+
+        Parameters
+        ----------
+        desired: dict
+            {key: {attribute: value}} - the other constructor arguments for each child
+            that ought to exist (including 'domain')
+        cls: class
+            The class of our children
+        relprops: dict
+            Properties for any new relationships we create
+        Returns
+        -------
+        The resulting {key: child} map
+        '''
+        return self._reconcile(self.owner, self.childrel, self.children, desired, cls,
+                               self.childkey, relprops, True)
+
+    def reconcile_grandchildren(self, child, desired, cls, relprops=None):
+        '''Make the children of this child match 'desired' - see reconcile_children()
+        '''
+        childkey = getattr(child, self.childkey)
+        # We only know what a child owns if it was part of our subgraph when we loaded it
+        known = self.children.get(childkey) is child
+        existing = self.grandchildren[childkey] if known else {}
+        return self._reconcile(child, self.grandchildrel, existing, desired, cls,
+                               self.grandchildkey, relprops, known)
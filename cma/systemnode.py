@@ -20,16 +20,73 @@
 #
 #
 ''' This module defines the classes for several of our System nodes ...  '''
-import sys, time
+import sys, time, threading, hashlib
 from consts import CMAconsts
 from store import Store
 from cmadb import CMAdb
 from AssimCclasses import pyConfigContext
 from graphnodes import RegisterGraphClass, GraphNode, JSONMapNode,  \
-        add_an_array_item, delete_an_array_item, nodeconstructor
+        add_an_array_item, delete_an_array_item, nodeconstructor, TransactionJSONCache, \
+        ProcessNode, JSONMapCache
 from cmaconfig import ConfigFile
 from AssimCtypes import CONFIGNAME_TYPE
 from frameinfo import FrameTypes, FrameSetTypes
+from graphnodeexpression import LRUCache
+
+class DiscoveryDispatch(object):
+    '''Per-packet state shared by all the listeners a discovery packet is dispatched to.
+    Listeners run in priority order, so later listeners can reuse the work of earlier ones
+    instead of repeating the same lookups and conversions.
+    For example, TCPDiscoveryListener resolves the ProcessNodes for a 'tcpdiscovery'
+    packet, and TCPDiscoveryGenerateMonitoring picks them up from here.
+    '''
+    stats = {'dispatches': 0, 'processhits': 0, 'processmisses': 0}
+
+    def __init__(self, system, jsonobj):
+        'Initialize our DiscoveryDispatch for this system and JSON discovery packet'
+        DiscoveryDispatch.stats['dispatches'] += 1
+        self.system = system
+        self.jsonobj = jsonobj
+        self.processnodes = {}  # processname => ProcessNode
+        self.shared = {}        # Anything else listeners want to share with each other
+        self._data = None
+        self._processattrs = None
+
+    def data(self):
+        "Return the 'data' portion of our JSON packet (fetched only once)"
+        if self._data is None:
+            self._data = self.jsonobj['data']
+        return self._data
+
+    def processattrs(self):
+        '''Return the ProcessNode constructor arguments for each process in our
+        (tcpdiscovery) packet - as {processname: {attribute: value}}'''
+        if self._processattrs is None:
+            self._processattrs = {}
+            data = self.data()
+            for procname in data.keys():
+                procinfo = data[procname]
+                self._processattrs[procname] = {
+                    'pathname': procinfo.get('exe', 'unknown'),
+                    'argv':     procinfo.get('cmdline', 'unknown'),
+                    'uid':      procinfo.get('uid', 'unknown'),
+                    'gid':      procinfo.get('gid', 'unknown'),
+                    'cwd':      procinfo.get('cwd', '/')}
+        return self._processattrs
+
+    def processnode(self, store, procname):
+        'Return the ProcessNode for this process - resolving it only once per packet'
+        try:
+            ret = self.processnodes[procname]
+            DiscoveryDispatch.stats['processhits'] += 1
+            return ret
+        except KeyError:
+            DiscoveryDispatch.stats['processmisses'] += 1
+        ret = store.load_or_create(ProcessNode, domain=self.system.domain
+        ,   processname=procname, host=self.system.designation
+        ,   **self.processattrs()[procname])
+        self.processnodes[procname] = ret
+        return ret
 
 @RegisterGraphClass
 class SystemNode(GraphNode):
@@ -44,6 +101,11 @@ class SystemNode(GraphNode):
                            return json'''
 
     _JSONprocessors = None # This will get updated
+    _JSONlisteners = {}     # Class => our long-lived listener object of that class
+    _JSONlock = threading.RLock()
+    # (node id, JSON name) => (sha1 of the JSON text exactly as received, canonical jhash)
+    _rawjsonhashes = LRUCache(16384)
+    ingeststats = {'packets': 0, 'rawmatch': 0, 'serialized': 0, 'changed': 0}
 
     def __init__(self, domain, designation, roles=None):
         GraphNode.__init__(self, domain=domain)
@@ -74,15 +136,33 @@ class SystemNode(GraphNode):
         return self.roles
 
     def logjson(self, origaddr, jsontext):
-        'Process and save away JSON discovery data.'
+        '''Process and save away JSON discovery data.
+        We parse the JSON text once, and share that parsed object with our listeners
+        and the JSONMapNode we store it in.  If the text is byte-for-byte what we got last
+        time, we don't even serialize it to compute its canonical hash.
+        '''
         assert CMAdb.store.has_node(self)
+        jsontext = str(jsontext)
         jsonobj = pyConfigContext(jsontext)
         if 'instance' not in jsonobj or 'data' not in jsonobj:
             CMAdb.log.warning('Invalid JSON discovery packet: %s' % jsontext)
             return
+        SystemNode.ingeststats['packets'] += 1
         dtype = jsonobj['instance']
-        discoverychanged = not self.json_eq(dtype, jsontext)
+        oldhash = getattr(self, self.HASH_PREFIX + dtype, None)
+        rawkey = (TransactionJSONCache.nodeid(self), dtype)
+        rawhash = hashlib.sha1(jsontext).hexdigest()
+        if oldhash is not None and SystemNode._rawjsonhashes.get(rawkey) == (rawhash, oldhash):
+            SystemNode.ingeststats['rawmatch'] += 1
+            discoverychanged = False
+        else:
+            SystemNode.ingeststats['serialized'] += 1
+            canonical = str(jsonobj)
+            jhash = JSONMapNode.strhash(canonical)
+            SystemNode._rawjsonhashes.put(rawkey, (rawhash, jhash))
+            discoverychanged = (oldhash != jhash)
         if discoverychanged:
+            SystemNode.ingeststats['changed'] += 1
             CMAdb.log.debug("Saved discovery type %s [%s] for endpoint %s."
             %       (jsonobj['discovertype'], dtype, self.designation))
         else:
@@ -90,7 +170,9 @@ class SystemNode(GraphNode):
                 CMAdb.log.debug('Discovery type %s for endpoint %s is unchanged.'
                 %       (dtype, self.designation))
         self._process_json(origaddr, jsonobj, discoverychanged)
-        self[dtype] = jsontext # This is stored in separate nodes for performance
+        if discoverychanged:
+            # This is stored in separate nodes for performance
+            self._set_json(dtype, jsonobj, canonical, jhash)
 
 
     def __iter__(self):
@@ -112,19 +194,35 @@ class SystemNode(GraphNode):
         return len(self.keys())
 
     def jsonval(self, jsontype):
-        'Construct a python object associated with a particular JSON discovery value.'
-        if not hasattr(self, str(self.HASH_PREFIX + jsontype)):
+        '''Construct a python object associated with a particular JSON discovery value.
+        Our JSON__hash__ attribute tells us which JSONMapNode we want, so if it's in the
+        (shared) JSONMapCache we don't need to go to the database at all.
+        The JSONMapNode we return may be shared with other systems - don't modify it.
+        '''
+        jhash = getattr(self, str(self.HASH_PREFIX + jsontype), None)
+        if jhash is None:
             #print >> sys.stderr, 'DOES NOT HAVE ATTR %s' % jsontype
             #print >> sys.stderr, 'ATTRIBUTES ARE:' , str(self.keys())
             return None
+        cachekey = (TransactionJSONCache.nodeid(self), jhash)
+        node = TransactionJSONCache.get(cachekey)
+        if node is not None:
+            return node
+        node = JSONMapCache.get(jhash)
+        if node is None:
+            node = self._load_jsonnode(jsontype)
+            JSONMapCache.put(node)
+        TransactionJSONCache.put(cachekey, node)
+        return node
+
+    def _load_jsonnode(self, jsontype):
+        'Load the JSONMapNode for this JSON discovery value from the database'
         #print >> sys.stderr, 'LOADING', self.JSONsingleattr, \
         #       {'droneid': Store.id(self), 'jsonname': jsontype}
-        node = CMAdb.store.load_cypher_node(self.JSONsingleattr, JSONMapNode,
+        return CMAdb.store.load_cypher_node(self.JSONsingleattr, JSONMapNode,
                                             params={'droneid': Store.id(self),
                                             'jsonname': str(jsontype)}
                                             )
-        #assert self.json_eq(jsontype, str(node))
-        return node
 
     def get(self, key, alternative=None):
         '''Return JSON object if the given key exists - 'alternative' if not.'''
@@ -149,16 +247,26 @@ class SystemNode(GraphNode):
 
     def __setitem__(self, name, value):
         'Set the given JSON value to the given object/string.'
+        jsonobj = value if isinstance(value, pyConfigContext) else pyConfigContext(value)
+        canonical = str(jsonobj)
+        self._set_json(name, jsonobj, canonical, JSONMapNode.strhash(canonical))
+
+    def _set_json(self, name, jsonobj, canonical, jhash):
+        '''Set the given JSON value from an already-parsed pyConfigContext, its canonical
+        string form and that string's hash - so nobody has to parse or serialize it again'''
         if name in self:
-            if self.json_eq(name, value):
+            if getattr(self, self.HASH_PREFIX + name) == jhash:
                 return
             else:
                 #print >> sys.stderr, 'DELETING ATTRIBUTE', name
                 # FIXME: ADD ATTRIBUTE HISTORY (enhancement)
                 # This will likely involve *not* doing a 'del' here
                 del self[name]
-        jsonnode = CMAdb.store.load_or_create(JSONMapNode, json=value)
+        jsonnode = CMAdb.store.load_or_create(JSONMapNode, json=canonical, jhash=jhash,
+                                              _map=jsonobj)
         setattr(self, self.HASH_PREFIX + name, jsonnode.jhash)
+        TransactionJSONCache.put((TransactionJSONCache.nodeid(self), jsonnode.jhash), jsonnode)
+        JSONMapCache.put(jsonnode)
         CMAdb.store.relate(self, CMAconsts.REL_jsonattr, jsonnode,
                            properties={'jsonname':  name,
                                        'time':   long(round(time.time()))
@@ -167,7 +275,8 @@ class SystemNode(GraphNode):
     def __delitem__(self, name):
         'Delete the given JSON value from the SystemNode.'
         #print >> sys.stderr, 'ATTRIBUTE DELETION:', name
-        jsonnode=self.get(name, None)
+        # We need the node from this transaction, not a (shared) cached copy
+        jsonnode = self._load_jsonnode(name) if name in self else None
         try:
             delattr(self, self.HASH_PREFIX + name)
         except AttributeError:
@@ -189,6 +298,7 @@ class SystemNode(GraphNode):
             # Avoid dangling properties...
 
             CMAdb.log.warning('Deleting old attribute value: %s [%s]' % (name, str(jsonnode)))
+            JSONMapCache.forget(jsonnode.jhash)
             CMAdb.store.delete(jsonnode)
 
     def json_eq(self, key, newvalue):
@@ -205,7 +315,9 @@ class SystemNode(GraphNode):
             return False
         hashname = self.HASH_PREFIX + key
         oldhash = getattr(self, hashname)
-        newhash = JSONMapNode.strhash(str(pyConfigContext(newvalue)))
+        if not isinstance(newvalue, pyConfigContext):
+            newvalue = pyConfigContext(newvalue)
+        newhash = JSONMapNode.strhash(str(newvalue))
         #print >> sys.stderr, 'COMPARING %s to %s for value %s' % (oldhash, newhash, key)
         return oldhash == newhash
 
@@ -248,6 +360,7 @@ class SystemNode(GraphNode):
         'Pass the JSON data along to interested discovery plugins (if any)'
         dtype = jsonobj['discovertype']
         foundone = False
+        dispatch = DiscoveryDispatch(self, jsonobj)
         if CMAdb.debug:
             CMAdb.log.debug('Processing JSON for discovery type [%s]' % dtype)
         for prio in range(0, len(SystemNode._JSONprocessors)):
@@ -256,9 +369,12 @@ class SystemNode(GraphNode):
                 classes = SystemNode._JSONprocessors[prio][dtype]
                 #print >> sys.stderr, 'PROC[%s][%s] = %s' % (prio, dtype, str(classes))
                 for cls in classes:
-                    proc = cls(CMAdb.io.config, CMAdb.transaction, CMAdb.store
-                    ,   CMAdb.log, CMAdb.debug)
-                    proc.processpkt(self, origaddr, jsonobj, discoverychanged)
+                    proc = SystemNode.json_listener(cls)
+                    if proc.threadsafe:
+                        proc.processpkt(self, origaddr, jsonobj, discoverychanged, dispatch)
+                        continue
+                    with proc.lock:
+                        proc.processpkt(self, origaddr, jsonobj, discoverychanged, dispatch)
         if foundone:
             CMAdb.log.info('Processed %schanged %s JSON data from %s into graph.'
             %   ('' if discoverychanged else 'un', dtype, self.designation))
@@ -267,22 +383,60 @@ class SystemNode(GraphNode):
             %   (dtype, self.designation))
 
     @staticmethod
-    def add_json_processor(clstoadd):
-        "Register (add) all the json processors we've been given as arguments"
-
-        if SystemNode._JSONprocessors is None:
-            SystemNode._JSONprocessors = []
-            for _prio in range(0, clstoadd.PRI_LIMIT):
-                SystemNode._JSONprocessors.append({})
+    def json_listener(cls):
+        '''Return our long-lived listener object for this DiscoveryListener class.
+        We make a new one the first time, or if the store or configuration it was
+        made with has been replaced.  This keeps any setup it does out of the per-packet path.
+        '''
+        def iscurrent(proc):
+            'Return True if this listener object was made with our current environment'
+            return (proc is not None and proc.store is CMAdb.store
+                    and proc.config is CMAdb.io.config and proc.debug == CMAdb.debug)
+
+        proc = SystemNode._JSONlisteners.get(cls)
+        if iscurrent(proc):
+            return proc
+        with SystemNode._JSONlock:
+            proc = SystemNode._JSONlisteners.get(cls)
+            if not iscurrent(proc):
+                proc = cls(CMAdb.io.config, CMAdb.io, CMAdb.store, CMAdb.log, CMAdb.debug)
+                SystemNode._JSONlisteners[cls] = proc
+            return proc
 
-        priority = clstoadd.priority()
-        msgtypes = clstoadd.desiredpackets()
+    @staticmethod
+    def abort_json_processing():
+        '''The current transaction has been aborted - tell our JSON processor classes
+        so they can forget anything they remember that didn't make it to the database.'''
+        SystemNode._rawjsonhashes.clear()
+        with SystemNode._JSONlock:
+            classes = set()
+            for prioprocessors in (SystemNode._JSONprocessors or []):
+                for msgtype in prioprocessors:
+                    classes.update(prioprocessors[msgtype])
+        for cls in classes:
+            cls.abort()
 
-        for msgtype in msgtypes:
-            if msgtype not in SystemNode._JSONprocessors[priority]:
-                SystemNode._JSONprocessors[priority][msgtype] = []
-            if clstoadd not in SystemNode._JSONprocessors[priority][msgtype]:
-                SystemNode._JSONprocessors[priority][msgtype].append(clstoadd)
+    @staticmethod
+    def add_json_processor(clstoadd):
+        '''Register (add) all the json processors we've been given as arguments.
+        Classes with threadsafe = True may have their processpkt() run in parallel.'''
+
+        with SystemNode._JSONlock:
+            if SystemNode._JSONprocessors is None:
+                SystemNode._JSONprocessors = []
+                for _prio in range(0, clstoadd.PRI_LIMIT):
+                    SystemNode._JSONprocessors.append({})
+
+            priority = clstoadd.priority()
+            msgtypes = clstoadd.desiredpackets()
+
+            for msgtype in msgtypes:
+                if msgtype not in SystemNode._JSONprocessors[priority]:
+                    SystemNode._JSONprocessors[priority][msgtype] = []
+                if clstoadd not in SystemNode._JSONprocessors[priority][msgtype]:
+                    SystemNode._JSONprocessors[priority][msgtype].append(clstoadd)
+            # (Re-)registering a class gets it a fresh listener object
+            SystemNode._JSONlisteners.pop(clstoadd, None)
 
         return clstoadd
 
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+_suites = ['all', 'cma']
+import sys
+sys.path.extend(['..', '../cma', "/usr/local/lib/python2.7/dist-packages"])
+from arpdiscovery import ArpIPMap, ArpDiscoveryListener
+from store import Store
+from graphnodes import NICNode
+
+class TestArpIPMap(object):
+    'Tests for our bounded IP => MAC map'
+
+    def test_subnetkey(self):
+        assert ArpIPMap.subnetkey('10.10.10.1') == ArpIPMap.subnetkey('10.10.10.254')
+        assert ArpIPMap.subnetkey('10.10.10.1') != ArpIPMap.subnetkey('10.10.11.1')
+        # Nanoprobes report IPv4 addresses as IPv4-mapped IPv6 addresses
+        assert ArpIPMap.subnetkey('::ffff:10.10.10.1') == ArpIPMap.subnetkey('10.10.10.1')
+        assert ArpIPMap.subnetkey('::ffff:10.10.10.1') != ArpIPMap.subnetkey('::ffff:10.10.11.1')
+        assert ArpIPMap.subnetkey('[::ffff:192.168.1.1]') == ArpIPMap.subnetkey('192.168.1.7')
+        assert (ArpIPMap.subnetkey('fe80::1:2:3:4')
+                == ArpIPMap.subnetkey('fe80::5:6:7:8'))
+        assert (ArpIPMap.subnetkey('2001:db8:0:1::1')
+                != ArpIPMap.subnetkey('2001:db8:0:2::1'))
+        assert ArpIPMap.subnetkey('not-an-address') == 'not-an-address'
+
+    def test_get_put(self):
+        ipmap = ArpIPMap()
+        assert ipmap.get('::ffff:10.10.10.1') is None
+        ipmap.put('::ffff:10.10.10.1', '00:11:22:33:44:55')
+        ipmap.put('::ffff:10.10.10.2', '00:11:22:33:44:56')
+        assert ipmap.get('::ffff:10.10.10.1') == '00:11:22:33:44:55'
+        assert ipmap.get('::ffff:10.10.10.2') == '00:11:22:33:44:56'
+        assert len(ipmap) == 2
+
+    def test_per_subnet_limit(self):
+        'A big subnet only pushes out its own addresses'
+        ipmap = ArpIPMap(maxsubnets=4, maxpersubnet=10)
+        ipmap.put('::ffff:10.10.20.1', '00:11:22:33:44:55')
+        for j in range(1, 100):
+            ipmap.put('::ffff:10.10.10.%d' % j, '00:11:22:33:44:%02x' % j)
+        assert ipmap.get('::ffff:10.10.20.1') == '00:11:22:33:44:55'
+        assert ipmap.get('::ffff:10.10.10.1') is None
+        assert ipmap.get('::ffff:10.10.10.99') == '00:11:22:33:44:63'
+        assert len(ipmap) == 11
+
+    def test_subnet_limit(self):
+        ipmap = ArpIPMap(maxsubnets=4, maxpersubnet=10)
+        for j in range(8):
+            ipmap.put('::ffff:10.10.%d.1' % j, '00:11:22:33:44:%02x' % j)
+        assert ipmap.get('::ffff:10.10.0.1') is None
+        assert ipmap.get('::ffff:10.10.7.1') == '00:11:22:33:44:07'
+        assert len(ipmap) == 4
+
+class FakeNode(object):
+    'Looks enough like a bound py2neo node for Store.id() and Store.is_abstract()'
+    def __init__(self, nodeid):
+        self._id = nodeid
+        self.bound = True
+
+class Thing(object):
+    'A NIC, IP address or Drone'
+    def __init__(self, **attrs):
+        for attr in attrs:
+            setattr(self, attr, attrs[attr])
+
+def bound_thing(nodeid, **attrs):
+    'Return a Thing which looks like it came from the database'
+    thing = Thing(**attrs)
+    setattr(thing, '_Store__store_node', FakeNode(nodeid))
+    return thing
+
+class FakeStore(object):
+    'Answers ArpDiscoveryListener queries from canned data, and records what it asks for'
+    def __init__(self, nics, ipowners):
+        self.nics = nics            # {macaddr: NIC}
+        self.ipowners = ipowners    # {ipaddr: (IP, [NIC, ...])}
+        self.queries = []
+        self.saved = []
+        self.related = []
+        self.separated = []
+
+    def load_cypher_query(self, query, _factory, params=None):
+        assert query == ArpDiscoveryListener.ipownerquery
+        self.queries.append(params)
+        terms = params['ipaddrs'].split(' OR ')
+        return iter([self.ipowners[ip] for ip in self.ipowners
+                     if '%s:global' % Store.lucene_escape(ip) in terms])
+
+    def load_or_create(self, cls, **args):
+        assert cls is NICNode
+        if args['macaddr'] not in self.nics:
+            self.nics[args['macaddr']] = Thing(**args)
+        return self.nics[args['macaddr']]
+
+    def save(self, obj):
+        self.saved.append(obj)
+        return obj
+
+    def relate(self, subj, reltype, obj, _properties=None):
+        self.related.append((subj, reltype, obj))
+
+    def separate(self, subj, reltype, obj):
+        self.separated.append((subj, reltype, obj))
+
+IP1 = '::ffff:10.10.10.1'
+IP2 = '::ffff:10.10.10.2'
+IP3 = '::ffff:10.10.10.3'
+MACA = '00:11:22:33:44:55'
+MACB = '00:11:22:33:44:56'
+
+class TestArpDiscoveryListener(object):
+    'Tests for turning ARP discovery into NIC => IP relationships'
+
+    def setup_method(self, _method):
+        ArpDiscoveryListener.abort()
+        ArpDiscoveryListener._ip_map_warmed = True
+        self.nica = bound_thing(2, macaddr=MACA, domain='global')
+        self.nicb = bound_thing(3, macaddr=MACB, domain='global')
+        self.ip1 = bound_thing(4, ipaddr=unicode(IP1), domain='global')
+        self.ip2 = bound_thing(5, ipaddr=unicode(IP2), domain='global')
+        self.store = FakeStore({MACA: self.nica, MACB: self.nicb},
+                               {IP1: (self.ip1, [self.nica]), IP2: (self.ip2, [self.nicb])})
+        self.listener = ArpDiscoveryListener(None, None, self.store, None, False)
+        self.drone = Thing(domain='global', designation='drone1')
+
+    def teardown_method(self, _method):
+        ArpDiscoveryListener.abort()
+
+    def test_add_mac_ips(self):
+        'One query finds every IP and its owner - we only relate and separate what moved'
+        self.listener.add_mac_ips(self.drone, {MACA: [IP1, IP2]})
+        assert len(self.store.queries) == 1
+        assert self.store.queries[0]['ipaddrs'] == \
+            r'\:\:ffff\:10.10.10.1:global OR \:\:ffff\:10.10.10.2:global'
+        # IP1 already belonged to NIC A.  IP2 moved from NIC B to NIC A.
+        assert self.store.separated == [(self.nicb, 'ipowner', self.ip2)]
+        assert self.store.related == [(self.nica, 'ipowner', self.ip2)]
+        assert self.store.saved == []
+
+    def test_lookup_batches(self):
+        'Lots of IP addresses are looked up in batches'
+        ArpDiscoveryListener.lookupbatch = 1
+        try:
+            self.listener.add_mac_ips(self.drone, {MACA: [IP1, IP2]})
+        finally:
+            ArpDiscoveryListener.lookupbatch = 256
+        assert len(self.store.queries) == 2
+        assert self.store.related == [(self.nica, 'ipowner', self.ip2)]
+
+    def test_processpkt_arp(self):
+        'Only new and moved entries reach the database - and only once'
+        jsonobj = {'data': {IP1: MACA, IP2: MACB}, 'instance': '_ARP_eth0'}
+        ArpDiscoveryListener.ip_map.put(IP1, MACA)
+        ArpDiscoveryListener.ip_map.put(IP2, MACB)
+        self.listener.processpkt_arp(self.drone, None, jsonobj)
+        assert self.store.queries == []
+        # IP2 moves to NIC A
+        jsonobj = {'data': {IP1: MACA, IP2: MACA}, 'instance': '_ARP_eth0'}
+        self.listener.processpkt_arp(self.drone, None, jsonobj)
+        assert len(self.store.queries) == 1
+        assert self.store.separated == [(self.nicb, 'ipowner', self.ip2)]
+        assert self.store.related == [(self.nica, 'ipowner', self.ip2)]
+        assert ArpDiscoveryListener.ip_map.get(IP2) == MACA
+        # Nothing new the next time
+        self.listener.processpkt_arp(self.drone, None, jsonobj)
+        assert len(self.store.queries) == 1
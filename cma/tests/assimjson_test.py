@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+_suites = ['all', 'cma']
+import sys
+sys.path.extend(['..', '../cma', "/usr/local/lib/python2.7/dist-packages"])
+import collections
+from assimjson import JSONtree, JSONChunker
+from query import ClientQuery
+
+class TrackedList(list):
+    'A list which remembers how far it has been iterated'
+    def __init__(self, items):
+        list.__init__(self, items)
+        self.seen = 0
+
+    def __iter__(self):
+        for item in list.__iter__(self):
+            self.seen += 1
+            yield item
+
+class Thing(object):
+    'A "normal" python object'
+    def __init__(self, **attrs):
+        for attr in attrs:
+            setattr(self, attr, attrs[attr])
+
+Row = collections.namedtuple('Row', ['name', 'things'])
+
+def query_rows():
+    'Return a couple of (large-ish) query result rows'
+    return [Row('first', TrackedList(['item %d' % j for j in range(5000)])),
+            Row('second', [Thing(a=1, b='two', _hidden=3), {'c': None, 'd': [True, 2.5]}])]
+
+class TestJSONStreaming(object):
+    'Tests for encoding JSON a piece at a time'
+
+    def test_iterpieces(self):
+        'iterpieces() produces the same JSON as str()'
+        tree = {'list': [1, 'x', None, [], {}], 'obj': Thing(a=[Thing()], JSON_x='{}'),
+                'tuple': (False, 3L), 'empty': Thing()}
+        assert ''.join(JSONtree(tree).iterpieces()) == str(JSONtree(tree))
+        for row in query_rows():
+            assert ''.join(JSONtree(row).iterpieces()) == str(JSONtree(row))
+
+    def test_chunker(self):
+        'JSONChunker passes things along in chunks of about chunksize bytes'
+        chunks = []
+        chunker = JSONChunker(chunks.append, chunksize=1000)
+        JSONtree(query_rows()).write(chunker.emit)
+        chunker.flush()
+        assert ''.join(chunks) == str(JSONtree(query_rows()))
+        assert max([len(chunk) for chunk in chunks]) < 2000
+
+    def test_chunked_query_json(self):
+        'Query JSON chunks are the same JSON as filter_json() - and are streamed mid-row'
+        query = ClientQuery.__new__(ClientQuery)
+        expected = ''.join(query.filter_json(None, False, False, 0, iter(query_rows())))
+        rows = query_rows()
+        chunkiter = query._chunked_json(None, False, False, 0, iter(rows), chunksize=1000)
+        firstchunk = next(chunkiter)
+        # We got our first chunk long before we finished encoding the first row
+        assert len(firstchunk) < 2000
+        assert rows[0].things.seen < len(rows[0].things) / 2
+        chunks = [firstchunk] + list(chunkiter)
+        assert ''.join(chunks) == expected
+        assert expected.startswith('{"data":[{"name":"first","things":["item 0",')
+        assert expected.endswith('}]}')
+        assert max([len(chunk) for chunk in chunks]) < 2000
+
+    def test_filter_json_rows(self):
+        'filter_json() returns a row at a time'
+        query = ClientQuery.__new__(ClientQuery)
+        rows = list(query.filter_json(None, False, False, 0, iter(query_rows())))
+        assert len(rows) == 3   # Two rows and the trailer
+        assert rows[1].startswith(',{"name":"second","things":[{"a":1,"b":"two"}')
+        assert rows[2] == ']}'
+        assert list(query.filter_json(None, False, False, 0, iter([]))) == ['{"data":[]}']
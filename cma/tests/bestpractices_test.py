@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+_suites = ['all', 'cma']
+import sys
+sys.path.extend(['..', '../cma', "/usr/local/lib/python2.7/dist-packages"])
+from bestpractices import BPRuleStatuses, BPTracer
+
+RULES = {'itbp-00001': {}, 'itbp-00002': {}, 'nist_V-38526': {}, 'nist_V-38601': {}}
+RESULTS = {'pass': ['itbp-00002'], 'fail': ['itbp-00001', 'nist_V-38601'], 'NA': [],
+           'ignore': ['nist_V-38526']}
+
+class FakeRuleIndex(object):
+    'Looks like a BPRuleIndex node'
+    def __init__(self, version, ruleids):
+        self.version = version
+        self.ruleids = ruleids
+
+class FakeStore(object):
+    'Just enough of a Store for BPRuleStatuses'
+    def __init__(self):
+        self.saved = {}
+    def load_or_create(self, _cls, version, ruleids):
+        self.saved[version] = FakeRuleIndex(version, [unicode(ruleid) for ruleid in ruleids])
+        return self.saved[version]
+    def load(self, _cls, version):
+        return self.saved.get(version)
+
+class TestBPRuleStatuses(object):
+    'Tests for the compact best practice status encoding'
+
+    def setup_method(self, _method):
+        BPRuleStatuses.knownversions = {}
+        BPRuleStatuses.savedversions = set()
+
+    def test_roundtrip(self):
+        codec = BPRuleStatuses(RULES)
+        chars = codec.statuschars(RESULTS)
+        assert chars == 'FPIF'
+        encoded = codec.encode(chars)
+        assert encoded == 'v1:%s:FPIF' % codec.version
+        assert codec.decode(encoded) == chars
+        statuses = codec.statuses(chars)
+        for status in RESULTS:
+            assert sorted(statuses[status]) == sorted(RESULTS[status])
+
+    def test_unknown(self):
+        codec = BPRuleStatuses(RULES)
+        assert codec.decode(None) == '----'
+        assert codec.decode('v0:12345678:FPIF') == '----'
+        assert codec.decode('v1:%s:FP' % codec.version) == '----'
+        assert codec.decode('v1:00000000:FPIF') == '----'
+
+    def test_changed_rules(self):
+        codec = BPRuleStatuses(RULES)
+        encoded = codec.encode(codec.statuschars(RESULTS))
+        newrules = dict(RULES)
+        del newrules['itbp-00002']
+        newrules['aaa-newrule'] = {}
+        newcodec = BPRuleStatuses(newrules)
+        assert newcodec.version != codec.version
+        # aaa-newrule, itbp-00001, nist_V-38526, nist_V-38601
+        assert newcodec.decode(encoded) == '-FIF'
+
+    def test_changed_rules_after_restart(self):
+        store = FakeStore()
+        codec = BPRuleStatuses(RULES)
+        encoded = codec.encode(codec.statuschars(RESULTS))
+        codec.remember(store)
+        assert codec.version in store.saved
+        # Forget everything we knew in memory - as though we restarted
+        BPRuleStatuses.knownversions = {}
+        BPRuleStatuses.savedversions = set()
+        newrules = dict(RULES)
+        newrules['zzz-newrule'] = {}
+        newcodec = BPRuleStatuses(newrules)
+        assert newcodec.decode(encoded) == '-----'
+        assert newcodec.decode(encoded, store) == 'FPIF-'
+
+    def test_legacy_json(self):
+        codec = BPRuleStatuses(RULES)
+        assert codec.decode('{"fail":["itbp-00001"],"pass":["nist_V-38601"]}') == 'F--P'
+
+class FakeDrone(object):
+    'Has a designation - and a str() which is not just the designation'
+    def __init__(self, designation):
+        self.designation = designation
+    def __str__(self):
+        return 'Drone(%s)' % self.designation
+
+class TestBPTracer(object):
+    'Tests for best practice tracing'
+
+    def teardown_method(self, _method):
+        BPTracer.configure(level=BPTracer.OFF, drones=[], ruleids=[])
+
+    def test_drone_tracing(self):
+        assert not BPTracer.enabled(BPTracer.SUMMARY, FakeDrone('servidor'))
+        BPTracer.configure(drones=['Servidor'])
+        assert BPTracer.enabled(BPTracer.SUMMARY, FakeDrone('servidor'))
+        assert BPTracer.enabled(BPTracer.RULES, FakeDrone('SERVIDOR'), 'itbp-00001')
+        assert not BPTracer.enabled(BPTracer.SUMMARY, FakeDrone('otherhost'))
+
+    def test_rule_tracing(self):
+        BPTracer.configure(ruleids=['itbp-00001'])
+        assert BPTracer.enabled(BPTracer.RULES, FakeDrone('servidor'), 'itbp-00001')
+        assert not BPTracer.enabled(BPTracer.RULES, FakeDrone('servidor'), 'itbp-00002')
+
+    def test_level(self):
+        BPTracer.configure(level=BPTracer.SUMMARY)
+        assert BPTracer.enabled(BPTracer.SUMMARY, FakeDrone('servidor'))
+        assert not BPTracer.enabled(BPTracer.RULES, FakeDrone('servidor'))
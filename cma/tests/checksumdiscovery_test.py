@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+_suites = ['all', 'cma']
+import sys
+sys.path.extend(['..', '../cma', "/usr/local/lib/python2.7/dist-packages"])
+from checksumdiscovery import ChecksumIndex, TCPDiscoveryChecksumGenerator
+
+class TestChecksumIndex(object):
+    'Tests for our per-system and fleet-wide checksum index'
+
+    def setup_method(self, _method):
+        self.index = ChecksumIndex()
+        self.index.update('alpha', {'/bin/sh': 'aaa', '/usr/sbin/sshd': 'sss'})
+        self.index.update('bravo', {'/bin/sh': 'aaa', '/usr/sbin/sshd': 'sss'})
+        self.index.update('charlie', {'/bin/sh': 'aaa', '/usr/sbin/sshd': 'ttt'})
+
+    def test_contains(self):
+        'We know which systems we have checksums for'
+        assert 'alpha' in self.index
+        assert 'delta' not in self.index
+
+    def test_fleet_index(self):
+        'The fleet index maps each file to the systems having each checksum'
+        assert self.index.fleet['/bin/sh'] == {'aaa': set(['alpha', 'bravo', 'charlie'])}
+        assert self.index.fleet['/usr/sbin/sshd'] == {'sss': set(['alpha', 'bravo']),
+                                                      'ttt': set(['charlie'])}
+
+    def test_update_changes(self):
+        'Changed checksums are reported - new files and unchanged ones are not'
+        changes = self.index.update('alpha', {'/bin/sh': 'bbb', '/usr/sbin/sshd': 'sss',
+                                              '/usr/bin/java': 'jjj'})
+        assert changes == {'/bin/sh': ('aaa', 'bbb')}
+        assert self.index.fleet['/bin/sh'] == {'aaa': set(['bravo', 'charlie']),
+                                               'bbb': set(['alpha'])}
+        assert self.index.fleet['/usr/bin/java'] == {'jjj': set(['alpha'])}
+
+    def test_update_first_time(self):
+        'A system we have never seen has no changes'
+        assert self.index.update('delta', {'/bin/sh': 'zzz'}) == {}
+        assert self.index.systems['delta'] == {'/bin/sh': 'zzz'}
+
+    def test_update_dropped_file(self):
+        'Files we no longer hear about leave the fleet index'
+        assert self.index.update('charlie', {'/bin/sh': 'aaa'}) == {}
+        assert self.index.fleet['/usr/sbin/sshd'] == {'sss': set(['alpha', 'bravo'])}
+
+    def test_mismatches(self):
+        'Files with different checksums on different systems are mismatches'
+        assert list(self.index.mismatches()) == \
+            [('/usr/sbin/sshd', {'sss': ['alpha', 'bravo'], 'ttt': ['charlie']})]
+        assert list(self.index.mismatches(minsystems=4)) == []
+
+    def test_outliers(self):
+        "A system's checksum is an outlier if another checksum is more common"
+        assert self.index.outliers('charlie') == {'/usr/sbin/sshd': ('ttt', 1, 3)}
+        assert self.index.outliers('alpha') == {}
+        assert self.index.outliers('charlie', ['/bin/sh', '/nosuchfile']) == {}
+        assert self.index.outliers('delta') == {}
+
+    def test_forget_system(self):
+        'Forgetting a system removes it everywhere - including emptied fleet entries'
+        self.index.forget_system('charlie')
+        assert 'charlie' not in self.index
+        assert self.index.fleet['/usr/sbin/sshd'] == {'sss': set(['alpha', 'bravo'])}
+        self.index.forget_system('alpha')
+        self.index.forget_system('bravo')
+        assert self.index.fleet == {}
+        assert list(self.index.mismatches()) == []
+
+    def test_abort(self):
+        'Aborting a transaction starts our index over'
+        TCPDiscoveryChecksumGenerator.index.update('alpha', {'/bin/sh': 'aaa'})
+        TCPDiscoveryChecksumGenerator.abort()
+        assert 'alpha' not in TCPDiscoveryChecksumGenerator.index
+        assert TCPDiscoveryChecksumGenerator.index.fleet == {}
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+_suites = ['all', 'cma']
+import sys
+sys.path.extend(['..', '../cma', "/usr/local/lib/python2.7/dist-packages"])
+from columnareval import ColumnarTable, ColumnarRuleEvaluator
+from graphnodeexpression import GraphNodeExpression, ExpressionContext
+
+def evaluator(values):
+    'Return a ColumnarRuleEvaluator for a table with one row for each of these values of $x'
+    rows = [{'x': value} for value in values]
+    return ColumnarRuleEvaluator(ColumnarTable(['row%d' % j for j in range(len(rows))], rows))
+
+def scalar(rule, values):
+    'Evaluate this rule a row at a time with the normal evaluator'
+    return [GraphNodeExpression.evaluate(rule, ExpressionContext(({'x': value},)))
+            for value in values]
+
+class TestColumnarRuleEvaluator(object):
+    'Tests for evaluating rules a column at a time'
+
+    def test_reuse(self):
+        'Each distinct set of arguments is only computed once'
+        values = ['no', 'yes', 'no', 'no', 'yes']
+        colevaluator = evaluator(values)
+        assert colevaluator.evaluate('EQ($x, no)') == [True, False, True, True, False]
+        assert colevaluator.stats['computed'] == 2
+        assert colevaluator.stats['reused'] == 3
+
+    def test_mixed_bool_int_float(self):
+        'True == 1 == 1.0 in python - but not to EQ, so they must not share results'
+        values = [1, True, 1.0, 1, False, 0]
+        for rule in ('EQ($x, 1)', 'NE($x, 1)', 'EQ($x, 0)', 'IN($x, 1, 2)'):
+            expected = scalar(rule, values)
+            assert evaluator(values).evaluate(rule) == expected, rule
+        assert evaluator(values).evaluate('EQ($x, 1)') == \
+            [True, False, False, True, False, False]
+
+    def test_memokey(self):
+        'Our memo keys distinguish types - even inside tuples'
+        memokey = ColumnarRuleEvaluator._memokey
+        assert memokey((1, 'a')) == memokey((1, 'a'))
+        assert memokey((1, 'a')) != memokey((True, 'a'))
+        assert memokey((1, 'a')) != memokey((1.0, 'a'))
+        assert memokey(((1, 2),)) != memokey(((True, 2),))
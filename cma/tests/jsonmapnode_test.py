@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+_suites = ['all', 'cma']
+import sys
+sys.path.extend(['..', '../cma', "/usr/local/lib/python2.7/dist-packages"])
+from graphnodes import JSONMapNode
+
+BIGJSON = '{"data":{%s}}' % ','.join(['"pkg%04d":"1.%d.0-ubuntu1"' % (j, j) for j in range(500)])
+
+class TestJSONMapNodeCodec(object):
+    'Tests for storing JSONMapNodes compressed'
+
+    def teardown_method(self, _method):
+        JSONMapNode.compressthreshold = 0
+
+    def test_small_not_compressed(self):
+        assert JSONMapNode.encode('{"a":1}', 1) == '{"a":1}'
+        assert JSONMapNode.encode(BIGJSON, 0) == BIGJSON
+        assert JSONMapNode.encode(BIGJSON, len(BIGJSON) + 1) == BIGJSON
+        assert JSONMapNode.encode(BIGJSON) == BIGJSON   # default threshold is 0 - never
+
+    def test_roundtrip(self):
+        encoded = JSONMapNode.encode(BIGJSON, 1024)
+        assert JSONMapNode.iscompressed(encoded)
+        assert encoded.startswith(JSONMapNode.ZLIBTAG)
+        assert len(encoded) < len(BIGJSON)
+        assert JSONMapNode.decode(encoded) == BIGJSON
+        assert JSONMapNode.decode(BIGJSON) == BIGJSON
+        assert not JSONMapNode.iscompressed(BIGJSON)
+
+    def test_incompressible(self):
+        'We never store something bigger than the JSON itself'
+        import base64, os
+        noise = '{"x":"%s"}' % base64.b64encode(os.urandom(3000))
+        assert JSONMapNode.encode(noise, 100) == noise
+
+    def test_node(self):
+        JSONMapNode.compressthreshold = 1024
+        node = JSONMapNode(BIGJSON)
+        assert JSONMapNode.iscompressed(node.json)
+        canonical = str(node)
+        # Constructing from the stored (compressed) form gives the same node
+        fromstored = JSONMapNode(node.json)
+        assert str(fromstored) == canonical
+        assert fromstored.jhash == node.jhash == JSONMapNode.strhash(canonical)
+        assert fromstored['data']['pkg0007'] == '1.7.0-ubuntu1'
+        JSONMapNode.compressthreshold = 0
+        assert JSONMapNode(node.json).json == canonical
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+_suites = ['all', 'cma']
+import sys
+sys.path.extend(['..', '../cma', "/usr/local/lib/python2.7/dist-packages"])
+import collections
+from query import PackageIndex, PackageTuple
+from packagediscovery import PackageDiscoveryListener
+
+NameRow = collections.namedtuple('NameRow', ['id', 'name'])
+
+class FakeSystem(object):
+    'A system (Drone) as far as package queries are concerned'
+    def __init__(self, domain, designation):
+        self.domain = domain
+        self.designation = designation
+
+class FakeStore(object):
+    'Answers the PackageIndex queries from canned data, and records the JSON scans'
+    def __init__(self, pkgnames=(), installed=()):
+        self.pkgnames = pkgnames        # [(pkgid, package name)]
+        self.installed = installed      # [(system, package name, version, package type)]
+        self.systemsparams = None
+
+    def load_cypher_query(self, query, _factory, params=None):
+        if query == PackageIndex.existsquery:
+            return iter([NameRow(pkgid, name) for (pkgid, name) in self.pkgnames][:1])
+        if query == PackageIndex.namesquery:
+            return iter([NameRow(pkgid, name) for (pkgid, name) in self.pkgnames])
+        assert query == PackageIndex.systemsquery
+        self.systemsparams = params
+        ids = dict(self.pkgnames)
+        wanted = [ids[pkgid] for pkgid in params['pkgids']]
+        return iter([row for row in self.installed if row[1] in wanted])
+
+class FakeScan(object):
+    'Stands in for a JSON scan - remembers whether it was restricted to unindexed systems'
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def __call__(self, unindexedonly):
+        self.calls.append(unindexedonly)
+        return iter(self.rows)
+
+def names(results):
+    'Return (designation, package) for each PackageTuple'
+    return [(row.drone.designation, row.package) for row in results]
+
+class TestPackageIndex(object):
+    'Tests for answering package queries from the package index'
+
+    def setup_method(self, _method):
+        self.alpha = FakeSystem('global', 'alpha')
+        self.charlie = FakeSystem('global', 'charlie')
+        self.bravo = FakeSystem('global', 'bravo')      # Not indexed yet
+        self.delta = FakeSystem('global', 'delta')      # Not indexed yet
+        self.store = FakeStore(pkgnames=[(10, 'bash'), (11, 'openssh-server')],
+                               installed=[(self.alpha, 'bash', '4.3', 'deb'),
+                                          (self.alpha, 'openssh-server', '7.2', 'deb'),
+                                          (self.charlie, 'bash', '4.4', 'deb')])
+        self.scan = FakeScan([PackageTuple('global', self.bravo, 'bash', '4.2', 'deb'),
+                              PackageTuple('global', self.delta, 'bash', '4.4', 'deb')])
+
+    def test_no_index(self):
+        'Without any PackageNodes, everything comes from scanning JSON'
+        store = FakeStore()
+        results = list(PackageIndex.results(store, None, self.scan))
+        assert self.scan.calls == [False]
+        assert names(results) == [('bravo', 'bash'), ('delta', 'bash')]
+        assert store.systemsparams is None
+
+    def test_index_and_unindexed_systems(self):
+        'Indexed systems come from the index - the others still have their JSON scanned'
+        results = list(PackageIndex.results(self.store, None, self.scan))
+        assert self.scan.calls == [True]
+        assert names(results) == [('alpha', 'bash'), ('alpha', 'openssh-server'),
+                                  ('bravo', 'bash'), ('charlie', 'bash'), ('delta', 'bash')]
+        assert results[3] == PackageTuple('global', self.charlie, 'bash', '4.4', 'deb')
+
+    def test_namefilter(self):
+        'Only matching package names are fetched from the index'
+        results = list(PackageIndex.results(self.store, lambda name: name.startswith('open'),
+                                            FakeScan([])))
+        assert self.store.systemsparams == {'pkgids': [11]}
+        assert names(results) == [('alpha', 'openssh-server')]
+
+    def test_namefilter_matches_nothing(self):
+        'No matching names means no systems query - but unindexed systems are still scanned'
+        scan = FakeScan([PackageTuple('global', self.bravo, 'zsh', '5.1', 'deb')])
+        results = list(PackageIndex.results(self.store, lambda name: name == 'zsh', scan))
+        assert self.store.systemsparams is None
+        assert scan.calls == [True]
+        assert names(results) == [('bravo', 'zsh')]
+
+    def test_merge_orders_by_domain(self):
+        'Results are ordered by domain first, then designation'
+        other = FakeSystem('another', 'zulu')
+        results = list(PackageIndex.merge(
+            iter([PackageTuple('global', self.alpha, 'bash', '4.3', 'deb')]),
+            iter([PackageTuple('another', other, 'bash', '4.3', 'deb'),
+                  PackageTuple('global', self.alpha, 'zsh', '5.1', 'deb')])))
+        assert names(results) == [('zulu', 'bash'), ('alpha', 'bash'), ('alpha', 'zsh')]
+
+    def test_unindexed_clause(self):
+        'JSON scans of unindexed systems are restricted by packages_indexed'
+        assert 'system.packages_indexed' in PackageIndex.unindexedclause % 'system'
+
+class TestKnownPackageLookup(object):
+    'Tests for looking up existing PackageNodes through the PackageNode index'
+
+    def test_lucene_query(self):
+        'Package keys are escaped and ORed together'
+        query = PackageDiscoveryListener.lucene_query(['deb:openssh-server', 'deb:bash'])
+        assert query == r'deb\:openssh\-server:None OR deb\:bash:None'
+
+    def test_lucene_escapes(self):
+        'Lucene special characters and whitespace are escaped'
+        query = PackageDiscoveryListener.lucene_query(['pip:a b/c(1)*'])
+        assert query == r'pip\:a\ b\/c\(1\)\*:None'
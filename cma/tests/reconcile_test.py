@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+_suites = ['all', 'cma']
+import sys
+sys.path.extend(['..', '../cma', "/usr/local/lib/python2.7/dist-packages"])
+from reconcile import OwnedSubgraph
+
+class FakeNode(object):
+    'Looks enough like a bound py2neo node for Store.id() and Store.is_abstract()'
+    def __init__(self, nodeid):
+        self._id = nodeid
+        self.bound = True
+
+class Thing(object):
+    'A child or grandchild'
+    def __init__(self, **attrs):
+        for attr in attrs:
+            setattr(self, attr, attrs[attr])
+
+def bound_thing(nodeid, **attrs):
+    'Return a Thing which looks like it came from the database'
+    thing = Thing(**attrs)
+    setattr(thing, '_Store__store_node', FakeNode(nodeid))
+    return thing
+
+class FakeStore(object):
+    'Records what OwnedSubgraph asks of its Store'
+    def __init__(self, rows=()):
+        self.rows = rows
+        self.queries = []
+        self.created = []
+        self.related = []
+        self.relatednew = []
+        self.deleted = []
+
+    def load_cypher_query(self, query, _factory, params=None):
+        self.queries.append((query, params))
+        return iter(self.rows)
+
+    def load_or_create(self, cls, **args):
+        obj = cls(**args)
+        self.created.append(obj)
+        return obj
+
+    def relate(self, parent, reltype, child, relprops=None):
+        self.related.append((parent, reltype, child, relprops))
+
+    def relate_new(self, parent, reltype, child, relprops=None):
+        self.relatednew.append((parent, reltype, child, relprops))
+
+    def delete(self, obj):
+        self.deleted.append(obj)
+
+class TestOwnedSubgraph(object):
+    'Tests for reconciling an owned subgraph against what discovery says'
+
+    def setup_method(self, _method):
+        self.nic1 = bound_thing(2, macaddr='00:11:22:33:44:55', ifname='eth0')
+        self.nic2 = bound_thing(3, macaddr='00:11:22:33:44:56', ifname='eth1')
+        self.ip1 = bound_thing(4, ipaddr='10.10.10.1')
+        self.ip2 = bound_thing(5, ipaddr='10.10.10.2')
+        self.owner = bound_thing(1, designation='servidor')
+        self.store = FakeStore(rows=[(self.nic1, [self.ip1, self.ip2]), (self.nic2, [None])])
+        self.subgraph = OwnedSubgraph(self.store, self.owner, 'nicowner', 'macaddr',
+                                      'ipowner', 'ipaddr')
+
+    def test_load(self):
+        assert len(self.store.queries) == 1
+        assert self.store.queries[0][1] == {'ownerid': 1}
+        assert set(self.subgraph.children.keys()) == set([self.nic1.macaddr, self.nic2.macaddr])
+        assert self.subgraph.grandchildren[self.nic1.macaddr] == {'10.10.10.1': self.ip1,
+                                                                 '10.10.10.2': self.ip2}
+        assert self.subgraph.grandchildren[self.nic2.macaddr] == {}
+
+    def test_reconcile_children(self):
+        desired = {'00:11:22:33:44:55': {'domain': 'global', 'ifname': 'eth0'},
+                   '00:11:22:33:44:57': {'domain': 'global', 'ifname': 'eth2'}}
+        result = self.subgraph.reconcile_children(desired, Thing, relprops={'causes': True})
+        # nic1 unchanged, nic2 gone, a new NIC created and related without asking the database
+        assert result['00:11:22:33:44:55'] is self.nic1
+        assert self.store.deleted == [self.nic2]
+        assert len(self.store.created) == 1
+        newnic = self.store.created[0]
+        assert result['00:11:22:33:44:57'] is newnic
+        assert newnic.macaddr == '00:11:22:33:44:57' and newnic.ifname == 'eth2'
+        assert self.store.related == [(self.owner, 'nicowner', newnic, {'causes': True})]
+        assert self.store.relatednew == []
+
+    def test_update_attributes(self):
+        desired = {'00:11:22:33:44:55': {'domain': 'global', 'ifname': 'eth9'},
+                   '00:11:22:33:44:56': {'domain': 'global', 'ifname': 'eth1'}}
+        before = dict(OwnedSubgraph.stats)
+        self.subgraph.reconcile_children(desired, Thing)
+        assert self.nic1.ifname == 'eth9'
+        assert OwnedSubgraph.stats['updated'] == before['updated'] + 1
+        assert OwnedSubgraph.stats['unchanged'] == before['unchanged'] + 1
+        assert self.store.created == [] and self.store.deleted == []
+
+    def test_reconcile_grandchildren(self):
+        desired = {'10.10.10.2': {'domain': 'global'}, '10.10.10.3': {'domain': 'global'}}
+        result = self.subgraph.reconcile_grandchildren(self.nic1, desired, Thing)
+        assert result['10.10.10.2'] is self.ip2
+        assert self.store.deleted == [self.ip1]
+        newip = self.store.created[0]
+        assert newip.ipaddr == '10.10.10.3'
+        assert self.store.related == [(self.nic1, 'ipowner', newip, None)]
+
+    def test_grandchildren_of_unknown_child(self):
+        'We have to ask the database about relationships of children we did not load'
+        othernic = bound_thing(6, macaddr='00:11:22:33:44:58')
+        self.subgraph.reconcile_grandchildren(othernic, {'10.10.10.9': {'domain': 'global'}},
+                                              Thing)
+        assert self.store.related == []
+        assert len(self.store.relatednew) == 1
+        assert self.store.deleted == []
+
+    def test_abstract_owner(self):
+        'A brand new owner has nothing to load'
+        store = FakeStore()
+        subgraph = OwnedSubgraph(store, Thing(designation='newhost'), 'nicowner', 'macaddr')
+        assert store.queries == []
+        subgraph.reconcile_children({'00:11:22:33:44:55': {'domain': 'global'}}, Thing)
+        assert len(store.created) == 1 and len(store.related) == 1
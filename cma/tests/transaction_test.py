@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# vim: smartindent tabstop=4 shiftwidth=4 expandtab number
+#
+# This file is part of the Assimilation Project.
+#
+# Copyright (C) 2016 - Assimilation Systems Limited
+#
+# The Assimilation software is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Assimilation software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with the Assimilation Project software.  If not, see http://www.gnu.org/licenses/
+#
+#
+_suites = ['all', 'cma']
+import sys
+sys.path.extend(['..', '../cma', "/usr/local/lib/python2.7/dist-packages"])
+from AssimCclasses import pyNetAddr
+from frameinfo import FrameSetTypes, FrameTypes
+from transaction import Transaction
+
+DEST = '10.10.10.1:1984'
+
+class TestBatchedFrames(object):
+    'Tests for Transaction.add_batched_frame()'
+
+    def test_same_action_batches(self):
+        trans = Transaction(encryption_required=False)
+        for j in range(3):
+            trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, '{"j":%d}' % j,
+                                    FrameTypes.RSCJSON)
+        assert len(trans.tree['packets']) == 1
+        frames = trans.tree['packets'][0]['frames']
+        assert [frame['framevalue'] for frame in frames] == ['{"j":0}', '{"j":1}', '{"j":2}']
+        assert frames[0]['frametype'] == FrameTypes.RSCJSON
+
+    def test_other_destination(self):
+        trans = Transaction(encryption_required=False)
+        trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, '{"a":1}',
+                                FrameTypes.RSCJSON)
+        trans.add_batched_frame(pyNetAddr('10.10.10.2:1984'), FrameSetTypes.DORSCOP, '{"b":2}',
+                                FrameTypes.RSCJSON)
+        trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, '{"c":3}',
+                                FrameTypes.RSCJSON)
+        assert len(trans.tree['packets']) == 2
+        assert len(trans.tree['packets'][0]['frames']) == 2
+
+    def test_order_preserved(self):
+        'Anything else sent to the same place ends the batch'
+        trans = Transaction(encryption_required=False)
+        trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, '{"a":1}',
+                                FrameTypes.RSCJSON)
+        trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.STOPRSCOP, '{"a":1}',
+                                FrameTypes.RSCJSON)
+        trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, '{"b":2}',
+                                FrameTypes.RSCJSON)
+        assert len(trans.tree['packets']) == 3
+        trans.add_packet(pyNetAddr(DEST), FrameSetTypes.SENDEXPECTHB,
+                         (pyNetAddr('10.10.10.5:1984'),), frametype=FrameTypes.IPPORT)
+        trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, '{"c":3}',
+                                FrameTypes.RSCJSON)
+        assert len(trans.tree['packets']) == 5
+
+    def test_limits(self):
+        trans = Transaction(encryption_required=False)
+        for j in range(Transaction.MAXBATCHFRAMES + 1):
+            trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, '{"j":%d}' % j,
+                                    FrameTypes.RSCJSON)
+        assert len(trans.tree['packets']) == 2
+        assert len(trans.tree['packets'][0]['frames']) == Transaction.MAXBATCHFRAMES
+        trans = Transaction(encryption_required=False)
+        bigvalue = '{"x":"%s"}' % ('x' * (Transaction.MAXBATCHBYTES / 2))
+        for j in range(3):
+            trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, bigvalue,
+                                    FrameTypes.RSCJSON)
+        assert len(trans.tree['packets']) == 3
+
+    def test_abort(self):
+        trans = Transaction(encryption_required=False)
+        trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, '{"a":1}',
+                                FrameTypes.RSCJSON)
+        trans.abort_trans()
+        trans.add_batched_frame(pyNetAddr(DEST), FrameSetTypes.DORSCOP, '{"b":2}',
+                                FrameTypes.RSCJSON)
+        assert len(trans.tree['packets']) == 1
+        assert len(trans.tree['packets'][0]['frames']) == 1
@@ -107,6 +107,8 @@ class Transaction(object):
         self.stats = {'lastcommit': timedelta(0), 'totaltime': timedelta(0)}
         self.encryption_required = encryption_required
         self.post_transaction_packets = []
+        self.jsoncache = {}     # Parsed JSON values - see graphnodes.TransactionJSONCache
+        self.batchpackets = {}  # str(destaddr) => packet still accepting batched frames
 
     def __str__(self):
         'Convert our internal tree to JSON.'
@@ -154,6 +156,42 @@ class Transaction(object):
                     newframes.append({'frametype': frametype, 'framevalue': thing})
             frames = newframes
         self.tree['packets'].append({'action': int(action), 'destaddr': destaddr, 'frames': frames})
+        # Anything batched to this destination after this has to go in a later packet
+        self.batchpackets.pop(str(destaddr), None)
+
+    # Limits on how much we put into a single batched packet
+    MAXBATCHFRAMES = 32
+    MAXBATCHBYTES = 24000
+
+    def add_batched_frame(self, destaddr, action, framevalue, frametype):
+        '''Add a single frame to a packet for this destaddr and action - adding it to the
+        last packet we queued for this destination if that packet is for the same action
+        and has room for it.  This lets us send (for example) all the resource operations
+        for a system in a single packet.  Since nothing else is queued for destaddr in
+        between, the nanoprobe sees the same requests in the same order either way.
+
+        Parameters
+        ----------
+        destaddr : pyNetAddr
+            The address to send this frame to
+        action : int
+            What action to ask the destaddr to perform on our behalf
+        framevalue : str
+            The value of the frame to send
+        frametype: int
+            The frame type of 'framevalue'
+        '''
+        destkey = str(destaddr)
+        framevalue = str(framevalue)
+        batch = self.batchpackets.get(destkey)
+        if (batch is not None and batch['packet']['action'] == int(action)
+                and len(batch['packet']['frames']) < Transaction.MAXBATCHFRAMES
+                and batch['size'] + len(framevalue) <= Transaction.MAXBATCHBYTES):
+            batch['packet']['frames'].append({'frametype': frametype, 'framevalue': framevalue})
+            batch['size'] += len(framevalue)
+            return
+        self.add_packet(destaddr, action, (framevalue,), frametype=frametype)
+        self.batchpackets[destkey] = {'packet': self.tree['packets'][-1], 'size': len(framevalue)}
 
 
 ###################################################################################################
@@ -236,6 +274,7 @@ class Transaction(object):
         'Forget everything about this transaction.'
         self.tree = {'packets': []}
         self.namespace = {}
+        self.batchpackets = {}
 
 if __name__ == '__main__':
 
@@ -261,6 +300,15 @@ if __name__ == '__main__':
         ,   frametype=FrameTypes.IPPORT)
         assert len(trans.tree['packets']) == 2
 
+        # Batched frames to the same place go in the same packet - until something intervenes
+        trans.add_batched_frame(destaddr, FrameSetTypes.DORSCOP, '{"a":1}', FrameTypes.RSCJSON)
+        trans.add_batched_frame(destaddr, FrameSetTypes.DORSCOP, '{"b":2}', FrameTypes.RSCJSON)
+        assert len(trans.tree['packets']) == 3
+        assert len(trans.tree['packets'][2]['frames']) == 2
+        trans.add_batched_frame(destaddr, FrameSetTypes.STOPRSCOP, '{"a":1}', FrameTypes.RSCJSON)
+        trans.add_batched_frame(destaddr, FrameSetTypes.DORSCOP, '{"c":3}', FrameTypes.RSCJSON)
+        assert len(trans.tree['packets']) == 5
+
         print >> sys.stderr, 'JSON: %s\n' % str(trans)
         print >> sys.stderr, 'JSON: %s\n' % str(pyConfigContext(str(trans)))
         trans.commit_trans(io)